@@ -0,0 +1,240 @@
+from collections import Counter
+from contextlib import contextmanager
+
+from arquivo import FICHAS
+
+# Contadores dos painéis por (município, dia de envio, recorte), mantidos incrementalmente.
+# Cada gestante contribui com:
+#   - 'fichas' (valor = classificacao_risco): uma por ficha dentro da área (fa = 0), no dia da ficha;
+#   - 'gestantes', 'fora_area', 'desfecho': situação da ficha mais recente dela (data de envio, depois
+#     id), no dia dessa ficha;
+#   - se tiver ficha ativa (sem desfecho e dentro da área), os perfis da ativa mais recente ('ativas',
+#     'risco', 'genero', 'sexualidade', 'raca', 'deficiencia', 'periodo', 'etnia', 'pnar',
+#     'pontuacao_soma', 'pontuacao_n' e 'item:<secao>' para cada item em ficha_itens).
+# "Mais recente" é escolhida dentro de cada escopo, como os relatórios contavam ao vivo (GROUP BY
+# gestante com MAX(id) no WHERE do escopo): uma vez entre as fichas do município da ficha e outra
+# entre todas as fichas (municipio = ESTADO); e no recorte 0 (todas as fichas) e 1 (só as indígenas,
+# o filtro de saude_indigena). Assim a ficha encerrada em um município continua contando lá mesmo
+# que a gestante tenha ficha mais nova em outro, e o estado conta cada gestante uma vez.
+# Aproximações de um total somável: com período, a gestante entra pelo dia dessa ficha mais recente
+# (não por qualquer ficha enviada no período); num escopo com vários municípios (mas não todos), a
+# gestante com fichas em mais de um deles conta uma vez em cada. Os valores ficam crus (códigos); cada relatório
+# aplica os seus mapas na leitura.
+SQL_TABELA = '''
+    CREATE TABLE IF NOT EXISTS agregados_diarios (
+        municipio TEXT NOT NULL,
+        dia TEXT NOT NULL,           -- data_envio_iso ('' quando a data não pôde ser convertida)
+        indigena INTEGER NOT NULL,   -- recorte: 0 = todas as fichas, 1 = só raca_cor_etnia = 'Indígena'
+        dimensao TEXT NOT NULL,
+        valor TEXT NOT NULL,
+        total REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (municipio, dia, indigena, dimensao, valor)
+    ) WITHOUT ROWID
+'''
+
+LOTE = 500
+
+# Município das linhas que valem para o estado todo (escopo sem filtro de município)
+ESTADO = '*'
+
+_PERFIS = (
+    ('risco', 'classificacao_risco'),
+    ('genero', 'genero'),
+    ('sexualidade', 'sexualidade'),
+    ('raca', 'raca_cor_etnia'),
+    ('deficiencia', 'deficiencia'),
+    ('periodo', 'periodo_gestacional'),
+    ('etnia', 'etnia_indigena'),
+)
+
+
+def _texto(valor):
+    return str(valor).strip() if valor is not None else ''
+
+
+def _numero(valor):
+    texto = _texto(valor)
+    if not texto or not texto.replace('.', '', 1).replace(',', '.', 1).isdigit():
+        return None
+    try:
+        return float(texto)
+    except ValueError:
+        return None
+
+
+def _escopos(row):
+    """Escopos (município, recorte) em que a ficha entra."""
+    municipios = (row['municipio'] or '', ESTADO)
+    recortes = (0, 1) if row['raca_cor_etnia'] == 'Indígena' else (0,)
+    return [(municipio, recorte) for municipio in municipios for recorte in recortes]
+
+
+def _mais_recente(atual, row):
+    if atual is None:
+        return row
+    return max(atual, row, key=lambda r: (r['data_envio_iso'] or '', r['id']))
+
+
+def contribuicoes(cursor, gestante_ids, fonte=FICHAS):
+    """Counter {(municipio, dia, recorte, dimensao, valor): total} das gestantes informadas.
+
+    fonte é a tabela/visão das fichas: calculos_completo inclui as arquivadas.
+    """
+    contrib = Counter()
+    ids = sorted({gid for gid in gestante_ids if gid is not None})
+    for inicio in range(0, len(ids), LOTE):
+        lote = ids[inicio:inicio + LOTE]
+        placeholders = ','.join(['?'] * len(lote))
+
+        # (gestante, município, recorte) -> [ficha mais recente, ficha ativa mais recente]
+        grupos = {}
+        for row in cursor.execute(f'SELECT * FROM {fonte} WHERE gestante_id IN ({placeholders})', lote).fetchall():
+            dia = row['data_envio_iso'] or ''
+            ativa = row['desfecho'] is None and row['fa'] == 0
+            for municipio, recorte in _escopos(row):
+                if row['fa'] == 0:
+                    contrib[(municipio, dia, recorte, 'fichas', _texto(row['classificacao_risco']))] += 1
+                grupo = grupos.setdefault((row['gestante_id'], municipio, recorte), [None, None])
+                grupo[0] = _mais_recente(grupo[0], row)
+                if ativa and (grupo[1] is None or row['id'] > grupo[1]['id']):
+                    grupo[1] = row
+
+        ativas = {}
+        for (_, municipio, recorte), (recente, ativa) in grupos.items():
+            base = (municipio, recente['data_envio_iso'] or '', recorte)
+            contrib[base + ('gestantes', '')] += 1
+            if recente['fa'] == 1:
+                contrib[base + ('fora_area', '')] += 1
+            if recente['desfecho']:
+                contrib[base + ('desfecho', _texto(recente['desfecho']))] += 1
+            if ativa is None:
+                continue
+            base = (municipio, ativa['data_envio_iso'] or '', recorte)
+            ativas.setdefault(ativa['id'], []).append(base)
+            contrib[base + ('ativas', '')] += 1
+            for dimensao, coluna in _PERFIS:
+                contrib[base + (dimensao, _texto(ativa[coluna]))] += 1
+            if ativa['pnar_sinalizado'] == 1:
+                contrib[base + ('pnar', '')] += 1
+            pontuacao = _numero(ativa['pontuacao_total'])
+            if pontuacao is not None:
+                contrib[base + ('pontuacao_soma', '')] += pontuacao
+                contrib[base + ('pontuacao_n', '')] += 1
+
+        if ativas:
+            ficha_ids = list(ativas)
+            for row in cursor.execute(f'''
+                SELECT ficha_id, secao, codigo FROM ficha_itens
+                WHERE ficha_id IN ({','.join(['?'] * len(ficha_ids))})
+            ''', ficha_ids).fetchall():
+                for base in ativas[row[0]]:
+                    contrib[base + ('item:' + row[1], row[2])] += 1
+    return contrib
+
+
+def aplicar_delta(cursor, antes, depois):
+    delta = Counter(depois)
+    delta.subtract(antes)
+    linhas = [chave + (total,) for chave, total in delta.items() if total]
+    if not linhas:
+        return
+    cursor.executemany('''
+        INSERT INTO agregados_diarios (municipio, dia, indigena, dimensao, valor, total)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (municipio, dia, indigena, dimensao, valor) DO UPDATE SET total = total + excluded.total
+    ''', linhas)
+    cursor.executemany('''
+        DELETE FROM agregados_diarios
+        WHERE municipio = ? AND dia = ? AND indigena = ? AND dimensao = ? AND valor = ? AND ABS(total) < 1e-9
+    ''', [linha[:5] for linha in linhas])
+
+
+@contextmanager
+def manter_agregados(cursor, gestante_ids):
+    """Envolve escritas em calculos/gestantes/ficha_itens das gestantes informadas.
+
+    Tira a contribuição delas antes das escritas e aplica a diferença depois, na mesma
+    transação do chamador (o commit continua com a rota).
+    """
+    ids = list(gestante_ids)
+    antes = contribuicoes(cursor, ids)
+    yield
+    aplicar_delta(cursor, antes, contribuicoes(cursor, ids))
+
+
+def _todas_contribuicoes(cursor, fonte=FICHAS):
+    total = Counter()
+    ultimo = 0
+    while True:
+        ids = [row[0] for row in cursor.execute(
+            'SELECT id FROM gestantes WHERE id > ? ORDER BY id LIMIT ?', (ultimo, LOTE)).fetchall()]
+        if not ids:
+            return total
+        total.update(contribuicoes(cursor, ids, fonte))
+        ultimo = ids[-1]
+
+
+def reconstruir_agregados(cursor, fonte=FICHAS):
+    """Recalcula a tabela inteira a partir das fichas (usar dentro de uma transação)."""
+    cursor.execute('DELETE FROM agregados_diarios')
+    aplicar_delta(cursor, Counter(), _todas_contribuicoes(cursor, fonte))
+    return cursor.execute('SELECT COUNT(*) FROM agregados_diarios').fetchone()[0]
+
+
+def verificar_agregados(cursor):
+    """Lista de divergências (chave, gravado, esperado) entre a tabela e um recálculo completo."""
+    esperado = _todas_contribuicoes(cursor)
+    gravado = Counter({
+        tuple(row[:5]): row[5]
+        for row in cursor.execute(
+            'SELECT municipio, dia, indigena, dimensao, valor, total FROM agregados_diarios').fetchall()
+    })
+    divergencias = []
+    for chave in set(esperado) | set(gravado):
+        if abs(esperado.get(chave, 0) - gravado.get(chave, 0)) > 1e-6:
+            divergencias.append((chave, gravado.get(chave, 0), esperado.get(chave, 0)))
+    return sorted(divergencias)
+
+
+def ler_agregados(cursor, municipios=None, dia_inicio=None, dia_fim=None, indigena=False, por_municipio=False):
+    """Soma os agregados no escopo pedido.
+
+    Sem municipios (ou com todos os que têm fichas), lê as linhas do estado todo; com indigena=True,
+    o recorte só de fichas indígenas.
+    Retorna {dimensao: {valor: total}}, ou {municipio: {dimensao: {valor: total}}} com por_municipio=True.
+    """
+    where = ['indigena = ?']
+    params = [1 if indigena else 0]
+    if municipios is not None and not por_municipio and set(municipios) >= {
+            row[0] for row in cursor.execute(
+                'SELECT DISTINCT municipio FROM agregados_diarios WHERE municipio <> ?', (ESTADO,)).fetchall()}:
+        municipios = None
+    if municipios is not None:
+        if not municipios:
+            return {}
+        where.append(f"municipio IN ({','.join(['?'] * len(municipios))})")
+        params.extend(municipios)
+    else:
+        where.append('municipio <> ?' if por_municipio else 'municipio = ?')
+        params.append(ESTADO)
+    if dia_inicio or dia_fim:
+        where.append("dia <> ''")
+    if dia_inicio:
+        where.append('dia >= ?')
+        params.append(dia_inicio)
+    if dia_fim:
+        where.append('dia <= ?')
+        params.append(dia_fim)
+    chave_municipio = 'municipio, ' if por_municipio else ''
+
+    resultado = {}
+    for row in cursor.execute(f'''
+        SELECT {chave_municipio}dimensao, valor, SUM(total) AS total
+        FROM agregados_diarios WHERE {' AND '.join(where)}
+        GROUP BY {chave_municipio}dimensao, valor
+    ''', params).fetchall():
+        destino = resultado.setdefault(row['municipio'], {}) if por_municipio else resultado
+        total = row['total'] if row['dimensao'] == 'pontuacao_soma' else int(round(row['total']))
+        if total:
+            destino.setdefault(row['dimensao'], {})[row['valor']] = total
+    return resultado
@@ -1,15 +1,39 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, send_file
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, send_file, g, has_app_context, Response
 import sqlite3
 import json
 import re
 import uuid
+import time
 from datetime import datetime
-import bcrypt
-from init_db import criar_banco
+from init_db import garantir_schema
+from conexao_db import pool as db_pool
+from copia_relatorios import abrir_copia, iniciar_atualizacao_periodica
+from fila_escrita import fila as fila_escrita
+from senhas import gerar_hash, precisa_rehash, verificar_senha
+from principal import APOIO, USUARIOS, invalidar_principal, obter_principal, principal_atual
+from ficha_itens import decodificar_secao, estatisticas_decodificacao
+from ficha_registro import fabrica_fichas
+from pontuacao import pesos_publicos, pontuar_ficha
+from etnias import ETNIAS, OPCOES as ETNIAS_OPCOES, buscar_etnias, nome_etnia, resolver_etnias
+from fichas import FichaInvalida, data_br_para_iso, gravar_ficha, validar_ficha
+from gestantes import vincular_ficha, atualizar_gestantes
+from agregados import manter_agregados, ler_agregados
+from busca_nomes import FTS5_DISPONIVEL, filtro_nome, termo_fts
+from paginacao import CursorInvalido, paginar
+from exportacao import FORMATOS as EXPORTACAO_FORMATOS, csv_em_blocos, xlsx_em_blocos
+from importacao import EXTENSOES as IMPORTACAO_EXTENSOES, iniciar_importacao, obter_importacao, registrar_importacao
+from arquivo import FICHAS, tabela_fichas
+from manutencao import MODOS_BACKUP, ManutencaoEmAndamento, iniciar_manutencao, obter_manutencao, registrar_manutencao
+from consulta_cpf import buscar_ultima_ficha, estatisticas_cache as estatisticas_cache_cpf, invalidar_cpf, normalizar_cpf
+from sincronizacao import LOTE_MAXIMO as SINCRONIZACAO_LOTE_MAXIMO, chave_valida, gravar_sincronizadas
+from reclassificacao import (ReclassificacaoEmAndamento, iniciar_reclassificacao, obter_reclassificacao,
+                             registrar_reclassificacao)
+from operacoes_lote import LOTE_MAXIMO, TIPOS as OPERACOES_TIPOS, aplicar_operacoes
 from functools import wraps
 from flask_login import LoginManager, UserMixin, login_required, current_user, login_user, logout_user
 import os
 import io
+import tempfile
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
@@ -40,17 +64,19 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT id, role FROM usuarios WHERE id = ?", (user_id,))
-    row = c.fetchone()
-    conn.close()
-    if row:
-        return User(row['id'], row['role'])
+    if str(session.get('user_id')) == str(user_id):
+        principal = usuario_logado(USUARIOS)
+    else:
+        principal = obter_principal(get_db_connection, USUARIOS, int(user_id))
+    if principal:
+        return User(principal.id, principal.role)
     return None
 
 # Criar o banco de dados
-criar_banco()
+garantir_schema()
+
+# Cópia somente leitura para os relatórios pesados (copia_relatorios.py)
+iniciar_atualizacao_periodica()
 
 # Registrar a fonte personalizada para o PDF
 try:
@@ -132,427 +158,6 @@ RACA_COR_ETNIA_MAP = {
     None: 'Não informado'
 }
 
-def get_etnia_nome(etnia_codigo):
-    """Converte código de etnia para nome (COMPLETO - igual ao HTML)"""
-    ETNIA_MAP = {
-        # Não declarar
-        'nao_declarar': 'Não declarar',
-        
-        # Etnias principais (0001-0264)
-        '0001': 'ACONAS (WAKONAS, NACONAS, JAKONA, ACORANES)',
-        '0002': 'AIKANA (AIKANA, MAS SAKA,TUBARAO)',
-        '0003': 'AJURU',
-        '0004': 'AKUNSU (AKUNT\'\'SU)',
-        '0005': 'AMANAYE',
-        '0006': 'AMONDAWA',
-        '0007': 'ANAMBE',
-        '0008': 'APARAI (APALAI)',
-        '0009': 'APIAKA (APIACA)',
-        '0010': 'APINAYE (APINAJE/APINAIE/APINAGE)',
-        '0011': 'APURINA (APORINA, IPURINA, IPURINAN)',
-        '0012': 'ARANA (ARACUAI DO VALE DO JEQUITINHONHA)',
-        '0013': 'ARAPASO (ARAPACO)',
-        '0014': 'ARARA DE RONDONIA (KARO, URUCU, URUKU)',
-        '0015': 'ARARA DO ACRE (SHAWANAUA, AMAWAKA)',
-        '0016': 'ARARA DO ARIPUANA (ARARA DO BEIRADAO/ARI-PUANA)',
-        '0017': 'ARARA DO PARA (UKARAGMA, UKARAMMA)',
-        '0018': 'ARAWETE (ARAUETE)',
-        '0019': 'ARIKAPU (ARICAPU, ARIKAPO, MASUBI, MAXUBI)',
-        '0020': 'ARIKEM (ARIQUEN, ARIQUEME, ARIKEME)',
-        '0021': 'ARIKOSE (ARICOBE)',
-        '0022': 'ARUA',
-        '0023': 'ARUAK (ARAWAK)',
-        '0024': 'ASHANINKA (KAMPA)',
-        '0025': 'ASURINI DO TOCANTINS (AKUAWA/AKWAWA)',
-        '0026': 'ASURINI DO XINGU (AWAETE)',
-        '0027': 'ATIKUM (ATICUM)',
-        '0028': 'AVA - CANOEIRO',
-        '0029': 'AWETI (AUETI/AUETO)',
-        '0030': 'BAKAIRI (KURA, BACAIRI)',
-        '0031': 'BANAWA YAFI (BANAWA, BANAWA-JAFI)',
-        '0032': 'BANIWA (BANIUA, BANIVA, WALIMANAI, WAKUENAI)',
-        '0033': 'BARA (WAIPINOMAKA)',
-        '0034': 'BARASANA (HANERA)',
-        '0035': 'BARE',
-        '0036': 'BORORO (BOE)',
-        '0037': 'BOTOCUDO (GEREN)',
-        '0038': 'CANOE',
-        '0039': 'CASSUPA',
-        '0040': 'CHAMACOCO',
-        '0041': 'CHIKUITANO (XIQUITANO)',
-        '0042': 'CIKIYANA (SIKIANA)',
-        '0043': 'CINTA LARGA (MATETAMAE)',
-        '0044': 'COLUMBIARA (CORUMBIARA)',
-        '0045': 'DENI',
-        '0046': 'DESANA (DESANA, DESANO, DESSANO, WIRA, UMUKOMASA)',
-        '0047': 'DIAHUI (JAHOI, JAHUI, DIARROI)',
-        '0048': 'ENAWE-NAWE (SALUMA)',
-        '0049': 'FULNI-O',
-        '0050': 'GALIBI (GALIBI DO OIAPOQUE, KARINHA)',
-        '0051': 'GALIBI MARWORNO (GALIBI DO UACA, ARUA)',
-        '0052': 'GAVIAO DE RONDONIA (DIGUT)',
-        '0053': 'GAVIAO KRIKATEJE',
-        '0054': 'GAVIAO PARKATEJE (PARKATEJE)',
-        '0055': 'GAVIAO PUKOBIE (PUKOBIE, PYKOPJE, GAVIAO DO MARANHAO)',
-        '0056': 'GUAJA (AWA, AVA)',
-        '0057': 'GUAJAJARA (TENETEHARA)',
-        '0058': 'GUARANI KAIOWA (PAI TAVYTERA)',
-        '0059': 'GUARANI M\'\'BYA',
-        '0060': 'GUARANI NANDEVA (AVAKATUETE, CHIRIPA,NHANDEWA, AVA GUARANI)',
-        '0061': 'GUATO',
-        '0062': 'HIMARIMA (HIMERIMA)',
-        '0063': 'INGARIKO (INGARICO, AKAWAIO, KAPON)',
-        '0064': 'IRANXE (IRANTXE)',
-        '0065': 'ISSE',
-        '0066': 'JABOTI (JABUTI, KIPIU, YABYTI)',
-        '0067': 'JAMAMADI (YAMAMADI, DJEOROMITXI)',
-        '0068': 'JARAWARA',
-        '0069': 'JIRIPANCO (JERIPANCO, GERIPANCO)',
-        '0070': 'JUMA (YUMA)',
-        '0071': 'JURUNA',
-        '0072': 'JURUTI (YURITI)',
-        '0073': 'KAAPOR (URUBU-KAAPOR, KA\'\'APOR, KAAPORTE)',
-        '0074': 'KADIWEU (CADUVEO, CADIUEU)',
-        '0075': 'KAIABI (CAIABI, KAYABI)',
-        '0076': 'KAIMBE (CAIMBE)',
-        '0077': 'KAINGANG (CAINGANGUE)',
-        '0078': 'KAIXANA (CAIXANA)',
-        '0079': 'KALABASSA (CALABASSA, CALABACAS)',
-        '0080': 'KALANCO',
-        '0081': 'KALAPALO (CALAPALO)',
-        '0082': 'KAMAYURA (CAMAIURA, KAMAIURA)',
-        '0083': 'KAMBA (CAMBA)',
-        '0084': 'KAMBEBA (CAMBEBA, OMAGUA)',
-        '0085': 'KAMBIWA (CAMBIUA)',
-        '0086': 'KAMBIWA PIPIPA (PIPIPA)',
-        '0087': 'KAMPE',
-        '0088': 'KANAMANTI (KANAMATI, CANAMANTI)',
-        '0089': 'KANAMARI (CANAMARI, KANAMARY, TUKUNA)',
-        '0090': 'KANELA APANIEKRA (CANELA)',
-        '0091': 'KANELA RANKOKAMEKRA (CANELA)',
-        '0092': 'KANINDE',
-        '0093': 'KANOE (CANOE)',
-        '0094': 'KANTARURE (CANTARURE)',
-        '0095': 'KAPINAWA (CAPINAUA)',
-        '0096': 'KARAJA (CARAJA)',
-        '0097': 'KARAJA/JAVAE (JAVAE)',
-        '0098': 'KARAJA/XAMBIOA (KARAJA DO NORTE)',
-        '0099': 'KARAPANA (CARAPANA, MUTEAMASA, UKOPINOPONA)',
-        '0100': 'KARAPOTO (CARAPOTO)',
-        '0101': 'KARIPUNA (CARIPUNA)',
-        '0102': 'KARIPUNA DO AMAPA (CARIPUNA)',
-        '0103': 'KARIRI (CARIRI)',
-        '0104': 'KARIRI-XOCO (CARIRI-CHOCO)',
-        '0105': 'KARITIANA (CARITIANA)',
-        '0106': 'KATAWIXI (KATAUIXI,KATAWIN, KATAWISI, CATAUICHI)',
-        '0107': 'KATUENA (CATUENA, KATWENA)',
-        '0108': 'KATUKINA (PEDA DJAPA)',
-        '0109': 'KATUKINA DO ACRE',
-        '0110': 'KAXARARI (CAXARARI)',
-        '0111': 'KAXINAWA (HUNI-KUIN, CASHINAUA, CAXINAUA)',
-        '0112': 'KAXIXO',
-        '0113': 'KAXUYANA (CAXUIANA)',
-        '0114': 'KAYAPO (CAIAPO)',
-        '0115': 'KAYAPO KARARAO (KARARAO)',
-        '0116': 'KAYAPO TXUKAHAMAE (TXUKAHAMAE)',
-        '0117': 'KAYAPO XICRIM (XIKRIN)',
-        '0118': 'KAYUISANA (CAIXANA, CAUIXANA, KAIXANA)',
-        '0119': 'KINIKINAWA (GUAN, KOINUKOEN, KINIKINAO)',
-        '0120': 'KIRIRI',
-        '0121': 'KOCAMA (COCAMA, KOKAMA)',
-        '0122': 'KOKUIREGATEJE',
-        '0123': 'KORUBO',
-        '0124': 'KRAHO (CRAO, KRAO)',
-        '0125': 'KREJE (KRENYE)',
-        '0126': 'KRENAK (BORUN, CRENAQUE)',
-        '0127': 'KRIKATI (KRINKATI)',
-        '0128': 'KUBEO (CUBEO, COBEWA, KUBEWA, PAMIWA, CUBEU)',
-        '0129': 'KUIKURO (KUIKURU, CUICURO)',
-        '0130': 'KUJUBIM (KUYUBI, CUJUBIM)',
-        '0131': 'KULINA PANO (CULINA)',
-        '0132': 'KULINA/MADIHA (CULINA, MADIJA, MADIHA)',
-        '0133': 'KURIPAKO (CURIPACO, CURRIPACO, CORIPACO, WAKUENAI)',
-        '0134': 'KURUAIA (CURUAIA)',
-        '0135': 'KWAZA (COAIA, KOAIA)',
-        '0136': 'MACHINERI (MANCHINERI, MANXINERI)',
-        '0137': 'MACURAP (MAKURAP)',
-        '0138': 'MAKU DOW (DOW)',
-        '0139': 'MAKU HUPDA (HUPDA)',
-        '0140': 'MAKU NADEB (NADEB)',
-        '0141': 'MAKU YUHUPDE (YUHUPDE)',
-        '0142': 'MAKUNA (MACUNA, YEBA-MASA)',
-        '0143': 'MAKUXI (MACUXI, MACHUSI, PEMON)',
-        '0144': 'MARIMAM (MARIMA)',
-        '0145': 'MARUBO',
-        '0146': 'MATIPU',
-        '0147': 'MATIS',
-        '0148': 'MATSE (MAYORUNA)',
-        '0149': 'MAXAKALI (MAXACALI)',
-        '0150': 'MAYA (MAYA)',
-        '0151': 'MAYTAPU',
-        '0152': 'MEHINAKO (MEINAKU, MEINACU)',
-        '0153': 'MEKEN (MEQUEM, MEKHEM, MICHENS)',
-        '0154': 'MENKY (MYKY, MUNKU, MENKI, MYNKY)',
-        '0155': 'MIRANHA (MIRANHA, MIRANA)',
-        '0156': 'MIRITI TAPUIA (MIRITI-TAPUYA, BUIA-TAPUYA)',
-        '0157': 'MUNDURUKU (MUNDURUCU)',
-        '0158': 'MURA',
-        '0159': 'NAHUKWA (NAFUQUA)',
-        '0160': 'NAMBIKWARA DO CAMPO (HALOTESU, KITHAULU, WAKALITESU, SAWENTES, MANDUKA)',
-        '0161': 'NAMBIKWARA DO NORTE (NEGAROTE ,MAMAINDE, LATUNDE, SABANE E MANDUKA, TAWANDE)',
-        '0162': 'NAMBIKWARA DO SUL (WASUSU ,HAHAINTESU, ALANTESU, WAIKISU, ALAKETESU, WASUSU, SARARE)',
-        '0163': 'NARAVUTE (NARUVOTO)',
-        '0164': 'NAWA (NAUA)',
-        '0165': 'NUKINI (NUQUINI, NUKUINI)',
-        '0166': 'OFAIE (OFAYE-XAVANTE)',
-        '0167': 'ORO WIN',
-        '0168': 'PAIAKU (JENIPAPO-KANINDE)',
-        '0169': 'PAKAA NOVA (WARI, PACAAS NOVOS)',
-        '0170': 'PALIKUR (AUKWAYENE, AUKUYENE, PALIKU\'\'ENE)',
-        '0171': 'PANARA (KRENHAKARORE , KRENAKORE, KRENA-KARORE)',
-        '0172': 'PANKARARE (PANCARARE)',
-        '0173': 'PANKARARU (PANCARARU)',
-        '0174': 'PANKARARU KALANKO (KALANKO)',
-        '0175': 'PANKARARU KARUAZU (KARUAZU)',
-        '0176': 'PANKARU (PANCARU)',
-        '0177': 'PARAKANA (PARACANA, APITEREWA, AWAETE)',
-        '0178': 'PARECI (PARESI, HALITI)',
-        '0179': 'PARINTINTIN',
-        '0180': 'PATAMONA (KAPON)',
-        '0181': 'PATAXO',
-        '0182': 'PATAXO HA-HA-HAE',
-        '0183': 'PAUMARI (PALMARI)',
-        '0184': 'PAUMELENHO',
-        '0185': 'PIRAHA (MURA PIRAHA)',
-        '0186': 'PIRATUAPUIA (PIRATAPUYA, PIRATAPUYO, PIRA-TAPUYA, WAIKANA)',
-        '0187': 'PITAGUARI',
-        '0188': 'POTIGUARA',
-        '0189': 'POYANAWA (POIANAUA)',
-        '0190': 'RIKBAKTSA (CANOEIROS, ERIGPAKTSA)',
-        '0191': 'SAKURABIAT(MEKENS, SAKIRABIAP, SAKIRABIAR)',
-        '0192': 'SATERE-MAWE (SATERE-MAUE)',
-        '0193': 'SHANENAWA (KATUKINA)',
-        '0194': 'SIRIANO (SIRIA-MASA)',
-        '0195': 'SURIANA',
-        '0196': 'SURUI DE RONDONIA (PAITER)',
-        '0197': 'SURUI DO PARA (AIKEWARA)',
-        '0198': 'SUYA (SUIA/KISEDJE)',
-        '0199': 'TAPAYUNA (BEICO-DE-PAU)',
-        '0200': 'TAPEBA',
-        '0201': 'TAPIRAPE (TAPI\'\'IRAPE)',
-        '0202': 'TAPUIA (TAPUIA-XAVANTE, TAPUIO)',
-        '0203': 'TARIANO (TARIANA, TALIASERI)',
-        '0204': 'TAUREPANG (TAULIPANG, PEMON, AREKUNA, PAGEYN)',
-        '0205': 'TEMBE',
-        '0206': 'TENHARIM',
-        '0207': 'TERENA',
-        '0208': 'TICUNA (TIKUNA, TUKUNA, MAGUTA)',
-        '0209': 'TINGUI BOTO',
-        '0210': 'TIRIYO EWARHUYANA (TIRIYO, TRIO, TARONA, YAWI, PIANOKOTO)',
-        '0211': 'TIRIYO KAH\'\'YANA (TIRIYO, TRIO, TARONA, YAWI, PIANOKOTO)',
-        '0212': 'TIRIYO TSIKUYANA (TIRIYO, TRIO, TARONA, YAWI, PIANOKOTO)',
-        '0213': 'TORA',
-        '0214': 'TREMEMBE',
-        '0215': 'TRUKA',
-        '0216': 'TRUMAI',
-        '0217': 'TSOHOM DJAPA (TSUNHUM-DJAPA)',
-        '0218': 'TUKANO (TUCANO, YE\'\'PA-MASA, DASEA)',
-        '0219': 'TUMBALALA',
-        '0220': 'TUNAYANA',
-        '0221': 'TUPARI',
-        '0222': 'TUPINAMBA',
-        '0223': 'TUPINIQUIM',
-        '0224': 'TURIWARA',
-        '0225': 'TUXA',
-        '0226': 'TUYUKA (TUIUCA, DOKAPUARA, UTAPINOMAKAPHONA)',
-        '0227': 'TXIKAO (TXICAO, IKPENG)',
-        '0228': 'UMUTINA (OMOTINA, BARBADOS)',
-        '0229': 'URU-EU-WAU-WAU (URUEU-UAU-UAU, URUPAIN, URUPA)',
-        '0230': 'WAI WAI HIXKARYANA (HIXKARYANA)',
-        '0231': 'WAI WAI KARAFAWYANA (KARAFAWYANA, KARA-PAWYANA)',
-        '0232': 'WAI WAI XEREU (XEREU)',
-        '0233': 'WAI WAI KATUENA (KATUENA)',
-        '0234': 'WAI WAI MAWAYANA (MAWAYANA)',
-        '0235': 'WAIAPI (WAYAMPI, OYAMPI, WAYAPY)',
-        '0236': 'WAIMIRI ATROARI (KINA)',
-        '0237': 'WANANO (UANANO, WANANA)',
-        '0238': 'WAPIXANA (UAPIXANA, VAPIDIANA, WAPISIANA, WAPISHANA)',
-        '0239': 'WAREKENA (UAREQUENA, WEREKENA)',
-        '0240': 'WASSU',
-        '0241': 'WAURA (UAURA, WAUJA)',
-        '0242': 'WAYANA (WAIANA, UAIANA)',
-        '0243': 'WITOTO (UITOTO, HUITOTO)',
-        '0244': 'XAKRIABA (XACRIABA)',
-        '0245': 'XAVANTE (A\'\'UWE, AKWE, AWEN, AKWEN)',
-        '0246': 'XERENTE (AKWE, AWEN, AKWEN)',
-        '0247': 'XETA',
-        '0248': 'XIPAIA (SHIPAYA, XIPAYA)',
-        '0249': 'XOKLENG (SHOKLENG, XOCLENG)',
-        '0250': 'XOKO (XOCO, CHOCO)',
-        '0251': 'XUKURU (XUCURU)',
-        '0252': 'XUKURU KARIRI (XUCURU-KARIRI)',
-        '0253': 'YAIPIYANA',
-        '0254': 'YAMINAWA (JAMINAWA, IAMINAWA)',
-        '0255': 'YANOMAMI NINAM (IANOMAMI, IANOAMA, XIRIANA)',
-        '0256': 'YANOMAMI SANUMA (IANOMAMI, IANOAMA, XIRIANA)',
-        '0257': 'YANOMAMI YANOMAM (IANOMAMI, IANOAMA, XIRIANA)',
-        '0258': 'YAWALAPITI (IAUALAPITI)',
-        '0259': 'YAWANAWA (IAUANAUA)',
-        '0260': 'YEKUANA (MAIONGON, YE\'\'KUANA, YEKWANA, MAYONGONG)',
-        '0261': 'YUDJA (JURUNA, YURUNA)',
-        '0262': 'ZO\'\'E (POTURU)',
-        '0263': 'ZORO (PAGEYN)',
-        '0264': 'ZURUAHA (SOROWAHA, SURUWAHA)',
-        
-        # Códigos Xxxx (extensões)
-        'X265': 'AHANENAWA',
-        'X266': 'AICABA',
-        'X267': 'AIKANÃ-KWASÁ',
-        'X268': 'AKUNTSU',
-        'X269': 'ALANTESU',
-        'X271': 'AMAWÁKA',
-        'X272': 'ANACÉ',
-        'X273': 'APURINÃ',
-        'X274': 'ARANÃ',
-        'X275': 'ARAPAÇO',
-        'X276': 'ARARA APOLIMA',
-        'X277': 'ARARA DO ARIPUANA',
-        'X278': 'ARIPUANÁ',
-        'X279': 'ASSURINI',
-        'X280': 'AWUARÁ',
-        'X281': 'BORBA',
-        'X282': 'CABIXI',
-        'X283': 'CAMARARÉ',
-        'X284': 'CAMASURI',
-        'X285': 'CARA PRETA',
-        'X286': 'CHARRUA',
-        'X287': 'CUJUBIM',
-        'X288': 'DAW',
-        'X289': 'GAVIÃO',
-        'X290': 'GUARANI',
-        'X291': 'HALANTESU',
-        'X292': 'HALOTESU',
-        'X293': 'HENGATÚ',
-        'X294': 'HIXKARYANA',
-        'X295': 'HUPDE',
-        'X296': 'HUPDES',
-        'X297': 'IAUANAUA',
-        'X298': 'IAUARETE AÇU',
-        'X299': 'IKPENG',
-        'X300': 'INAMBU',
-        'X301': 'INHABARANA',
-        'X302': 'JAVAE',
-        'X303': 'JENIPAPO',
-        'X304': 'JENIPAPO-KANINDE',
-        'X305': 'JIAHOI',
-        'X306': 'KAIOWA',
-        'X307': 'KAMPA',
-        'X308': 'KANELA',
-        'X309': 'KARAFAWYANA',
-        'X310': 'KARARAO',
-        'X311': 'KARUBO',
-        'X312': 'KASSUPÁ',
-        'X313': 'KATITHÃULU',
-        'X314': 'KATOKIN',
-        'X315': 'KATUKINA PANO',
-        'X316': 'KATUKINA PEDA DJAPA',
-        'X317': 'KATUKINA SHANENAUWA',
-        'X318': 'KAXAGO',
-        'X319': 'KAYABI',
-        'X320': 'KINÃ (WAIMIRI-ATROARI)',
-        'X321': 'KIRIRI-BARRA',
-        'X322': 'KITHÃULU',
-        'X323': 'KOIAIÁ',
-        'X324': 'KOIUPANKÁ',
-        'X325': 'KONTANAWA',
-        'X326': 'KRAHÔ KANELA',
-        'X327': 'KULINA',
-        'X328': 'LATUNDÊ',
-        'X329': 'MAKU',
-        'X330': 'MAKUNAMBÉ',
-        'X331': 'MAMAINDÊ',
-        'X332': 'MAMURI',
-        'X333': 'MANACAPURU',
-        'X334': 'MANAIRISSU',
-        'X335': 'MANCHINERI',
-        'X336': 'MANDUCA',
-        'X337': 'MARIBONDO',
-        'X338': 'MASSAKA',
-        'X339': 'MAWAYANA',
-        'X340': 'MAWÉ',
-        'X341': 'MAYORUNA',
-        'X342': 'MIQUELENO',
-        'X343': 'MOKURIÑ',
-        'X344': 'MON ORO WARAM',
-        'X345': 'MUTUM',
-        'X346': 'MYKY',
-        'X347': 'NADEB',
-        'X348': 'NAMBIKWARA',
-        'X349': 'NEGAROTÊ',
-        'X350': 'NHENGATU',
-        'X351': 'OFAIE XAVANTE',
-        'X352': 'ONÇA',
-        'X353': 'ORO AT',
-        'X354': 'ORO EO',
-        'X355': 'ORO JOWIN',
-        'X356': 'ORO MIYLIN',
-        'X357': 'ORO MON',
-        'X358': 'ORO NÁO',
-        'X359': 'ORO WAM',
-        'X360': 'ORO WARAM',
-        'X361': 'ORO WARAM XIJEIN',
-        'X362': 'PACA',
-        'X363': 'PANKARÁ',
-        'X364': 'PAPAGAIO',
-        'X365': 'PAYAYÁ',
-        'X366': 'PIPIPAN',
-        'X367': 'PIRATA',
-        'X368': 'PUROBORÁ',
-        'X369': 'SABANÊ',
-        'X370': 'SANUMA',
-        'X371': 'SAWENTESÚ',
-        'X372': 'SILCY-TAPUYA',
-        'X373': 'SIUCI',
-        'X374': 'TABAJARA',
-        'X375': 'TAKUARA',
-        'X376': 'TATU',
-        'X377': 'TAWANDÊ',
-        'X378': 'TEFÉ',
-        'X379': 'TIMBIRA',
-        'X380': 'TORÁ DO BAIXO GRANDE',
-        'X381': 'TSUNHUM-DJAPÁ',
-        'X382': 'TUBARÃO',
-        'X383': 'TUPAIU',
-        'X384': 'TUPI',
-        'X385': 'TUPINAMBÁ DE BELMONTE',
-        'X386': 'URUBU',
-        'X387': 'URUBU KAAPOR',
-        'X388': 'URUPÁ',
-        'X389': 'WAI WAI',
-        'X390': 'WAIKISU',
-        'X391': 'WAKALITESÚ',
-        'X392': 'WASSUSU',
-        'X393': 'XEREU',
-        'X394': 'XI EIN',
-        'X395': 'XICRIN',
-        'X396': 'XIPAYA',
-        'X397': 'XIRIANA',
-        'X398': 'XIRUAI',
-        'X399': 'YEPAMASSÃ',
-        'X400': 'TIRIYÓ',
-        'X401': 'YANOMAMI',
-        'X402': 'ARARA',
-        'X403': 'SAKIRIABAR',
-        'X404': 'TATZ',
-        'X405': 'SEM INFORMACAO',
-        '0304': 'PURI',
-        '0315': 'WARAO',
-        
-        # Vazio
-        '': ''
-    }
-    return ETNIA_MAP.get(etnia_codigo, etnia_codigo or 'Não informado')
-
 # Mapeamentos de chaves internas para rótulos
 CARACTERISTICAS_MAP = {
     '15anos': '≤ 15 anos',
@@ -664,10 +269,52 @@ DESFECHO_MAP = {
 }
 
 def get_db_connection():
-    conn = sqlite3.connect('banco.db')
-    conn.row_factory = sqlite3.Row
+    """Conexão do pool; dentro de uma requisição é sempre a mesma, devolvida no teardown."""
+    if has_app_context():
+        conn = g.get('db_conn')
+        if conn is None:
+            conn = g.db_conn = db_pool.adquirir(escopo_requisicao=True)
+        else:
+            db_pool.registrar_reuso()
+        return conn
+    return db_pool.adquirir()
+
+def usuario_logado(tabela=None):
+    """Principal da sessão (principal.py): uma consulta por requisição, compartilhada pelos decoradores e a rota."""
+    return principal_atual(get_db_connection, tabela)
+
+def get_db_leitura():
+    """Conexão dos relatórios pesados: a cópia somente leitura quando está em dia, senão a da requisição.
+
+    g.copia_gerada_em guarda o momento da cópia (None = banco principal), mostrado nas páginas.
+    """
+    conn = g.get('db_leitura')
+    if conn is None:
+        iniciar_atualizacao_periodica()
+        copia = abrir_copia()
+        if copia is None:
+            conn, g.copia_gerada_em = get_db_connection(), None
+        else:
+            conn, g.copia_gerada_em = copia
+        g.db_leitura = conn
     return conn
 
+def atualizacao_relatorio():
+    """Texto de atualização dos dados do relatório para os templates."""
+    gerada_em = g.get('copia_gerada_em')
+    if not gerada_em:
+        return 'Dados em tempo real'
+    return f"Dados atualizados em {datetime.strptime(gerada_em, '%Y-%m-%d %H:%M:%S').strftime('%d/%m/%Y %H:%M')}"
+
+@app.teardown_appcontext
+def devolver_db_connection(exc):
+    leitura = g.pop('db_leitura', None)
+    conn = g.pop('db_conn', None)
+    if leitura is not None and leitura is not conn:
+        leitura.close()
+    if conn is not None:
+        db_pool.devolver(conn)
+
 def draw_wrapped_text(canvas, text, x, y, max_width, font='Helvetica', font_size=9):
     if not text or not isinstance(text, str) or not text.strip():
         text = "Não informado"
@@ -734,11 +381,7 @@ def admin_required(f):
             flash('Por favor, faça login para acessar esta página.', 'error')
             return redirect(url_for('login'))
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('SELECT is_admin, role, is_super_admin FROM usuarios WHERE id = ?', (session['user_id'],))
-            user = cursor.fetchone()
-            conn.close()
+            user = usuario_logado(USUARIOS)
             if not user or not user['is_admin']:
                 flash('Acesso negado. Apenas administradores podem acessar esta página.', 'error')
                 return redirect(url_for('calculadora'))
@@ -760,32 +403,9 @@ def pnar_access_required(f):
             flash('Por favor, faça login para acessar esta página.', 'warning')
             return redirect(url_for('login'))
 
-        conn = get_db_connection()
-        c = conn.cursor()
-
-        # Verifica o perfil do usuário na tabela usuarios
-        c.execute("""
-            SELECT role, is_super_admin 
-            FROM usuarios 
-            WHERE id = ?
-        """, (session['user_id'],))
-        user = c.fetchone()
-
-        # Se for estadual ou super admin, libera acesso
-        if user and (user['role'] == 'estadual' or user['is_super_admin'] == 1):
-            conn.close()
-            return f(*args, **kwargs)
-
-        # Caso contrário, verifica se é apoio com pnar=1
-        c.execute("""
-            SELECT pnar 
-            FROM usuarios_apoio 
-            WHERE user_id = ?
-        """, (session['user_id'],))
-        apoio = c.fetchone()
-        conn.close()
-
-        if apoio and apoio['pnar'] == 1:
+        # Estadual, super admin ou apoio com pnar=1
+        user = usuario_logado()
+        if user and user.pnar:
             return f(*args, **kwargs)
 
         flash('Você não tem permissão para acessar o PNAR.', 'danger')
@@ -812,59 +432,69 @@ def login():
             conn = get_db_connection()
             cursor = conn.cursor()
 
-            # === 1. TENTA USUÁRIO NORMAL (TABELA usuarios) ===
-            cursor.execute('SELECT * FROM usuarios WHERE email = ? AND ativo = 1', (email,))
+            # === 1. UMA CONSULTA (e-mail é único nas duas tabelas) DECIDE ONDE VERIFICAR A SENHA ===
+            # usuarios tem prioridade sobre usuarios_apoio, como antes
+            cursor.execute('''
+                SELECT 0 AS prioridade, 'usuarios' AS tabela, id, senha, nome, municipio, approved,
+                       is_admin, is_super_admin, role, NULL AS acesso_saude_indigena
+                FROM usuarios WHERE email = ? AND ativo = 1
+                UNION ALL
+                SELECT 1, 'usuarios_apoio', id, senha, nome, municipio, approved,
+                       0, 0, 'apoio', acesso_saude_indigena
+                FROM usuarios_apoio WHERE email = ? AND ativo = 1 AND approved = 1
+                ORDER BY prioridade LIMIT 1
+            ''', (email, email))
             usuario = cursor.fetchone()
 
-            if usuario and bcrypt.checkpw(senha.encode('utf-8'), usuario['senha'].encode('utf-8')):
-                if usuario['approved'] == 0:
-                    flash('Sua conta ainda não foi aprovada pelo administrador.', 'error')
-                    conn.close()
-                    return redirect(url_for('login'))
+            if usuario and verificar_senha(senha, usuario['senha']):
+                if precisa_rehash(usuario['senha']):
+                    # Custo do bcrypt mudou (BCRYPT_ROUNDS): regrava o hash enquanto a senha é conhecida
+                    cursor.execute(f"UPDATE {usuario['tabela']} SET senha = ? WHERE id = ?",
+                                   (gerar_hash(senha), usuario['id']))
+                    conn.commit()
 
-                session['user_id'] = usuario['id']
-                session['is_admin'] = usuario['is_admin']
-                session['is_super_admin'] = usuario['is_super_admin']
-                session['role'] = usuario['role']
-                session['tipo_usuario'] = 'usuario'
-                session['user_nome'] = usuario['nome']
-                session['municipio'] = usuario['municipio']
+                # === 2. USUÁRIO NORMAL (TABELA usuarios) ===
+                if usuario['tabela'] == 'usuarios':
+                    if usuario['approved'] == 0:
+                        flash('Sua conta ainda não foi aprovada pelo administrador.', 'error')
+                        conn.close()
+                        return redirect(url_for('login'))
+
+                    session['user_id'] = usuario['id']
+                    session['is_admin'] = usuario['is_admin']
+                    session['is_super_admin'] = usuario['is_super_admin']
+                    session['role'] = usuario['role']
+                    session['tipo_usuario'] = 'usuario'
+                    session['user_nome'] = usuario['nome']
+                    session['municipio'] = usuario['municipio']
 
-                conn.close()
-                flash('Login realizado com sucesso!', 'success')
+                    conn.close()
+                    flash('Login realizado com sucesso!', 'success')
 
-                if usuario['is_admin'] or usuario['role'] in ['municipal', 'estadual']:
-                    return redirect(url_for('admin_painel'))
-                return redirect(url_for('calculadora'))
+                    if usuario['is_admin'] or usuario['role'] in ['municipal', 'estadual']:
+                        return redirect(url_for('admin_painel'))
+                    return redirect(url_for('calculadora'))
 
-            # === 2. TENTA USUÁRIO DE APOIO (TABELA usuarios_apoio) ===
-            cursor.execute('''
-                SELECT *, acesso_saude_indigena 
-                FROM usuarios_apoio 
-                WHERE email = ? AND ativo = 1 AND approved = 1
-            ''', (email,))
-            usuario_apoio = cursor.fetchone()
-
-            if usuario_apoio and bcrypt.checkpw(senha.encode('utf-8'), usuario_apoio['senha'].encode('utf-8')):
-                session['user_id'] = usuario_apoio['id']
+                # === 3. USUÁRIO DE APOIO (TABELA usuarios_apoio) ===
+                session['user_id'] = usuario['id']
                 session['is_admin'] = 0
                 session['is_super_admin'] = 0
                 session['role'] = 'apoio'
                 session['tipo_usuario'] = 'apoio'
-                session['user_nome'] = usuario_apoio['nome']
-                session['municipio'] = usuario_apoio['municipio']
-                session['acesso_saude_indigena'] = usuario_apoio['acesso_saude_indigena']  # ARMAZENA NA SESSÃO
+                session['user_nome'] = usuario['nome']
+                session['municipio'] = usuario['municipio']
+                session['acesso_saude_indigena'] = usuario['acesso_saude_indigena']  # ARMAZENA NA SESSÃO
 
                 conn.close()
                 flash('Login realizado com sucesso!', 'success')
 
                 # REDIRECIONA DE ACORDO COM acesso_saude_indigena
-                if usuario_apoio['acesso_saude_indigena'] == 1:
+                if usuario['acesso_saude_indigena'] == 1:
                     return redirect(url_for('saude_indigena'))
                 else:
                     return redirect(url_for('monitoramento'))
 
-            # === 3. FALHA NO LOGIN ===
+            # === 4. FALHA NO LOGIN ===
             flash('E-mail ou senha incorretos.', 'error')
             conn.close()
             return redirect(url_for('login'))
@@ -944,7 +574,7 @@ def register():
                     return redirect(url_for('register'))
                 else:
                     # Usuário inativo: permitir recadastro, atualizando os dados
-                    senha_hash = bcrypt.hashpw(senha.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+                    senha_hash = gerar_hash(senha)
                     cursor.execute('''
                         UPDATE usuarios
                         SET nome = ?, cpf = ?, profissao = ?, telefone = ?, email = ?, municipio = ?, cnes = ?, 
@@ -962,7 +592,7 @@ def register():
                     return redirect(url_for('login'))
             else:
                 # Novo usuário: inserir novo registro
-                senha_hash = bcrypt.hashpw(senha.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+                senha_hash = gerar_hash(senha)
                 cursor.execute('''
                     INSERT INTO usuarios (nome, cpf, profissao, telefone, email, municipio, cnes, senha, is_admin, approved, ativo, role)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, 0, 0, 'comum')
@@ -1012,8 +642,8 @@ def reset_password():
             cursor.execute('SELECT * FROM usuarios WHERE email = ?', (email,))
             user = cursor.fetchone()
 
-            if user and bcrypt.checkpw(old_password.encode('utf-8'), user['senha'].encode('utf-8')):
-                new_password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+            if user and verificar_senha(old_password, user['senha']):
+                new_password_hash = gerar_hash(new_password)
                 cursor.execute('UPDATE usuarios SET senha = ? WHERE email = ?', (new_password_hash, email))
                 conn.commit()
                 flash('Senha redefinida com sucesso! Faça login.', 'success')
@@ -1040,25 +670,17 @@ def calculadora():
         try:
             conn = get_db_connection()
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM calculos WHERE codigo_ficha = ? AND user_id = ?', (codigo_ficha, session['user_id']))
+            cursor.execute(f'SELECT * FROM {FICHAS} WHERE codigo_ficha = ? AND user_id = ?', (codigo_ficha, session['user_id']))
             ficha = cursor.fetchone()
             if ficha:
                 ficha = dict(ficha)
                 for field in ['caracteristicas', 'avaliacao_nutricional', 'comorbidades', 'historia_obstetrica', 'condicoes_gestacionais']:
-                    if ficha[field] and isinstance(ficha[field], str):
-                        try:
-                            ficha[field] = json.loads(ficha[field])
-                            if not isinstance(ficha[field], list):
-                                ficha[field] = [ficha[field]] if ficha[field] else []
-                        except json.JSONDecodeError:
-                            ficha[field] = [ficha[field]] if ficha[field] else []
-                    else:
-                        ficha[field] = []
+                    ficha[field] = list(decodificar_secao(ficha[field]))
                 # Mapear os novos campos
                 ficha['genero'] = GENERO_MAP.get(ficha.get('genero', 'nao_informado'), 'Não Informado')
                 ficha['sexualidade'] = SEXUALIDADE_MAP.get(ficha.get('sexualidade', 'nao_informado'), 'Não Informado')
                 ficha['raca_cor_etnia'] = RACA_COR_ETNIA_MAP.get(ficha.get('raca_cor_etnia', 'nao_informado'), 'Não Informado')
-                ficha['etnia_indigena'] = ETNIA_INDIGENA_MAP.get(ficha.get('etnia_indigena', ''), '')
+                ficha['etnia_indigena'] = ETNIAS.get(ficha.get('etnia_indigena') or '', '')
             conn.close()
         except sqlite3.OperationalError as e:
             flash(f'Erro no banco de dados: {str(e)}. Contate o administrador do banco de dados.', 'danger')
@@ -1071,7 +693,43 @@ def calculadora():
     return render_template('calculadora.html', ficha=ficha, 
                           generos=GENERO_MAP, 
                           sexualidades=SEXUALIDADE_MAP, 
-                          racas_cor_etnia=RACA_COR_ETNIA_MAP)
+                          racas_cor_etnia=RACA_COR_ETNIA_MAP,
+                          regras_pontuacao=pesos_publicos(),
+                          sincronizacao_lote=SINCRONIZACAO_LOTE_MAXIMO)
+
+@app.route('/pontuacao/pesos', methods=['GET'])
+def pesos_pontuacao():
+    """Pesos dos itens e faixas de classificação usados pela calculadora (pontuacao.py)."""
+    resposta = jsonify(pesos_publicos())
+    resposta.headers['Cache-Control'] = 'public, max-age=300'
+    return resposta
+
+# A lista completa não muda enquanto o processo vive: serializada uma vez
+ETNIAS_OPCOES_JSON = json.dumps({'success': True, 'etnias': [dict(opcao) for opcao in ETNIAS_OPCOES]},
+                                ensure_ascii=False)
+
+@app.route('/etnias', methods=['GET'])
+def listar_etnias():
+    """Catálogo de etnias indígenas (etnias.py): todas as opções do select ou, com ?q=, as que têm
+    palavras começando pelos termos digitados (até ?limite=, padrão 20)."""
+    consulta = request.args.get('q', '').strip()
+    if consulta:
+        limite = min(max(request.args.get('limite', 20, type=int), 1), 100)
+        resposta = jsonify({'success': True, 'etnias': [dict(opcao) for opcao in buscar_etnias(consulta, limite)]})
+    else:
+        resposta = Response(ETNIAS_OPCOES_JSON, mimetype='application/json')
+    resposta.headers['Cache-Control'] = 'public, max-age=3600'
+    return resposta
+
+def conferir_pontuacao(dados):
+    """Pontuação e classificação valem as calculadas aqui a partir dos itens (pontuacao.py); as enviadas
+    pela página só são conferidas (divergência = página desatualizada ou formulário alterado)."""
+    pontuacao, classificacao = pontuar_ficha(dados)
+    if (dados['pontuacao_total'], dados['classificacao_risco']) != (pontuacao, classificacao):
+        logging.warning(f"Pontuação enviada ({dados['pontuacao_total']}, {dados['classificacao_risco']}) difere "
+                        f"da calculada ({pontuacao}, {classificacao}); gravando a calculada")
+    dados['pontuacao_total'] = pontuacao
+    dados['classificacao_risco'] = classificacao
 
 @app.route('/salvar_calculadora', methods=['POST'])
 def salvar_calculadora():
@@ -1081,191 +739,62 @@ def salvar_calculadora():
     try:
         logging.debug(f"Dados recebidos do formulário: {request.form}")
 
-        # Capturar campos do formulário
-        nome_gestante = request.form.get('nome_gestante')
-        deficiencia = request.form.get('deficiencia')
-        data_nasc = request.form.get('data_nasc')
-        cpf = request.form.get('cpf', '000.000.000-00')
-        telefone = request.form.get('telefone')
-        municipio = request.form.get('municipio')
-        ubs = request.form.get('ubs')
-        acs = request.form.get('acs')
-        periodo_gestacional = request.form.get('periodo_gestacional')
-        data_envio = request.form.get('data_envio', datetime.now().strftime('%d/%m/%Y'))
-        pontuacao_total = request.form.get('pontuacao_total')
-        classificacao_risco = request.form.get('classificacao_risco', 'Risco Habitual')
-        imc = request.form.get('imc', None)
-        genero = request.form.get('genero')
-        sexualidade = request.form.get('sexualidade')
-        raca_cor_etnia = request.form.get('raca_cor_etnia')
-        etnia_indigena = request.form.get('etnia_indigena', '')  # ✅ NOVO CAMPO!
-
-        # Função para parsear campos JSON
-        def parse_json_field(field_name):
-            field_value = request.form.get(field_name, '[]')
-            try:
-                parsed = json.loads(field_value)
-                if not isinstance(parsed, list):
-                    parsed = [parsed] if parsed else []
-                return [str(item) for item in parsed if item and str(item).strip()]
-            except json.JSONDecodeError as e:
-                logging.warning(f"Erro ao desserializar {field_name}: {str(e)} - Valor bruto: {field_value}")
-                return []
-
-        # Parsear campos JSON
-        caracteristicas = parse_json_field('caracteristicas')
-        avaliacao_nutricional = parse_json_field('avaliacao_nutricional')
-        comorbidades = parse_json_field('comorbidades')
-        historia_obstetrica = parse_json_field('historia_obstetrica')
-        condicoes_gestacionais = parse_json_field('condicoes_gestacionais')
-
-        logging.debug(f"Características Individuais: {caracteristicas}")
-        logging.debug(f"Avaliação Nutricional: {avaliacao_nutricional}")
-        logging.debug(f"Comorbidades: {comorbidades}")
-        logging.debug(f"História Obstétrica: {historia_obstetrica}")
-        logging.debug(f"Condições Gestacionais: {condicoes_gestacionais}")
-        logging.debug(f"Gênero: {genero}")
-        logging.debug(f"Sexualidade: {sexualidade}")
-        logging.debug(f"Raça/Cor/Etnia: {raca_cor_etnia}")
-        logging.debug(f"Etnia Indígena: {etnia_indigena}")  # ✅ NOVO DEBUG!
-
         # Conectar ao banco
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT nome FROM usuarios WHERE id = ?', (session['user_id'],))
-        usuario = cursor.fetchone()
+        usuario = usuario_logado(USUARIOS)
         if not usuario:
             conn.close()
             return jsonify({'success': False, 'message': 'Usuário não encontrado.'}), 400
         profissional = usuario['nome']
 
-        # Validação dos campos obrigatórios
-        required_fields = {
-            'Nome da Gestante': nome_gestante,
-            'Data de Nascimento': data_nasc,
-            'Telefone': telefone,
-            'Município': municipio,
-            'UBS': ubs,
-            'ACS': acs,
-            'Período Gestacional': periodo_gestacional,
-            'Classificação de Risco': classificacao_risco,
-            'Gênero': genero,
-            'Raça/Cor/Etnia': raca_cor_etnia
-            # ✅ etnia_indigena NÃO é obrigatório (só aparece se indígena)
-        }
-        for field_name, field_value in required_fields.items():
-            if not field_value or field_value.strip() == '':
-                conn.close()
-                return jsonify({
-                    'success': False,
-                    'message': f'O campo "{field_name}" é obrigatório.'
-                }), 400
-
-        # Validação do CPF
-        if cpf and cpf != '000.000.000-00':
-            cpf = re.sub(r'[^\d]', '', cpf)
-            if not re.match(r'^\d{11}$', cpf):
-                conn.close()
-                return jsonify({
-                    'success': False,
-                    'message': 'CPF inválido. Deve conter exatamente 11 dígitos.'
-                }), 400
-        else:
-            cpf = '000.000.000-00'
-
-        # Validação da pontuação total
+        # Validação (campos obrigatórios, CPF, pontuação, datas), a mesma da importação de planilhas
         try:
-            pontuacao_total = int(pontuacao_total) if pontuacao_total and pontuacao_total.strip() else 0
-        except (ValueError, TypeError):
+            dados = validar_ficha(request.form)
+        except FichaInvalida as e:
             conn.close()
-            return jsonify({
-                'success': False,
-                'message': 'Pontuação total inválida.'
-            }), 400
-
-        # Validação das datas
-        if not re.match(r'^\d{2}/\d{2}/\d{4}$', data_nasc):
-            conn.close()
-            return jsonify({
-                'success': False,
-                'message': 'Data de nascimento inválida. Use o formato DD/MM/YYYY.'
-            }), 400
-
-        if not re.match(r'^\d{2}/\d{2}/\d{4}$', data_envio):
-            conn.close()
-            return jsonify({
-                'success': False,
-                'message': 'Data de envio inválida. Use o formato DD/MM/YYYY.'
-            }), 400
-
-        # Preparar dados JSON
-        caracteristicas_json = json.dumps(caracteristicas)
-        avaliacao_nutricional_json = json.dumps(avaliacao_nutricional)
-        comorbidades_json = json.dumps(comorbidades)
-        historia_obstetrica_json = json.dumps(historia_obstetrica)
-        condicoes_gestacionais_json = json.dumps(condicoes_gestacionais)
+            return jsonify({'success': False, 'message': str(e)}), 400
 
-        # Gerar código da ficha
-        codigo_ficha = str(uuid.uuid4())[:8].upper()
+        conferir_pontuacao(dados)
 
-        # ✅ INSERT COM ETNIA_INDIGENA
-        cursor.execute('''
-            INSERT INTO calculos (
-                user_id, codigo_ficha, nome_gestante, data_nasc, cpf, telefone, municipio, ubs, acs,
-                periodo_gestacional, data_envio, pontuacao_total, classificacao_risco, imc,
-                caracteristicas, avaliacao_nutricional, comorbidades, historia_obstetrica,
-                condicoes_gestacionais, profissional, genero, sexualidade, raca_cor_etnia, etnia_indigena
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            session['user_id'], codigo_ficha, nome_gestante, data_nasc, cpf, telefone, municipio, ubs, acs,
-            periodo_gestacional, data_envio, pontuacao_total, classificacao_risco,
-            float(imc) if imc and imc.strip() else None,
-            caracteristicas_json, avaliacao_nutricional_json, comorbidades_json,
-            historia_obstetrica_json, condicoes_gestacionais_json, profissional,
-            genero, sexualidade, raca_cor_etnia, etnia_indigena  # ✅ NOVO!
-        ))
+        logging.debug(f"Características Individuais: {dados['caracteristicas']}")
+        logging.debug(f"Avaliação Nutricional: {dados['avaliacao_nutricional']}")
+        logging.debug(f"Comorbidades: {dados['comorbidades']}")
+        logging.debug(f"História Obstétrica: {dados['historia_obstetrica']}")
+        logging.debug(f"Condições Gestacionais: {dados['condicoes_gestacionais']}")
+        logging.debug(f"Gênero: {dados['genero']}")
+        logging.debug(f"Sexualidade: {dados['sexualidade']}")
+        logging.debug(f"Raça/Cor/Etnia: {dados['raca_cor_etnia']}")
+        logging.debug(f"Etnia Indígena: {dados['etnia_indigena']}")
 
-        conn.commit()
-        cursor.execute('SELECT * FROM calculos WHERE codigo_ficha = ?', (codigo_ficha,))
-        ficha_salva = cursor.fetchone()
         conn.close()
+        # Chave gerada pela página: reenvio da mesma ficha devolve o código já gravado (sincronizacao.py)
+        chave = request.form.get('chave_sincronizacao')
+        duplicada = False
+        if chave:
+            if not chave_valida(chave):
+                return jsonify({'success': False, 'message': 'Chave de sincronização inválida.'}), 400
+            [(codigo_ficha, nova)] = fila_escrita.executar(
+                gravar_sincronizadas, session['user_id'], profissional, [(chave, dados)])
+            duplicada = not nova
+        else:
+            # Gerar código da ficha
+            codigo_ficha = str(uuid.uuid4())[:8].upper()
+            # Gravação (ficha, gestante, itens e agregados) no commit em grupo da fila de escrita
+            fila_escrita.executar(gravar_ficha, dados, session['user_id'], codigo_ficha, profissional)
+        invalidar_cpf(dados['cpf'])
 
-        if not ficha_salva:
-            return jsonify({
-                'success': False,
-                'message': 'Erro ao salvar a ficha no banco de dados.'
-            }), 500
-
-        logging.debug(f"Ficha salva com sucesso! Código: {codigo_ficha}, Etnia: {etnia_indigena}")
+        logging.debug(f"Ficha salva com sucesso! Código: {codigo_ficha}, Etnia: {dados['etnia_indigena']}")
 
         return jsonify({
             'success': True,
             'codigo_ficha': codigo_ficha,
+            'duplicada': duplicada,
             'message': f'Ficha salva com sucesso! Código: {codigo_ficha}',
             'dados': {
-                'nome_gestante': nome_gestante,
-                'deficiencia': deficiencia,
-                'data_nasc': data_nasc,
-                'cpf': cpf,
-                'telefone': telefone,
-                'municipio': municipio,
-                'ubs': ubs,
-                'acs': acs,
-                'periodo_gestacional': periodo_gestacional,
-                'data_envio': data_envio,
-                'pontuacao_total': pontuacao_total,
-                'classificacao_risco': classificacao_risco,
-                'imc': imc,
-                'caracteristicas': caracteristicas,
-                'avaliacao_nutricional': avaliacao_nutricional,
-                'comorbidades': comorbidades,
-                'historia_obstetrica': historia_obstetrica,
-                'condicoes_gestacionais': condicoes_gestacionais,
-                'profissional': profissional,
-                'genero': genero,
-                'sexualidade': sexualidade,
-                'raca_cor_etnia': raca_cor_etnia,
-                'etnia_indigena': etnia_indigena  # ✅ NOVO!
+                **{campo: valor for campo, valor in dados.items() if not campo.endswith('_iso')},
+                'imc': request.form.get('imc', None),
+                'profissional': profissional
             }
         })
 
@@ -1297,6 +826,73 @@ def salvar_calculadora():
             'message': f'Erro ao salvar os dados: {str(e)}'
         }), 500
 
+@app.route('/sincronizar_fichas', methods=['POST'])
+def sincronizar_fichas():
+    """Fichas preenchidas sem conexão, enviadas em lote pela fila da calculadora (sincronizacao.py).
+
+    Corpo: {"fichas": [{"chave": "<gerada pela página>", "campos": {campos do formulário}}, ...]}
+    As válidas são gravadas numa só transação; cada chave já recebida devolve o código da ficha
+    gravada da primeira vez (duplicada = true) sem criar outra. Um resultado por ficha, na mesma ordem.
+    """
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Usuário não autenticado.'}), 401
+
+    inicio = time.perf_counter()
+    data = request.get_json(silent=True) or {}
+    fichas = data.get('fichas')
+    if not isinstance(fichas, list) or not fichas:
+        return jsonify({'success': False, 'message': 'Envie a lista "fichas".'}), 400
+    if len(fichas) > SINCRONIZACAO_LOTE_MAXIMO:
+        return jsonify({'success': False, 'message': f'Máximo de {SINCRONIZACAO_LOTE_MAXIMO} fichas por lote.'}), 400
+    usuario = usuario_logado(USUARIOS)
+    if not usuario:
+        return jsonify({'success': False, 'message': 'Usuário não encontrado.'}), 400
+
+    # Validação ficha a ficha (a mesma de salvar_calculadora): as inválidas não barram as demais
+    resultados = [None] * len(fichas)
+    validas = []
+    for indice, item in enumerate(fichas):
+        item = item if isinstance(item, dict) else {}
+        chave, campos = item.get('chave'), item.get('campos')
+        if not chave_valida(chave):
+            erro = 'Chave de sincronização inválida.'
+        elif not isinstance(campos, dict):
+            erro = 'Campos da ficha ausentes.'
+        else:
+            try:
+                dados = validar_ficha(campos)
+            except FichaInvalida as e:
+                erro = str(e)
+            else:
+                conferir_pontuacao(dados)
+                validas.append((indice, chave, dados))
+                continue
+        resultados[indice] = {'success': False, 'chave': chave if chave_valida(chave) else None, 'message': erro}
+
+    if validas:
+        try:
+            gravadas = fila_escrita.executar(
+                gravar_sincronizadas, session['user_id'], usuario['nome'], [(chave, dados) for _, chave, dados in validas])
+        except sqlite3.Error as e:
+            logging.error(f"Erro no banco de dados ao sincronizar fichas: {str(e)}")
+            return jsonify({'success': False, 'message': f'Erro no banco de dados: {str(e)}'}), 500
+        invalidar_cpf(*(dados['cpf'] for _, _, dados in validas))
+        for (indice, chave, _), (codigo_ficha, nova) in zip(validas, gravadas):
+            resultados[indice] = {'success': True, 'chave': chave, 'codigo_ficha': codigo_ficha, 'duplicada': not nova}
+    for indice, resultado in enumerate(resultados):
+        resultado['indice'] = indice
+
+    novas = sum(1 for r in resultados if r['success'] and not r['duplicada'])
+    duplicadas = sum(1 for r in resultados if r['success'] and r['duplicada'])
+    rejeitadas = len(resultados) - novas - duplicadas
+    logging.info(f"Sincronização de {len(fichas)} ficha(s): {novas} gravada(s), {duplicadas} já recebida(s), "
+                 f"{rejeitadas} rejeitada(s) em {(time.perf_counter() - inicio) * 1000:.1f} ms")
+    return jsonify({
+        'success': rejeitadas < len(resultados),
+        'message': f'{novas} ficha(s) gravada(s), {duplicadas} já recebida(s), {rejeitadas} rejeitada(s).',
+        'resultados': resultados
+    })
+
 @app.route('/buscar_por_cpf', methods=['POST'])
 def buscar_por_cpf():
     if 'user_id' not in session:
@@ -1308,50 +904,24 @@ def buscar_por_cpf():
     if not cpf or len(cpf.replace('.', '').replace('-', '')) != 11:
         return jsonify({'success': False, 'message': 'CPF inválido.'}), 400
 
-    cpf_limpo = re.sub(r'\D', '', cpf)
+    cpf_limpo = normalizar_cpf(cpf)
+    if cpf_limpo is None:
+        return jsonify({'success': True, 'found': False, 'message': 'Nenhum registro encontrado.'})
 
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM calculos 
-            WHERE cpf = ?
-            ORDER BY data_envio DESC, id DESC
-            LIMIT 1
-        ''', (cpf_limpo,))
-        ficha = cursor.fetchone()
-
+        # Só os campos que a calculadora preenche, da ficha mais recente (consulta_cpf.py, com cache)
+        ficha = buscar_ultima_ficha(get_db_connection, cpf_limpo)
         if not ficha:
             return jsonify({'success': True, 'found': False, 'message': 'Nenhum registro encontrado.'})
 
-        colunas = [desc[0] for desc in cursor.description]
-        ficha_dict = dict(zip(colunas, ficha))
-
-        campos_json = ['caracteristicas', 'avaliacao_nutricional', 'comorbidades', 
-                       'historia_obstetrica', 'condicoes_gestacionais']
-        for campo in campos_json:
-            if ficha_dict[campo]:
-                try:
-                    ficha_dict[campo] = json.loads(ficha_dict[campo])
-                except:
-                    ficha_dict[campo] = []
-            else:
-                ficha_dict[campo] = []
-
         return jsonify({
             'success': True,
             'found': True,
-            'ficha': ficha_dict
+            'ficha': ficha
         })
 
     except Exception as e:
         logging.error(f"Erro ao buscar por CPF {cpf_limpo}: {str(e)}")
-        if conn:
-            try:
-                conn.close()
-            except:
-                pass
         return jsonify({'success': False, 'message': 'Erro interno do servidor.'}), 500
 
 @app.route('/historico', methods=['GET'])
@@ -1369,12 +939,16 @@ def buscar_historico():
 
     try:
         data = request.get_json()
-        page = data.get('page', 1)
-        per_page = data.get('per_page', 100)
+        per_page = min(max(int(data.get('per_page', 100)), 1), 500)
         sort_column = data.get('sort_column', 'id')
         sort_direction = data.get('sort_direction', 'DESC')
         nome_gestante = data.get('nome_gestante', '').strip()
         data_nasc = data.get('data_nasc', '').strip()
+        # Cursores opacos devolvidos pela página anterior (paginação por chave, sem OFFSET)
+        depois = data.get('cursor') or None
+        antes = data.get('cursor_anterior') or None
+        # O total só é contado quando pedido (por padrão, na primeira página)
+        incluir_total = data.get('incluir_total', not (depois or antes))
 
         valid_columns = [
             'id', 'codigo_ficha', 'nome_gestante', 'data_nasc', 'data_envio', 'periodo_gestacional',
@@ -1389,53 +963,54 @@ def buscar_historico():
             logging.warning(f"Direção de ordenação inválida: {sort_direction}. Usando 'DESC'.")
             sort_direction = 'DESC'
 
-        offset = (page - 1) * per_page
+        # Datas são ordenadas pelas colunas ISO (DD/MM/YYYY não ordena cronologicamente);
+        # colunas que aceitam NULL entram com COALESCE para a comparação do cursor funcionar
+        sort_expr = {
+            'data_envio': "COALESCE(data_envio_iso, '')",
+            'data_nasc': "COALESCE(data_nasc_iso, '')",
+            'profissional': "COALESCE(profissional, '')",
+        }.get(sort_column, sort_column)
 
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # Montar a query com filtros, incluindo fa = 0
-        query = '''
-            SELECT id, codigo_ficha, nome_gestante, data_nasc, data_envio, periodo_gestacional, 
-                   pontuacao_total, classificacao_risco, municipio, ubs, acs, profissional, pdf_compartilhado_municipal, pnar_ambulatorio
-            FROM calculos 
-            WHERE user_id = ? AND (desfecho IS NULL OR desfecho = '') AND fa = 0
-        '''
+        # Filtros, incluindo fa = 0 (atendida por idx_calculos_user_ativas)
+        origem = 'calculos WHERE user_id = ? AND desfecho IS NULL AND fa = 0'
         params = [session['user_id']]
 
+        # Nome pelo índice FTS5 (sem acento, prefixo de cada palavra)
         if nome_gestante:
-            query += ' AND nome_gestante LIKE ?'
-            params.append(f'%{nome_gestante}%')
+            filtro_sql, filtro_params = filtro_nome('calculos_nome_fts', 'id', nome_gestante)
+            origem += f' AND {filtro_sql}'
+            params.extend(filtro_params)
         if data_nasc:
-            query += ' AND data_nasc = ?'
+            origem += ' AND data_nasc = ?'
             params.append(data_nasc)
 
-        # Contar registros totais
-        count_query = "SELECT COUNT(*) FROM calculos WHERE user_id = ? AND (desfecho IS NULL OR desfecho = '') AND fa = 0"
-        count_params = [session['user_id']]
-        if nome_gestante:
-            count_query += ' AND nome_gestante LIKE ?'
-            count_params.append(f'%{nome_gestante}%')
-        if data_nasc:
-            count_query += ' AND data_nasc = ?'
-            count_params.append(data_nasc)
+        total_records = None
+        if incluir_total:
+            cursor.execute(f'SELECT COUNT(*) FROM {origem}', params)
+            total_records = cursor.fetchone()[0]
 
-        cursor.execute(count_query, count_params)
-        total_records = cursor.fetchone()[0]
-
-        query += f' ORDER BY {sort_column} {sort_direction} LIMIT ? OFFSET ?'
-        params.extend([per_page, offset])
-        logging.debug(f"Executando query: {query} com params={params}")
-        cursor.execute(query, params)
-        fichas = cursor.fetchall()
-        fichas_dict = [dict(ficha) for ficha in fichas]
-        conn.close()
+        try:
+            pagina = paginar(
+                cursor,
+                '''id, codigo_ficha, nome_gestante, data_nasc, data_envio, periodo_gestacional,
+                   pontuacao_total, classificacao_risco, municipio, ubs, acs, profissional, pdf_compartilhado_municipal, pnar_ambulatorio''',
+                origem, params, sort_expr, sort_direction, per_page, depois=depois, antes=antes
+            )
+        except CursorInvalido as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
 
-        return jsonify({
+        resposta = {
             'success': True,
-            'fichas': fichas_dict,
-            'total_records': total_records
-        })
+            'fichas': pagina.itens,
+            'proximo_cursor': pagina.proximo,
+            'cursor_anterior': pagina.anterior,
+        }
+        if total_records is not None:
+            resposta['total_records'] = total_records
+        return jsonify(resposta)
 
     except sqlite3.Error as e:
         logging.error(f"Erro no banco de dados: {str(e)}")
@@ -1469,7 +1044,7 @@ def marcar_fora_area():
 
         # Verificar se o registro existe para o usuário logado
         cursor.execute('''
-            SELECT id, cpf, municipio FROM calculos 
+            SELECT id, cpf, municipio, gestante_id FROM calculos 
             WHERE user_id = ? AND codigo_ficha = ? AND nome_gestante = ? AND data_nasc = ? AND fa = 0
         ''', (session['user_id'], codigo_ficha, nome_gestante, data_nasc))
         registro = cursor.fetchone()
@@ -1478,36 +1053,27 @@ def marcar_fora_area():
             conn.close()
             return jsonify({'success': False, 'message': 'Registro não encontrado ou já marcado como fora de área.'}), 404
 
-        # Identificar todas as fichas da mesma gestante
-        cpf = registro['cpf']
+        # Todas as fichas da mesma gestante no município, pelo gestante_id
         municipio = registro['municipio']
-        if cpf and cpf != '000.000.000-00':
-            # Buscar fichas pelo CPF e município
-            cursor.execute('''
-                SELECT id, codigo_ficha FROM calculos 
-                WHERE cpf = ? AND municipio = ? AND fa = 0
-            ''', (cpf, municipio))
-        else:
-            # Buscar fichas por nome_gestante, data_nasc e município
-            cursor.execute('''
-                SELECT id, codigo_ficha FROM calculos 
-                WHERE nome_gestante = ? AND data_nasc = ? AND municipio = ? AND fa = 0
-            ''', (nome_gestante, data_nasc, municipio))
-        
-        fichas_relacionadas = cursor.fetchall()
-        if not fichas_relacionadas:
+        gestante_id = registro['gestante_id'] or vincular_ficha(
+            cursor, registro['id'], registro['cpf'], nome_gestante, data_nasc)
+        cursor.execute('''
+            SELECT codigo_ficha FROM calculos 
+            WHERE gestante_id = ? AND municipio = ? AND fa = 0
+        ''', (gestante_id, municipio))
+        updated_fichas = [ficha['codigo_ficha'] for ficha in cursor.fetchall()]
+        if not updated_fichas:
             conn.close()
             return jsonify({'success': False, 'message': 'Nenhuma ficha relacionada encontrada.'}), 404
 
         # Marcar todas as fichas relacionadas como fora de área
-        updated_fichas = []
-        for ficha in fichas_relacionadas:
+        with manter_agregados(cursor, [gestante_id]):
             cursor.execute('''
                 UPDATE calculos 
                 SET fa = 1 
-                WHERE id = ?
-            ''', (ficha['id'],))
-            updated_fichas.append(ficha['codigo_ficha'])
+                WHERE gestante_id = ? AND municipio = ? AND fa = 0
+            ''', (gestante_id, municipio))
+            atualizar_gestantes(cursor, [gestante_id])
 
         conn.commit()
         conn.close()
@@ -1568,12 +1134,19 @@ def registrar_desfecho_lote():
 
         conn = get_db_connection()
         cursor = conn.cursor()
-        # Buscar fichas com desfecho NULL
+        # Gestantes com esse nome e data de nascimento; as fichas são atualizadas por gestante_id
         cursor.execute('''
-            SELECT codigo_ficha, nome_gestante, data_nasc, municipio
-            FROM calculos 
+            SELECT DISTINCT gestante_id FROM calculos
             WHERE nome_gestante = ? AND data_nasc = ? AND desfecho IS NULL
         ''', (nome_gestante, data_nasc))
+        gestante_ids = [row['gestante_id'] for row in cursor.fetchall() if row['gestante_id'] is not None]
+        placeholders = ','.join(['?'] * len(gestante_ids)) or 'NULL'
+        # Buscar fichas com desfecho NULL
+        cursor.execute(f'''
+            SELECT codigo_ficha, nome_gestante, data_nasc, municipio
+            FROM calculos 
+            WHERE gestante_id IN ({placeholders}) AND desfecho IS NULL
+        ''', gestante_ids)
         fichas = cursor.fetchall()
         logging.debug(f"Fichas encontradas: {len(fichas)} para nome={nome_gestante}, data_nasc={data_nasc}")
         for ficha in fichas:
@@ -1587,13 +1160,14 @@ def registrar_desfecho_lote():
             }), 404
 
         data_desfecho = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-        for ficha in fichas:
-            cursor.execute('''
+        with manter_agregados(cursor, gestante_ids):
+            cursor.execute(f'''
                 UPDATE calculos 
                 SET desfecho = ?, data_desfecho = ? 
-                WHERE codigo_ficha = ?
-            ''', (desfecho, data_desfecho, ficha['codigo_ficha']))
-            logging.debug(f"Atualizado desfecho para ficha {ficha['codigo_ficha']}: desfecho={desfecho}, data_desfecho={data_desfecho}")
+                WHERE gestante_id IN ({placeholders}) AND desfecho IS NULL
+            ''', [desfecho, data_desfecho] + gestante_ids)
+            atualizar_gestantes(cursor, gestante_ids)
+        logging.debug(f"Desfecho {desfecho} registrado para {len(fichas)} ficha(s) das gestantes {gestante_ids}")
 
         conn.commit()
         conn.close()
@@ -1628,6 +1202,90 @@ def registrar_desfecho_lote():
             'message': f'Erro ao registrar desfecho: {str(e)}'
         }), 500
 
+@app.route('/registrar_operacoes_lote', methods=['POST'])
+def registrar_operacoes_lote():
+    """Desfechos e marcações de fora de área de várias gestantes numa só transação.
+
+    Corpo: {"operacoes": [{"tipo": "desfecho", "nome_gestante", "data_nasc", "desfecho"},
+                          {"tipo": "fora_area", "codigo_ficha", "nome_gestante", "data_nasc"}, ...]}
+    Responde com um resultado por operação (na mesma ordem) e a vazão do lote.
+    """
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': 'Usuário não autenticado.'}), 401
+
+    inicio = time.perf_counter()
+    data = request.get_json(silent=True) or {}
+    operacoes = data.get('operacoes')
+    if not isinstance(operacoes, list) or not operacoes:
+        return jsonify({'success': False, 'message': 'Envie a lista "operacoes".'}), 400
+    if len(operacoes) > LOTE_MAXIMO:
+        return jsonify({'success': False, 'message': f'Máximo de {LOTE_MAXIMO} operações por lote.'}), 400
+
+    # Validação item a item: operações inválidas viram erro no resultado sem barrar as demais
+    resultados = [None] * len(operacoes)
+    validas = []
+    for indice, op in enumerate(operacoes):
+        op = op if isinstance(op, dict) else {}
+        tipo = op.get('tipo')
+        campos = {k: str(op.get(k) or '').strip() for k in ('nome_gestante', 'data_nasc', 'desfecho', 'codigo_ficha')}
+        if tipo not in OPERACOES_TIPOS:
+            erro = 'Tipo de operação inválido. Use "desfecho" ou "fora_area".'
+        elif not campos['nome_gestante'] or not campos['data_nasc']:
+            erro = 'Nome da gestante e data de nascimento são obrigatórios.'
+        elif tipo == 'desfecho' and not campos['desfecho']:
+            erro = 'Desfecho é obrigatório.'
+        elif tipo == 'desfecho' and DESFECHO_MAP.get(campos['desfecho'], 'Não informado') == 'Não informado':
+            # DESFECHO_MAP também rotula '' e None ("Não informado"), que não encerram ficha
+            erro = f"Desfecho inválido: {campos['desfecho']}."
+        elif tipo == 'fora_area' and not campos['codigo_ficha']:
+            erro = 'Código da ficha é obrigatório para marcar fora de área.'
+        else:
+            validas.append((indice, dict(campos, tipo=tipo)))
+            continue
+        resultados[indice] = {'success': False, 'message': erro}
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        data_desfecho = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+        aplicados = aplicar_operacoes(cursor, session['user_id'], [op for _, op in validas], data_desfecho)
+        conn.commit()
+    except sqlite3.Error as e:
+        if conn:
+            conn.rollback()
+        logging.error(f"Erro no banco de dados ao aplicar lote: {str(e)}")
+        return jsonify({'success': False, 'message': f'Erro no banco de dados: {str(e)}'}), 500
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        logging.error(f"Erro ao aplicar lote de operações: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': f'Erro ao aplicar as operações: {str(e)}'}), 500
+
+    for (indice, _), resultado in zip(validas, aplicados):
+        resultados[indice] = resultado
+    for indice, resultado in enumerate(resultados):
+        resultado['indice'] = indice
+
+    duracao = time.perf_counter() - inicio
+    aplicadas = sum(1 for r in resultados if r['success'])
+    fichas = sum(r.get('fichas_atualizadas', 0) for r in resultados)
+    logging.info(f"Lote de {len(operacoes)} operação(ões): {aplicadas} aplicada(s), {fichas} ficha(s) em {duracao * 1000:.1f} ms")
+
+    return jsonify({
+        'success': aplicadas > 0,
+        'message': f'{aplicadas} de {len(operacoes)} operação(ões) aplicada(s), {fichas} ficha(s) atualizada(s).',
+        'resultados': resultados,
+        'vazao': {
+            'operacoes': len(operacoes),
+            'aplicadas': aplicadas,
+            'falhas': len(operacoes) - aplicadas,
+            'fichas_atualizadas': fichas,
+            'duracao_ms': round(duracao * 1000, 1),
+            'operacoes_por_segundo': round(len(operacoes) / duracao, 1) if duracao > 0 else None
+        }
+    })
+
 @app.route('/obter_ficha_completa', methods=['POST'])
 def obter_ficha_completa():
     if 'user_id' not in session:
@@ -1642,8 +1300,8 @@ def obter_ficha_completa():
 
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM calculos 
+        cursor.execute(f'''
+            SELECT * FROM {FICHAS}
             WHERE codigo_ficha = ? AND user_id = ?
         ''', (codigo_ficha, session['user_id']))
         ficha = cursor.fetchone()
@@ -1660,27 +1318,8 @@ def obter_ficha_completa():
 
         try:
             for field in ['caracteristicas', 'avaliacao_nutricional', 'comorbidades', 'historia_obstetrica', 'condicoes_gestacionais']:
-                raw_value = ficha_dict[field]
-                if raw_value is None or raw_value == '':
-                    ficha_dict[field] = []
-                else:
-                    try:
-                        parsed_value = json.loads(raw_value) if isinstance(raw_value, str) else raw_value
-                        if not isinstance(parsed_value, list):
-                            parsed_value = [parsed_value] if parsed_value else []
-                        if parsed_value and isinstance(parsed_value, list) and len(parsed_value) == 1:
-                            try:
-                                nested_items = json.loads(parsed_value[0]) if isinstance(parsed_value[0], str) else parsed_value[0]
-                                if isinstance(nested_items, list):
-                                    parsed_value = nested_items
-                                elif nested_items:
-                                    parsed_value = [nested_items]
-                            except json.JSONDecodeError:
-                                pass
-                        ficha_dict[field] = parsed_value
-                    except json.JSONDecodeError as e:
-                        logging.warning(f"Erro ao desserializar {field}: {str(e)} - Valor bruto: {raw_value}")
-                        ficha_dict[field] = [raw_value] if raw_value else []
+                # Aceita o JSON duplamente serializado das fichas antigas
+                ficha_dict[field] = list(decodificar_secao(ficha_dict[field]))
             # Mapear os novos campos
             ficha_dict['genero'] = [ficha_dict.get('genero', 'nao_informado')]
             ficha_dict['sexualidade'] = [ficha_dict.get('sexualidade', 'nao_informado')]
@@ -1811,17 +1450,18 @@ def compartilhar_tudo():
 
         nome_admin = admin['nome']
 
-        # 2️⃣ Marcar TODAS fichas ATIVAS deste município como COMPARTILHADAS
-        cursor.execute('''
-            UPDATE calculos 
-            SET pdf_compartilhado_municipal = 1 
-            WHERE user_id = ? AND municipio = ? 
-            AND desfecho IS NULL AND fora_area = 0
-        ''', (session['user_id'], municipio_selecionado))
-        
-        rows_affected = cursor.rowcount
-        conn.commit()
+        # 2️⃣ Marcar TODAS fichas ATIVAS deste município como COMPARTILHADAS (fila de escrita)
+        def compartilhar(cursor_escrita, user_id):
+            cursor_escrita.execute('''
+                UPDATE calculos 
+                SET pdf_compartilhado_municipal = 1 
+                WHERE user_id = ? AND municipio = ? 
+                AND desfecho IS NULL AND fora_area = 0
+            ''', (user_id, municipio_selecionado))
+            return cursor_escrita.rowcount
+
         conn.close()
+        rows_affected = fila_escrita.executar(compartilhar, session['user_id'])
 
         if rows_affected == 0:
             return jsonify({
@@ -1953,38 +1593,28 @@ def verificar_compartilhamento(codigo_ficha):
 @app.route('/pnar')
 @pnar_access_required
 def pnar():
-    conn = get_db_connection()
-    c = conn.cursor()
-    user_id = session.get('user_id')
+    user = usuario_logado()
     user_role = session.get('role')
 
     # === PERSONALIZAÇÃO DO TÍTULO ===
     titulo_usuario = "Usuário PNAR"  # fallback
 
     if user_role == 'estadual':
-        c.execute("SELECT is_super_admin, nome FROM usuarios WHERE id = ?", (user_id,))
-        user = c.fetchone()
-        if user and user[0] == 1:  # is_super_admin
-            titulo_usuario = user[1]  # nome do estadual
+        if user and user.is_super_admin == 1:
+            titulo_usuario = user.nome  # nome do estadual
         else:
-            conn.close()
             flash('Você não tem permissão para acessar o PNAR.', 'danger')
             return redirect(url_for('admin_painel'))
     elif user_role == 'apoio':
-        c.execute("SELECT pnar, servico FROM usuarios_apoio WHERE user_id = ?", (user_id,))
-        apoio = c.fetchone()
-        if apoio and apoio[0] == 1:  # pnar = 1
-            titulo_usuario = apoio[1] or "Serviço de Apoio"  # nome do serviço
+        if user and user.apoio and user.pnar:
+            titulo_usuario = user.servico or "Serviço de Apoio"  # nome do serviço
         else:
-            conn.close()
             flash('Você não tem permissão para acessar o PNAR.', 'danger')
             return redirect(url_for('admin_painel'))
     else:
-        conn.close()
         flash('Você não tem permissão para acessar o PNAR.', 'danger')
         return redirect(url_for('admin_painel'))
 
-    conn.close()
     return render_template('pnar.html', titulo_usuario=titulo_usuario)
 
 @app.route('/registrar_pnar', methods=['POST'])
@@ -2009,25 +1639,28 @@ def registrar_pnar():
 
         # Verifica se a ficha existe e pertence ao usuário
         cursor.execute('''
-            SELECT 1 FROM calculos
+            SELECT gestante_id FROM calculos
             WHERE codigo_ficha = ? AND nome_gestante = ? AND data_nasc = ? AND user_id = ?
         ''', (codigo_ficha, nome_gestante, data_nasc, session['user_id']))
+        ficha = cursor.fetchone()
 
-        if not cursor.fetchone():
+        if not ficha:
             conn.close()
             return jsonify({'success': False, 'message': 'Ficha não encontrada ou não pertence a você.'}), 404
 
-        # Atualiza
-        cursor.execute('''
-            UPDATE calculos
-            SET pnar_sinalizado = 1,
-                pnar_ambulatorio = ?,
-                pnar_data_registro = datetime('now','localtime')
-            WHERE codigo_ficha = ?
-        ''', (servico, codigo_ficha))
+        # Atualiza (fila de escrita)
+        def sinalizar(cursor_escrita, gestante_id):
+            with manter_agregados(cursor_escrita, [gestante_id]):
+                cursor_escrita.execute('''
+                    UPDATE calculos
+                    SET pnar_sinalizado = 1,
+                        pnar_ambulatorio = ?,
+                        pnar_data_registro = datetime('now','localtime')
+                    WHERE codigo_ficha = ?
+                ''', (servico, codigo_ficha))
 
-        conn.commit()
         conn.close()
+        fila_escrita.executar(sinalizar, ficha['gestante_id'])
 
         return jsonify({
             'success': True,
@@ -2046,10 +1679,13 @@ def buscar_pnar():
 
     try:
         data = request.get_json() or {}
-        page = max(1, int(data.get('page', 1)))
-        per_page = min(100, int(data.get('per_page', 100)))
+        per_page = min(100, max(1, int(data.get('per_page', 100))))
         sort_column = data.get('sort_column', 'nome_gestante')
         sort_direction = data.get('sort_direction', 'ASC').upper()
+        # Cursores opacos devolvidos pela página anterior (paginação por chave, sem OFFSET)
+        depois = data.get('cursor') or None
+        antes = data.get('cursor_anterior') or None
+        incluir_total = data.get('incluir_total', not (depois or antes))
 
         # Validação básica
         valid_columns = ['nome_gestante', 'periodo_gestacional', 'municipio']
@@ -2058,64 +1694,53 @@ def buscar_pnar():
         if sort_direction not in ['ASC', 'DESC']:
             sort_direction = 'ASC'
 
-        user_id = session['user_id']
         user_role = session.get('role')
 
         conn = get_db_connection()
         c = conn.cursor()
 
-        # Query base
-        query = """
-            SELECT codigo_ficha, nome_gestante, periodo_gestacional, municipio
-            FROM calculos
+        # Filtros base
+        origem = """
+            calculos
             WHERE classificacao_risco = 'Alto Risco'
               AND desfecho IS NULL
               AND pnar_sinalizado = 1
         """
         params = []
-        count_params = []
 
         # Filtro para usuário de apoio
         if user_role == 'apoio':
-            c.execute("SELECT servico FROM usuarios_apoio WHERE user_id = ?", (user_id,))
-            apoio = c.fetchone()
-            if not apoio or not apoio[0]:
+            apoio = usuario_logado()
+            if not apoio or not apoio.apoio or not apoio.servico:
                 conn.close()
                 return jsonify({"success": False, "message": "Acesso negado."}), 403
-            servico = apoio[0]
-            query += " AND pnar_ambulatorio = ?"
+            servico = apoio.servico
+            origem += " AND pnar_ambulatorio = ?"
             params.append(servico)
-            count_params.append(servico)
-
-        # Contar total
-        c.execute(f"SELECT COUNT(*) FROM ({query})", count_params)
-        total_records = c.fetchone()[0]
-
-        # Paginação
-        offset = (page - 1) * per_page
-        c.execute(f"""
-            {query}
-            ORDER BY {sort_column} {sort_direction}
-            LIMIT ? OFFSET ?
-        """, params + [per_page, offset])
-
-        fichas = [
-            {
-                'codigo_ficha': row[0],
-                'nome_gestante': row[1],
-                'periodo_gestacional': row[2],
-                'municipio': row[3]
-            }
-            for row in c.fetchall()
-        ]
 
-        conn.close()
+        # Contar total (só quando pedido; por padrão, na primeira página)
+        total_records = None
+        if incluir_total:
+            c.execute(f"SELECT COUNT(*) FROM {origem}", params)
+            total_records = c.fetchone()[0]
 
-        return jsonify({
+        try:
+            pagina = paginar(
+                c, 'codigo_ficha, nome_gestante, periodo_gestacional, municipio',
+                origem, params, sort_column, sort_direction, per_page, depois=depois, antes=antes
+            )
+        except CursorInvalido as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+
+        resposta = {
             "success": True,
-            "fichas": fichas,
-            "total_records": total_records
-        })
+            "fichas": pagina.itens,
+            "proximo_cursor": pagina.proximo,
+            "cursor_anterior": pagina.anterior
+        }
+        if total_records is not None:
+            resposta["total_records"] = total_records
+        return jsonify(resposta)
 
     except Exception as e:
         logging.error(f"Erro em /buscar_pnar: {str(e)}", exc_info=True)
@@ -2158,8 +1783,7 @@ def admin_painel():
         cursor = conn.cursor()
 
         # Obter informações do usuário logado
-        cursor.execute('SELECT municipio, role, is_super_admin FROM usuarios WHERE id = ?', (session['user_id'],))
-        user = cursor.fetchone()
+        user = usuario_logado(USUARIOS)
         if not user:
             conn.close()
             flash('Usuário não encontrado.', 'error')
@@ -2259,6 +1883,7 @@ def admin_aprovar_usuario():
             ''', (session['user_id'], usuario_id, 'Aprovação', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 
                   f'Usuário ID {usuario_id} aprovado'))
             conn.commit()
+            invalidar_principal(USUARIOS, usuario_id)
             flash('Usuário aprovado com sucesso.', 'success')
         conn.close()
     except sqlite3.OperationalError as e:
@@ -2296,6 +1921,7 @@ def admin_rejeitar_usuario():
             ''', (session['user_id'], usuario_id, 'Rejeição', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 
                   f'Usuário ID {usuario_id} rejeitado e removido'))
             conn.commit()
+            invalidar_principal(USUARIOS, usuario_id)
             flash('Usuário rejeitado e removido.', 'success')
         conn.close()
     except sqlite3.OperationalError as e:
@@ -2333,6 +1959,7 @@ def admin_ativar_usuario():
             ''', (session['user_id'], usuario_id, 'Ativação', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 
                   f'Usuário ID {usuario_id} ({user["email"]}) ativado'))
             conn.commit()
+            invalidar_principal(USUARIOS, usuario_id)
 
             # Retornar dados do usuário para atualizar o front-end
             return jsonify({
@@ -2381,6 +2008,7 @@ def admin_desativar_usuario():
             ''', (session['user_id'], usuario_id, 'Desativação', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 
                   f'Usuário ID {usuario_id} ({user["email"]}) desativado'))
             conn.commit()
+            invalidar_principal(USUARIOS, usuario_id)
 
             return jsonify({
                 'success': True,
@@ -2405,11 +2033,7 @@ def super_admin_required(f):
             flash('Por favor, faça login para acessar esta página.', 'error')
             return redirect(url_for('login'))
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('SELECT is_admin, role, is_super_admin FROM usuarios WHERE id = ?', (session['user_id'],))
-            user = cursor.fetchone()
-            conn.close()
+            user = usuario_logado(USUARIOS)
             if not user or user['role'] != 'estadual' or not user['is_super_admin']:
                 flash(f'Acesso negado: apenas administradores estaduais podem acessar esta página.', 'error')
                 return redirect(url_for('admin_painel'))
@@ -2426,15 +2050,8 @@ def apoio_required(f):
             flash('Por favor, faça login para acessar esta página.', 'error')
             return redirect(url_for('login'))
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            if session.get('tipo_usuario') == 'apoio':
-                cursor.execute('SELECT id FROM usuarios_apoio WHERE id = ?', (session['user_id'],))
-            else:
-                cursor.execute('SELECT role FROM usuarios WHERE id = ?', (session['user_id'],))
-            user = cursor.fetchone()
-            conn.close()
-            if not user or (session.get('tipo_usuario') != 'apoio' and user['role'] != 'estadual'):
+            user = usuario_logado()
+            if not user or (not user.apoio and user['role'] != 'estadual'):
                 flash('Acesso negado. Apenas usuários de apoio ou administradores estaduais podem acessar esta página.', 'error')
                 return redirect(url_for('login'))
             return f(*args, **kwargs)
@@ -2448,6 +2065,150 @@ def get_usuario_municipios(cursor, usuario_id):
     cursor.execute('SELECT municipio FROM usuario_municipios WHERE usuario_id = ?', (usuario_id,))
     return [row['municipio'] for row in cursor.fetchall()]
 
+# Estatísticas do pool de conexões e da fila de escrita (por worker)
+@app.route('/admin/db_stats', methods=['GET'])
+@super_admin_required
+def admin_db_stats():
+    return jsonify({'success': True, 'pool': db_pool.estatisticas(), 'fila_escrita': fila_escrita.estatisticas(),
+                    'secoes_json': estatisticas_decodificacao(), 'ultima_ficha_cpf': estatisticas_cache_cpf()})
+
+@app.route('/admin/manutencao_banco', methods=['POST'])
+@super_admin_required
+def admin_manutencao_banco():
+    """Inicia backup + ANALYZE/optimize + compactação + checkpoint em segundo plano (ver manutencao.py)."""
+    data = request.get_json(silent=True) or {}
+    opcoes = {
+        'backup': bool(data.get('backup', True)),
+        'modo_backup': data.get('modo_backup', 'vacuum'),
+        'analisar': bool(data.get('analisar', True)),
+        'compactacao': bool(data.get('compactacao', True)),
+    }
+    if opcoes['modo_backup'] not in MODOS_BACKUP:
+        return jsonify({'success': False, 'message': f"Modo de backup inválido: use {' ou '.join(MODOS_BACKUP)}."}), 400
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        manutencao_id = registrar_manutencao(cursor, session['user_id'], opcoes)
+        cursor.execute('''
+            INSERT INTO acoes_administrativas (admin_id, usuario_id, acao, data_acao, detalhes)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (session['user_id'], session['user_id'], 'Manutenção do banco', datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              f'Manutenção {manutencao_id}: {json.dumps(opcoes)}'))
+        conn.commit()
+    except ManutencaoEmAndamento as e:
+        conn.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 409
+
+    iniciar_manutencao(manutencao_id, opcoes)
+    return jsonify({
+        'success': True,
+        'manutencao_id': manutencao_id,
+        'message': 'Manutenção iniciada. Acompanhe o andamento pelo status.',
+        'status_url': url_for('admin_status_manutencao', manutencao_id=manutencao_id)
+    }), 202
+
+@app.route('/admin/manutencao_banco/<int:manutencao_id>', methods=['GET'])
+@super_admin_required
+def admin_status_manutencao(manutencao_id):
+    conn = get_db_connection()
+    manutencao = obter_manutencao(conn.cursor(), manutencao_id)
+    if not manutencao:
+        return jsonify({'success': False, 'message': 'Manutenção não encontrada.'}), 404
+    return jsonify({'success': True, 'manutencao': manutencao})
+
+@app.route('/admin/reclassificar_fichas', methods=['POST'])
+@super_admin_required
+def admin_reclassificar_fichas():
+    """Recalcula pontuação e classificação de todas as fichas com os pesos atuais, em segundo plano
+    (ver reclassificacao.py); uma reclassificação interrompida com os mesmos pesos é retomada."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        reclassificacao_id, retomada = registrar_reclassificacao(cursor, session['user_id'])
+        cursor.execute('''
+            INSERT INTO acoes_administrativas (admin_id, usuario_id, acao, data_acao, detalhes)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (session['user_id'], session['user_id'], 'Reclassificação de fichas', datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              f"Reclassificação {reclassificacao_id}{' (retomada)' if retomada else ''}"))
+        conn.commit()
+    except ReclassificacaoEmAndamento as e:
+        conn.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 409
+
+    iniciar_reclassificacao(reclassificacao_id)
+    return jsonify({
+        'success': True,
+        'reclassificacao_id': reclassificacao_id,
+        'retomada': retomada,
+        'message': 'Reclassificação iniciada. Acompanhe o andamento pelo status.',
+        'status_url': url_for('admin_status_reclassificacao', reclassificacao_id=reclassificacao_id)
+    }), 202
+
+@app.route('/admin/reclassificar_fichas/<int:reclassificacao_id>', methods=['GET'])
+@super_admin_required
+def admin_status_reclassificacao(reclassificacao_id):
+    conn = get_db_connection()
+    reclassificacao = obter_reclassificacao(conn.cursor(), reclassificacao_id)
+    if not reclassificacao:
+        return jsonify({'success': False, 'message': 'Reclassificação não encontrada.'}), 404
+    return jsonify({'success': True, 'reclassificacao': reclassificacao})
+
+@app.route('/admin/importar_fichas', methods=['POST'])
+@admin_required
+def admin_importar_fichas():
+    """Recebe uma planilha CSV/XLSX e importa as fichas em segundo plano (ver importacao.py)."""
+    arquivo = request.files.get('arquivo')
+    if not arquivo or not arquivo.filename:
+        return jsonify({'success': False, 'message': 'Envie a planilha no campo "arquivo".'}), 400
+    extensao = os.path.splitext(arquivo.filename)[1].lower()
+    if extensao not in IMPORTACAO_EXTENSOES:
+        return jsonify({'success': False, 'message': f"Formato não suportado: use {' ou '.join(IMPORTACAO_EXTENSOES)}."}), 400
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    admin = usuario_logado(USUARIOS)
+    if not admin:
+        conn.close()
+        return jsonify({'success': False, 'message': 'Administrador não encontrado.'}), 404
+    # Admin municipal só importa fichas do próprio município
+    municipios_permitidos = [admin['municipio']] if admin['role'] == 'municipal' and not admin['is_super_admin'] else None
+
+    # O upload vai para um arquivo temporário em disco (lido depois em streaming, nunca inteiro na memória)
+    descritor, caminho = tempfile.mkstemp(prefix='importacao_', suffix=extensao)
+    os.close(descritor)
+    try:
+        arquivo.save(caminho)
+        importacao_id = registrar_importacao(cursor, arquivo.filename, session['user_id'])
+        cursor.execute('''
+            INSERT INTO acoes_administrativas (admin_id, usuario_id, acao, data_acao, detalhes)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (session['user_id'], session['user_id'], 'Importação de fichas', datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              f'Importação {importacao_id}: planilha {arquivo.filename}'))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        os.remove(caminho)
+        logging.error(f"Erro ao receber planilha: {str(e)}")
+        return jsonify({'success': False, 'message': f'Erro ao receber a planilha: {str(e)}'}), 500
+
+    iniciar_importacao(importacao_id, caminho, session['user_id'], admin['nome'], municipios_permitidos)
+    return jsonify({
+        'success': True,
+        'importacao_id': importacao_id,
+        'message': 'Importação iniciada. Acompanhe o andamento pelo status.',
+        'status_url': url_for('admin_status_importacao', importacao_id=importacao_id)
+    }), 202
+
+@app.route('/admin/importar_fichas/<int:importacao_id>', methods=['GET'])
+@admin_required
+def admin_status_importacao(importacao_id):
+    conn = get_db_connection()
+    importacao = obter_importacao(conn.cursor(), importacao_id)
+    if not importacao or (importacao['user_id'] != session['user_id'] and not session.get('is_super_admin')):
+        return jsonify({'success': False, 'message': 'Importação não encontrada.'}), 404
+    return jsonify({'success': True, 'importacao': importacao})
+
 # Rota para buscar usuários aprovados para autocomplete
 @app.route('/admin/buscar_usuarios_aprovados', methods=['GET'])
 @super_admin_required
@@ -2456,11 +2217,22 @@ def buscar_usuarios_aprovados():
         query = request.args.get('query', '').lower()
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, nome FROM usuarios 
-            WHERE approved = 1 AND ativo = 1 AND lower(nome) LIKE ?
-            LIMIT 10
-        ''', (f'%{query}%',))
+        termo = termo_fts(query)
+        if FTS5_DISPONIVEL and termo:
+            # Prefixo sem acento, ordenado por relevância (bm25)
+            cursor.execute('''
+                SELECT u.id, u.nome FROM usuarios_nome_fts f
+                JOIN usuarios u ON u.id = f.rowid
+                WHERE usuarios_nome_fts MATCH ? AND u.approved = 1 AND u.ativo = 1
+                ORDER BY f.rank
+                LIMIT 10
+            ''', (termo,))
+        else:
+            cursor.execute('''
+                SELECT id, nome FROM usuarios 
+                WHERE approved = 1 AND ativo = 1 AND lower(nome) LIKE ?
+                LIMIT 10
+            ''', (f'%{query}%',))
         usuarios = [{'id': row['id'], 'nome': row['nome']} for row in cursor.fetchall()]
         conn.close()
         return jsonify({'success': True, 'usuarios': usuarios})
@@ -2535,6 +2307,7 @@ def atualizar_usuario(user_id):
                           (user_id, municipio))
         
         conn.commit()
+        invalidar_principal(USUARIOS, user_id)
         flash('Usuário atualizado com sucesso!', 'success')
     except sqlite3.Error as e:
         conn.rollback()
@@ -2552,8 +2325,7 @@ def admin_gerenciar_usuarios():
         cursor = conn.cursor()
 
         # === NOME DO USUÁRIO LOGADO ===
-        cursor.execute('SELECT nome FROM usuarios WHERE id = ?', (session['user_id'],))
-        user = cursor.fetchone()
+        user = usuario_logado(USUARIOS)
         if not user:
             logging.error(f"Usuário com ID {session['user_id']} não encontrado.")
             flash('Usuário não encontrado.', 'danger')
@@ -2562,10 +2334,13 @@ def admin_gerenciar_usuarios():
         full_name = user['nome']
         logging.debug(f"Usuário logado: {full_name}")
 
-        # === PAGINAÇÃO ===
+        # === PAGINAÇÃO (por chave: cursores 'depois'/'antes' em nome + id, sem OFFSET) ===
         page = request.args.get('page', 1, type=int)
         per_page = 100
-        offset = (page - 1) * per_page
+        depois = request.args.get('depois') or None
+        antes = request.args.get('antes') or None
+        # Parâmetros da página atual, repassados nos redirects do POST
+        posicao = {k: v for k, v in (('page', page), ('depois', depois), ('antes', antes)) if v}
 
         # === CONTAGEM POR PAPEL (TABELA usuarios) ===
         cursor.execute('''
@@ -2612,24 +2387,22 @@ def admin_gerenciar_usuarios():
         }
         logging.debug(f"Contagens de usuários: {totais_usuarios}")
 
-        # === TOTAL PARA PAGINAÇÃO (só usuarios da tabela principal) ===
-        cursor.execute('''
-            SELECT COUNT(*) AS total
-            FROM usuarios
-            WHERE ativo = 1 AND approved = 1
-        ''')
-        total_usuarios = cursor.fetchone()['total']
-        total_pages = (total_usuarios + per_page - 1) // per_page
+        # === TOTAL PARA PAGINAÇÃO (estimado pela contagem por papel, sem outro COUNT) ===
+        total_usuarios = sum(counts.values())
+        total_pages = max((total_usuarios + per_page - 1) // per_page, 1)
 
         # === LISTAR USUÁRIOS (apenas da tabela usuarios) ===
-        cursor.execute('''
-            SELECT id, COALESCE(nome, '') as nome, email, profissao, cnes, municipio, role, is_admin, is_super_admin
-            FROM usuarios
-            WHERE ativo = 1 AND approved = 1
-            ORDER BY nome ASC
-            LIMIT ? OFFSET ?
-        ''', (per_page, offset))
-        usuarios = [dict(user) for user in cursor.fetchall()]
+        try:
+            pagina = paginar(
+                cursor,
+                "id, COALESCE(nome, '') as nome, email, profissao, cnes, municipio, role, is_admin, is_super_admin",
+                'usuarios WHERE ativo = 1 AND approved = 1', [],
+                "COALESCE(nome, '')", 'ASC', per_page, depois=depois, antes=antes
+            )
+        except CursorInvalido:
+            conn.close()
+            return redirect(url_for('admin_gerenciar_usuarios'))
+        usuarios = pagina.itens
 
         # === DADOS PARA O MAPA (por município) ===
         usuarios_por_municipio = {}
@@ -2673,17 +2446,17 @@ def admin_gerenciar_usuarios():
             if not usuario_id or not novo_role:
                 flash('ID do usuário ou novo papel inválido.', 'danger')
                 conn.close()
-                return redirect(url_for('admin_gerenciar_usuarios', page=page))
+                return redirect(url_for('admin_gerenciar_usuarios', **posicao))
 
             if novo_role not in ['comum', 'municipal', 'estadual', 'apoio']:
                 flash('Papel inválido.', 'danger')
                 conn.close()
-                return redirect(url_for('admin_gerenciar_usuarios', page=page))
+                return redirect(url_for('admin_gerenciar_usuarios', **posicao))
 
             if int(usuario_id) == session['user_id']:
                 flash('Você não pode modificar seu próprio papel.', 'danger')
                 conn.close()
-                return redirect(url_for('admin_gerenciar_usuarios', page=page))
+                return redirect(url_for('admin_gerenciar_usuarios', **posicao))
 
             try:
                 cursor.execute('''
@@ -2696,7 +2469,7 @@ def admin_gerenciar_usuarios():
                 if not user_in_usuarios:
                     flash('Usuário não encontrado.', 'danger')
                     conn.close()
-                    return redirect(url_for('admin_gerenciar_usuarios', page=page))
+                    return redirect(url_for('admin_gerenciar_usuarios', **posicao))
 
                 if novo_role == 'apoio':
                     required = ['nome', 'email', 'municipio', 'senha']
@@ -2704,7 +2477,7 @@ def admin_gerenciar_usuarios():
                         if user_in_usuarios[field] is None:
                             flash(f'O campo {field} é obrigatório para apoio.', 'danger')
                             conn.close()
-                            return redirect(url_for('admin_gerenciar_usuarios', page=page))
+                            return redirect(url_for('admin_gerenciar_usuarios', **posicao))
 
                     cursor.execute('''
                         INSERT INTO usuarios_apoio (nome, email, municipio, senha, ativo, approved, acesso_saude_indigena)
@@ -2736,30 +2509,35 @@ def admin_gerenciar_usuarios():
                       f'Papel alterado para {role_traduzido}'))
 
                 conn.commit()
+                invalidar_principal(USUARIOS, usuario_id)
                 flash(f'Papel alterado para {role_traduzido}.', 'success')
                 conn.close()
-                return redirect(url_for('admin_gerenciar_usuarios', page=page))
+                return redirect(url_for('admin_gerenciar_usuarios', **posicao))
 
             except Exception as e:
                 logging.error(f"Erro ao alterar papel: {str(e)}")
                 flash(f'Erro ao alterar papel: {str(e)}', 'danger')
                 conn.close()
-                return redirect(url_for('admin_gerenciar_usuarios', page=page))
+                return redirect(url_for('admin_gerenciar_usuarios', **posicao))
 
         # === PAGINAÇÃO (classe) ===
         class Pagination:
-            def __init__(self, items, page, per_page, total, total_pages):
+            def __init__(self, items, page, per_page, total, total_pages, next_cursor, prev_cursor, args):
                 self.items = items
                 self.page = page
                 self.per_page = per_page
                 self.total = total
-                self.pages = total_pages
-                self.has_prev = page > 1
-                self.has_next = page < total_pages
-                self.prev_num = page - 1 if self.has_prev else None
+                self.pages = max(total_pages, page)
+                self.next_cursor = next_cursor
+                self.prev_cursor = prev_cursor
+                self.args = args  # posição atual (page + cursor) para o form de alterar papel
+                self.has_prev = prev_cursor is not None
+                self.has_next = next_cursor is not None
+                self.prev_num = max(page - 1, 1) if self.has_prev else None
                 self.next_num = page + 1 if self.has_next else None
 
-        paginated_usuarios = Pagination(usuarios, page, per_page, total_usuarios, total_pages)
+        paginated_usuarios = Pagination(usuarios, page, per_page, total_usuarios, total_pages,
+                                        pagina.proximo, pagina.anterior, posicao)
 
         # === FECHAR CONEXÃO E RENDERIZAR ===
         conn.close()
@@ -2823,8 +2601,7 @@ def cadastrar_apoio():
     # Permissões do admin
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT role, is_super_admin, municipio FROM usuarios WHERE id = ?', (session['user_id'],))
-    admin = cursor.fetchone()
+    admin = usuario_logado(USUARIOS)
     if not admin:
         conn.close()
         return jsonify({'success': False, 'message': 'Administrador não encontrado.'}), 404
@@ -2837,7 +2614,7 @@ def cadastrar_apoio():
     existing_user = cursor.fetchone()
 
     try:
-        senha_hash = bcrypt.hashpw(senha.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        senha_hash = gerar_hash(senha)
         acesso_indigena_value = 1 if saude_indigena else 0  # Valor para o banco
 
         if existing_user:
@@ -2874,6 +2651,8 @@ def cadastrar_apoio():
                   f'Novo apoio com acesso indígena: {"Sim" if saude_indigena else "Não"}', 'apoio'))
 
         conn.commit()
+        if existing_user:
+            invalidar_principal(APOIO, existing_user['id'])
         conn.close()
         return jsonify({'success': True, 'message': 'Usuário de apoio cadastrado com sucesso!'})
 
@@ -2926,9 +2705,7 @@ def excluir_apoio():
             flash('Usuário de apoio não encontrado ou já inativo.', 'error')
             return jsonify({'success': False, 'message': 'Usuário de apoio não encontrado ou já inativo.'}), 404
 
-        current_user_id = session.get('user_id')
-        cursor.execute("SELECT role, municipio, is_super_admin FROM usuarios WHERE id = ?", (current_user_id,))
-        current_user = cursor.fetchone()
+        current_user = usuario_logado(USUARIOS)
         if not current_user:
             conn.close()
             flash('Administrador não encontrado.', 'error')
@@ -2954,6 +2731,7 @@ def excluir_apoio():
         ))
 
         conn.commit()
+        invalidar_principal(APOIO, usuario_id)
         conn.close()
 
         flash('Usuário de apoio desativado com sucesso.', 'success')
@@ -3024,7 +2802,7 @@ def cadastrar_pnar():
         cursor.execute('SELECT id, ativo FROM usuarios_apoio WHERE cpf = ? OR email = ?', (cpf, email))
         existente = cursor.fetchone()
 
-        hash_senha = bcrypt.hashpw(senha.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hash_senha = gerar_hash(senha)
 
         if existente:
             user_id = existente['id']
@@ -3059,6 +2837,7 @@ def cadastrar_pnar():
               datetime.now().strftime('%Y-%m-%d %H:%M:%S'), detalhes))
 
         conn.commit()
+        invalidar_principal(APOIO, user_id)
         conn.close()
 
         return jsonify({
@@ -3110,6 +2889,7 @@ def excluir_pnar():
         ))
 
         conn.commit()
+        invalidar_principal(APOIO, uid)
         conn.close()
 
         return jsonify({
@@ -3131,22 +2911,7 @@ def saude_indigena():
         cursor = conn.cursor()
 
         # === 1. USUÁRIO ===
-        if session.get('tipo_usuario') == 'apoio':
-            cursor.execute('''
-                SELECT a.id, a.municipio, 'apoio' as role, 0 as is_admin, 0 as is_super_admin, a.nome,
-                       COALESCE(a.acesso_saude_indigena, 0) as acesso_saude_indigena
-                FROM usuarios_apoio a WHERE a.id = ?
-            ''', (session['user_id'],))
-        else:
-            cursor.execute('''
-                SELECT u.id, u.municipio, u.role, u.is_admin, u.is_super_admin, u.nome,
-                       COALESCE(a.acesso_saude_indigena, 0) as acesso_saude_indigena
-                FROM usuarios u
-                LEFT JOIN usuarios_apoio a ON a.id = u.id
-                WHERE u.id = ?
-            ''', (session['user_id'],))
-
-        user = cursor.fetchone()
+        user = usuario_logado()
         if not user:
             conn.close()
             flash('Usuário não encontrado.', 'error')
@@ -3159,11 +2924,14 @@ def saude_indigena():
         full_name = user['nome']
         user_municipio = user['municipio']
 
+        # Fichas e agregados vêm da cópia de relatórios; usuário e permissões, do banco principal
+        leitura = get_db_leitura().cursor()
+
         ver_todos_municipios = acesso_saude_indigena or (is_super_admin == 1 and user_role == 'estadual')
 
         # === 2. MUNICÍPIOS PERMITIDOS ===
         if ver_todos_municipios:
-            cursor.execute('SELECT DISTINCT municipio FROM calculos WHERE raca_cor_etnia = ? ORDER BY municipio', ('Indígena',))
+            leitura.execute(f'SELECT DISTINCT municipio FROM {FICHAS} WHERE raca_cor_etnia = ? ORDER BY municipio', ('Indígena',))
         else:
             cursor.execute('''
                 SELECT municipio FROM usuario_municipios WHERE usuario_id = ?
@@ -3176,19 +2944,21 @@ def saude_indigena():
                 municipios = [user_municipio]
             if municipios:
                 placeholders = ','.join(['?'] * len(municipios))
-                cursor.execute(f'''
-                    SELECT DISTINCT municipio FROM calculos 
+                leitura.execute(f'''
+                    SELECT DISTINCT municipio FROM {FICHAS}
                     WHERE raca_cor_etnia = 'Indígena' AND municipio IN ({placeholders})
                     ORDER BY municipio
                 ''', tuple(municipios))
             else:
                 municipios = []
-        municipios = [row['municipio'] for row in cursor.fetchall()]
+        municipios = [row['municipio'] for row in leitura.fetchall()]
 
         # === 3. FILTROS ===
         filtro_municipio = request.form.get('municipio') or request.args.get('municipio')
         filtro_data_inicio = request.form.get('data_inicio') or request.args.get('data_inicio')
         filtro_data_fim = request.form.get('data_fim') or request.args.get('data_fim')
+        data_inicio_iso = data_br_para_iso(filtro_data_inicio)
+        data_fim_iso = data_br_para_iso(filtro_data_fim)
 
         if filtro_municipio and filtro_municipio not in municipios:
             flash('Acesso negado ao município.', 'error')
@@ -3201,12 +2971,12 @@ def saude_indigena():
         if filtro_municipio:
             base_where.append("municipio = ?")
             base_params.append(filtro_municipio)
-        if filtro_data_inicio:
-            base_where.append("data_envio >= ?")
-            base_params.append(filtro_data_inicio)
-        if filtro_data_fim:
-            base_where.append("data_envio <= ?")
-            base_params.append(filtro_data_fim)
+        if data_inicio_iso:
+            base_where.append("data_envio_iso >= ?")
+            base_params.append(data_inicio_iso)
+        if data_fim_iso:
+            base_where.append("data_envio_iso <= ?")
+            base_params.append(data_fim_iso)
         if not ver_todos_municipios and municipios:
             placeholders = ','.join(['?'] * len(municipios))
             base_where.append(f"municipio IN ({placeholders})")
@@ -3215,62 +2985,44 @@ def saude_indigena():
         where_clause = ' AND '.join(base_where)
         where_full = f"WHERE {where_clause}" if where_clause else "WHERE 1=1"
 
-        # === 5. ÚLTIMOS REGISTROS (CARDS) - APENAS ATIVAS (desfecho NULL, fa=0) ===
-        latest_where_cards = where_full + " AND desfecho IS NULL AND fa = 0"
-        latest_subquery = f'''
-            SELECT 
-                COALESCE(
-                    NULLIF(TRIM(cpf), ''), 
-                    NULLIF(TRIM(cpf), '000.000.000-00'),
-                    'sem_cpf'
-                ) AS cpf_limpo,
-                nome_gestante, 
-                data_nasc,
-                MAX(id) as max_id
-            FROM calculos
-            {latest_where_cards}
-            GROUP BY cpf_limpo, nome_gestante, data_nasc
-        '''
-
-        query_ultimos = f'''
-            SELECT c.*
-            FROM calculos c
-            INNER JOIN ({latest_subquery}) latest ON c.id = latest.max_id
-        '''
-
-        logging.debug(f"Query cards:\n{query_ultimos}\nParams: {base_params}")
-        cursor.execute(query_ultimos, base_params)
-        ultimos_registros = [dict(row) for row in cursor.fetchall()]
-        logging.debug(f"Registros para cards (ativas): {len(ultimos_registros)}")
+        # === 5. AGREGADOS (CARDS) - GESTANTES INDÍGENAS NO ESCOPO ===
+        if filtro_municipio:
+            municipios_escopo = [filtro_municipio]
+        elif not ver_todos_municipios and municipios:
+            municipios_escopo = municipios
+        else:
+            municipios_escopo = None
+        agregados = ler_agregados(leitura, municipios=municipios_escopo, dia_inicio=data_inicio_iso,
+                                  dia_fim=data_fim_iso, indigena=True)
+        agregados_municipio = ler_agregados(leitura, municipios=municipios_escopo, dia_inicio=data_inicio_iso,
+                                            dia_fim=data_fim_iso, indigena=True, por_municipio=True)
 
         # === 6. TODOS OS REGISTROS (TABELA CONSOLIDADA) - TODOS INDÍGENAS ===
+        # O arquivo só entra quando o período alcança fichas arquivadas
         query_todos = f'''
             SELECT c.*
-            FROM calculos c
+            FROM {tabela_fichas(leitura, data_inicio_iso)} c
             {where_full}
-            ORDER BY c.data_envio DESC
+            ORDER BY c.data_envio_iso DESC, c.id DESC
         '''
-        cursor.execute(query_todos, base_params)
-        todos_registros = [dict(row) for row in cursor.fetchall()]
+        leitura.execute(query_todos, base_params)
+        todos_registros = [dict(row) for row in leitura.fetchall()]
         logging.debug(f"Registros na tabela (consolidado): {len(todos_registros)}")
 
         # === 7. TOTAL GERAL ===
-        total_geral = cursor.execute('SELECT COUNT(*) FROM calculos WHERE fa = 0').fetchone()[0]
-        total_indigenas = len(ultimos_registros)
+        total_geral = sum(ler_agregados(leitura).get('fichas', {}).values())
+        total_indigenas = sum(agregados.get('ativas', {}).values())
         percentual_indigenas = round(total_indigenas / total_geral * 100, 1) if total_geral > 0 else 0
 
         # === 8. MAPEAMENTO SEGURO ===
         def mapear_campo(valor, mapa, default='Não informado'):
             if not valor:
                 return default
-            try:
-                items = json.loads(valor) if isinstance(valor, str) else [valor]
-                mapped = [mapa.get(str(i).strip(), str(i).strip()) for i in items if str(i).strip()]
-                return ', '.join(mapped) if mapped else default
-            except:
-                return mapa.get(str(valor).strip(), default)
+            items = decodificar_secao(valor) if isinstance(valor, str) else [str(valor).strip()]
+            mapped = [mapa.get(i, i) for i in items if i]
+            return ', '.join(mapped) if mapped else default
 
-        # === 9. ESTATÍSTICAS (APENAS REGISTROS ATIVOS) ===
+        # === 9. ESTATÍSTICAS (APENAS GESTANTES ATIVAS, A PARTIR DOS AGREGADOS) ===
         genero_counts = {}
         sexualidade_counts = {}
         etnia_indigena_counts = {}
@@ -3281,52 +3033,49 @@ def saude_indigena():
         comorbidades_counts = {}
         historia_obstetrica_counts = {}
         condicoes_gestacionais_counts = {}
-        desfecho_counts = {}
         risco_habitual = risco_intermediario = risco_alto = 0
 
-        for reg in ultimos_registros:
-            # Gênero
-            genero = GENERO_MAP.get(reg.get('genero', ''), 'Não informado')
-            genero_counts[genero] = genero_counts.get(genero, 0) + 1
+        for codigo, total in agregados.get('genero', {}).items():
+            genero = GENERO_MAP.get(codigo, 'Não informado')
+            genero_counts[genero] = genero_counts.get(genero, 0) + total
 
-            # Sexualidade
-            sexual = SEXUALIDADE_MAP.get(reg.get('sexualidade', ''), 'Não informado')
-            sexualidade_counts[sexual] = sexualidade_counts.get(sexual, 0) + 1
+        for codigo, total in agregados.get('sexualidade', {}).items():
+            sexual = SEXUALIDADE_MAP.get(codigo, 'Não informado')
+            sexualidade_counts[sexual] = sexualidade_counts.get(sexual, 0) + total
 
-            # Etnia
-            etnia = get_etnia_nome(reg.get('etnia_indigena', '')).strip()
+        for codigo, total in agregados.get('etnia', {}).items():
+            etnia = nome_etnia(codigo).strip()
             if etnia and etnia not in ['Não informado', '-', '']:
-                etnia_indigena_counts[etnia] = etnia_indigena_counts.get(etnia, 0) + 1
-                total_etnias += 1
-
-            # Período
-            periodo = reg.get('periodo_gestacional') or 'Não informado'
-            periodo_gestacional[periodo] = periodo_gestacional.get(periodo, 0) + 1
-
-            # Campos JSON
-            for campo, mapa, contador in [
-                ('caracteristicas', CARACTERISTICAS_MAP, caracteristicas_counts),
-                ('avaliacao_nutricional', AVALIACAO_NUTRICIONAL_MAP, avaliacao_nutricional_counts),
-                ('comorbidades', COMORBIDADES_MAP, comorbidades_counts),
-                ('historia_obstetrica', HISTORIA_OBSTETRICA_MAP, historia_obstetrica_counts),
-                ('condicoes_gestacionais', CONDICOES_GESTACIONAIS_MAP, condicoes_gestacionais_counts)
-            ]:
-                texto = mapear_campo(reg.get(campo), mapa, '-')
-                for item in [x.strip() for x in texto.split(',') if x.strip() != '-']:
-                    contador[item] = contador.get(item, 0) + 1
+                etnia_indigena_counts[etnia] = etnia_indigena_counts.get(etnia, 0) + total
+                total_etnias += total
 
-            # Desfecho (só para cards)
-            desf = DESFECHO_MAP.get(reg.get('desfecho'), 'Sem desfecho')
-            desfecho_counts[desf] = desfecho_counts.get(desf, 0) + 1
+        for periodo, total in agregados.get('periodo', {}).items():
+            periodo = periodo or 'Não informado'
+            periodo_gestacional[periodo] = periodo_gestacional.get(periodo, 0) + total
 
-            # Risco
-            risco = (reg.get('classificacao_risco') or '').strip().lower()
+        # Gestantes ativas não têm desfecho
+        desfecho_counts = {DESFECHO_MAP.get(None, 'Sem desfecho'): total_indigenas} if total_indigenas else {}
+
+        for classificacao, total in agregados.get('risco', {}).items():
+            risco = classificacao.lower()
             if risco == 'risco habitual':
-                risco_habitual += 1
+                risco_habitual += total
             elif risco in ['médio risco', 'risco intermediário']:
-                risco_intermediario += 1
+                risco_intermediario += total
             elif risco == 'alto risco':
-                risco_alto += 1
+                risco_alto += total
+
+        for campo, mapa, contador in [
+            ('caracteristicas', CARACTERISTICAS_MAP, caracteristicas_counts),
+            ('avaliacao_nutricional', AVALIACAO_NUTRICIONAL_MAP, avaliacao_nutricional_counts),
+            ('comorbidades', COMORBIDADES_MAP, comorbidades_counts),
+            ('historia_obstetrica', HISTORIA_OBSTETRICA_MAP, historia_obstetrica_counts),
+            ('condicoes_gestacionais', CONDICOES_GESTACIONAIS_MAP, condicoes_gestacionais_counts)
+        ]:
+            for codigo, total in agregados.get('item:' + campo, {}).items():
+                nome = mapa.get(codigo, codigo)
+                if nome != '-':
+                    contador[nome] = contador.get(nome, 0) + total
 
         # Formatar etnias
         for etnia, count in etnia_indigena_counts.items():
@@ -3336,39 +3085,23 @@ def saude_indigena():
             }
 
         # === 9.5 CONTADORES DO CONSOLIDADO (DISTINTOS POR GESTANTE) ===
-        gestantes_vistas = set()
-        fora_de_area_distinto = 0
+        # Situação atual de cada gestante no escopo (ativas ou não)
+        total_gestantes_distintas = sum(agregados.get('gestantes', {}).values())
+        fora_de_area_distinto = sum(agregados.get('fora_area', {}).values())
         desfecho_consolidado_distinto = {}
-
-        for reg in todos_registros:
-            cpf = reg.get('cpf', '').strip()
-            if cpf in ['000.000.000-00', '']:
-                cpf = 'sem_cpf'
-            chave_gestante = (cpf, reg.get('nome_gestante'), reg.get('data_nasc'))
-
-            if chave_gestante not in gestantes_vistas:
-                gestantes_vistas.add(chave_gestante)
-
-                # Fora de Área
-                if reg.get('fa') == 1:
-                    fora_de_area_distinto += 1
-
-                # Desfechos (só se tiver valor)
-                desfecho_raw = reg.get('desfecho')
-                if desfecho_raw:
-                    desfecho_nome = DESFECHO_MAP.get(desfecho_raw, desfecho_raw)
-                    if desfecho_nome != 'Não informado':
-                        desfecho_consolidado_distinto[desfecho_nome] = desfecho_consolidado_distinto.get(desfecho_nome, 0) + 1
+        for desfecho_raw, total in agregados.get('desfecho', {}).items():
+            desfecho_nome = DESFECHO_MAP.get(desfecho_raw, desfecho_raw)
+            if desfecho_nome != 'Não informado':
+                desfecho_consolidado_distinto[desfecho_nome] = desfecho_consolidado_distinto.get(desfecho_nome, 0) + total
 
         # === 10. TOTAIS ===
         total_desfechos = sum(desfecho_counts.values())
         total_desfechos_consolidado = sum(desfecho_consolidado_distinto.values())
-        total_gestantes_distintas = len(gestantes_vistas)
 
         # === 11. ESTATÍSTICAS FINAIS ===
         estatisticas = {
             'total_registros': total_indigenas,
-            'municipios_unicos': len(set(r['municipio'] for r in ultimos_registros if r['municipio'])),
+            'municipios_unicos': sum(1 for dimensoes in agregados_municipio.values() if dimensoes.get('ativas')),
             'percentual_indigenas': percentual_indigenas,
             'total_etnias_indigenas': total_etnias,
             'etnia_indigena_counts': etnia_indigena_counts,
@@ -3392,8 +3125,9 @@ def saude_indigena():
         }
 
         # === 12. FORMATAR TABELA (TODOS OS REGISTROS INDÍGENAS) ===
-        for reg in todos_registros:
-            reg['etnia_indigena'] = get_etnia_nome(reg.get('etnia_indigena', ''))
+        etnias = resolver_etnias(reg.get('etnia_indigena', '') for reg in todos_registros)
+        for reg, etnia in zip(todos_registros, etnias):
+            reg['etnia_indigena'] = etnia
             reg['genero'] = GENERO_MAP.get(reg.get('genero'), 'Não informado')
             reg['sexualidade'] = SEXUALIDADE_MAP.get(reg.get('sexualidade'), 'Não informado')
 
@@ -3427,6 +3161,7 @@ def saude_indigena():
                                filtro_municipio=filtro_municipio,
                                filtro_data_inicio=filtro_data_inicio,
                                filtro_data_fim=filtro_data_fim,
+                               atualizacao=atualizacao_relatorio(),
                                current_user={
                                    'nome': full_name,
                                    'role': user_role,
@@ -3498,50 +3233,35 @@ def monitoramento():
     usuarios_por_municipio = {}
     municipios = []
 
-    # Consulta para estatísticas de cálculos
-    query_calculos = '''
-        SELECT c.*, u.municipio as user_municipio
-        FROM calculos c
-        JOIN usuarios u ON c.user_id = u.id
-        WHERE c.fa = 0
-    '''
-    params = []
-    if municipios_permitidos:
-        query_calculos += ' AND c.municipio IN (' + ','.join(['?'] * len(municipios_permitidos)) + ')'
-        params.extend(municipios_permitidos)
-
-    cursor.execute(query_calculos, params)
-    fichas = cursor.fetchall()
+    # Fichas dentro da área (fa = 0) por município e classificação, lidas dos agregados diários
+    # na cópia de relatórios; as listas de usuários abaixo vêm do banco principal (aprovações e
+    # desativações aparecem na hora)
+    leitura = get_db_leitura().cursor()
+    agregados_municipio = ler_agregados(leitura, municipios=municipios_permitidos or None, por_municipio=True)
 
     municipios_set = set()
-    for ficha in fichas:
-        municipio = ficha['municipio']
+    for municipio, dimensoes in agregados_municipio.items():
         if municipio not in municipios_permitidos:
             continue
-        municipios_set.add(municipio)
-        estatisticas['total_registros'] += 1
-        classificacao = ficha['classificacao_risco']
-        if classificacao == 'Risco Habitual':
-            estatisticas['classificacao_risco']['risco_habitual'] += 1
-        elif classificacao == 'Risco Intermediário':
-            estatisticas['classificacao_risco']['risco_intermediario'] += 1
-        elif classificacao == 'Risco Alto':
-            estatisticas['classificacao_risco']['risco_alto'] += 1
-
-        if municipio not in usuarios_por_municipio:
-            usuarios_por_municipio[municipio] = {
-                'total': 0,
-                'risco_habitual': 0,
-                'risco_intermediario': 0,
-                'risco_alto': 0
-            }
-        usuarios_por_municipio[municipio]['total'] += 1
-        if classificacao == 'Risco Habitual':
-            usuarios_por_municipio[municipio]['risco_habitual'] += 1
-        elif classificacao == 'Risco Intermediário':
-            usuarios_por_municipio[municipio]['risco_intermediario'] += 1
-        elif classificacao == 'Risco Alto':
-            usuarios_por_municipio[municipio]['risco_alto'] += 1
+        for classificacao, total in dimensoes.get('fichas', {}).items():
+            municipios_set.add(municipio)
+            estatisticas['total_registros'] += total
+            if municipio not in usuarios_por_municipio:
+                usuarios_por_municipio[municipio] = {
+                    'total': 0,
+                    'risco_habitual': 0,
+                    'risco_intermediario': 0,
+                    'risco_alto': 0
+                }
+            usuarios_por_municipio[municipio]['total'] += total
+            chave = {
+                'Risco Habitual': 'risco_habitual',
+                'Risco Intermediário': 'risco_intermediario',
+                'Risco Alto': 'risco_alto'
+            }.get(classificacao)
+            if chave:
+                estatisticas['classificacao_risco'][chave] += total
+                usuarios_por_municipio[municipio][chave] += total
 
     estatisticas['municipios_unicos'] = len(municipios_set)
     municipios = sorted(list(municipios_set))
@@ -3568,7 +3288,6 @@ def monitoramento():
     conn.close()
 
     return render_template('monitoramento.html',
-                          fichas=fichas,
                           estatisticas=estatisticas,
                           municipios=municipios,
                           filtro_municipio=filtro_municipio,
@@ -3576,7 +3295,8 @@ def monitoramento():
                           filtro_macrorregiao=filtro_macrorregiao,
                           usuarios_por_municipio=usuarios_por_municipio,
                           usuarios=usuarios,
-                          regioes_por_macrorregiao=regioes_por_macrorregiao)
+                          regioes_por_macrorregiao=regioes_por_macrorregiao,
+                          atualizacao=atualizacao_relatorio())
 
 @app.route('/admin/senha', methods=['GET'])
 @admin_required
@@ -3586,8 +3306,7 @@ def admin_senha():
         cursor = conn.cursor()
 
         # Obter informações do administrador logado
-        cursor.execute('SELECT role, is_super_admin, municipio FROM usuarios WHERE id = ?', (session['user_id'],))
-        admin = cursor.fetchone()
+        admin = usuario_logado(USUARIOS)
         if not admin:
             conn.close()
             flash('Administrador não encontrado.', 'error')
@@ -3630,8 +3349,7 @@ def admin_reset_senha():
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        cursor.execute('SELECT role, is_super_admin, municipio FROM usuarios WHERE id = ?', (session['user_id'],))
-        admin = cursor.fetchone()
+        admin = usuario_logado(USUARIOS)
         if not admin:
             conn.close()
             flash('Administrador não encontrado.', 'danger')
@@ -3664,7 +3382,7 @@ def admin_reset_senha():
             flash('Acesso negado: permissões insuficientes.', 'danger')
             return redirect(url_for('admin_senha'))
 
-        nova_senha_hash = bcrypt.hashpw(nova_senha.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        nova_senha_hash = gerar_hash(nova_senha)
         cursor.execute('UPDATE usuarios SET senha = ? WHERE email = ?', (nova_senha_hash, email))
         conn.commit()
 
@@ -3683,6 +3401,102 @@ def admin_reset_senha():
         flash(f'Erro no banco de dados: {str(e)}. Contate o administrador.', 'danger')
         return redirect(url_for('admin_senha'))
 
+def escopo_relatorio(cursor, user, leitura=None):
+    """Municípios visíveis, filtros e WHERE do relatório administrativo para o usuário logado.
+
+    user é a linha de usuarios (municipio, role, is_admin, is_super_admin). Usado por
+    admin_relatorio e pela exportação, que precisam devolver exatamente os mesmos registros.
+    leitura é o cursor das fichas (cópia de relatórios); sem ele, usa cursor.
+    """
+    leitura = leitura or cursor
+    # Municípios visíveis
+    if user['is_super_admin'] == 1 and user['role'] == 'estadual':
+        leitura.execute(f'SELECT DISTINCT municipio FROM {FICHAS} ORDER BY municipio')
+        municipios = [row['municipio'] for row in leitura.fetchall()]
+    else:
+        cursor.execute('SELECT municipio FROM usuario_municipios WHERE usuario_id = ?', (session['user_id'],))
+        municipios = [row['municipio'] for row in cursor.fetchall()]
+        if not municipios and user['municipio']:
+            municipios = [user['municipio']]
+
+    # Filtros (formulário do relatório ou query string da exportação)
+    filtro_municipio = request.form.get('municipio') or request.args.get('municipio')
+    filtro_data_inicio = request.form.get('data_inicio') or request.args.get('data_inicio')
+    filtro_data_fim = request.form.get('data_fim') or request.args.get('data_fim')
+    data_inicio_iso = data_br_para_iso(filtro_data_inicio)
+    data_fim_iso = data_br_para_iso(filtro_data_fim)
+
+    municipio_negado = bool(filtro_municipio and filtro_municipio not in municipios)
+    if municipio_negado:
+        filtro_municipio = None
+
+    # WHERE dinâmico
+    where_parts = []
+    params = []
+
+    if municipios and (user['is_admin'] == 1 or user['is_super_admin'] == 0):
+        placeholders = ','.join(['?'] * len(municipios))
+        where_parts.append(f"municipio IN ({placeholders})")
+        params.extend(municipios)
+        if filtro_municipio:
+            where_parts.append("municipio = ?")
+            params.append(filtro_municipio)
+    elif user['is_super_admin'] == 1 and user['role'] == 'estadual' and filtro_municipio:
+        where_parts.append("municipio = ?")
+        params.append(filtro_municipio)
+
+    # Mesmo escopo de municípios para a leitura dos agregados (None = todos)
+    if municipios and (user['is_admin'] == 1 or user['is_super_admin'] == 0):
+        municipios_escopo = [filtro_municipio] if filtro_municipio else municipios
+    elif user['is_super_admin'] == 1 and user['role'] == 'estadual' and filtro_municipio:
+        municipios_escopo = [filtro_municipio]
+    else:
+        municipios_escopo = None
+
+    # Intervalo de datas por data_envio_iso (index range scan em idx_calculos_*_envio_iso)
+    if data_inicio_iso:
+        where_parts.append("data_envio_iso >= ?")
+        params.append(data_inicio_iso)
+    if data_fim_iso:
+        where_parts.append("data_envio_iso <= ?")
+        params.append(data_fim_iso)
+
+    where_clause = " AND ".join(where_parts)
+    where_full = f"WHERE {where_clause}" if where_clause else "WHERE 1=1"
+
+    return {
+        'municipios': municipios,
+        'filtro_municipio': filtro_municipio,
+        'filtro_data_inicio': filtro_data_inicio,
+        'filtro_data_fim': filtro_data_fim,
+        'data_inicio_iso': data_inicio_iso,
+        'data_fim_iso': data_fim_iso,
+        'municipios_escopo': municipios_escopo,
+        'where_full': where_full,
+        'params': params,
+        'municipio_negado': municipio_negado,
+    }
+
+RISCO_RELATORIO_MAP = {
+    'risco habitual': 'Risco Habitual',
+    'habitual': 'Risco Habitual',
+    'médio risco': 'Risco Intermediário',
+    'risco intermediário': 'Risco Intermediário',
+    'alto risco': 'Risco Alto',
+    'risco alto': 'Risco Alto'
+}
+
+# Rótulos da tabela do relatório, aplicados pela Ficha na leitura de cada campo
+ROTULOS_RELATORIO = {
+    'etnia_indigena': nome_etnia,
+    'genero': lambda valor: GENERO_MAP.get((valor or '').strip().lower(), 'Não informado'),
+    'sexualidade': lambda valor: SEXUALIDADE_MAP.get((valor or '').strip().lower(), 'Não informado'),
+    'raca_cor_etnia': lambda valor: RACA_COR_ETNIA_MAP.get((valor or '').strip().lower(), 'Não informado'),
+    'fa': lambda valor: 'Sim' if valor == 1 else 'Não',
+    'desfecho': lambda valor: DESFECHO_MAP.get(valor, '-') if valor else '-',
+    'classificacao_risco': lambda valor: RISCO_RELATORIO_MAP.get((valor or '').strip().lower(), 'Não informado'),
+}
+
 @app.route('/admin/relatorio', methods=['GET', 'POST'])
 @admin_required
 def admin_relatorio():
@@ -3691,9 +3505,7 @@ def admin_relatorio():
         cursor = conn.cursor()
 
         # === 1. USUÁRIO E PERMISSÕES ===
-        cursor.execute('SELECT municipio, role, is_admin, is_super_admin, nome FROM usuarios WHERE id = ?',
-                       (session['user_id'],))
-        user = cursor.fetchone()
+        user = usuario_logado(USUARIOS)
         if not user:
             conn.close()
             flash('Usuário não encontrado.', 'error')
@@ -3704,119 +3516,82 @@ def admin_relatorio():
         is_super_admin = user['is_super_admin']
         full_name = user['nome']
 
-        # === 2. MUNICÍPIOS VISÍVEIS ===
-        if is_super_admin == 1 and user_role == 'estadual':
-            cursor.execute('SELECT DISTINCT municipio FROM calculos ORDER BY municipio')
-            municipios = [row['municipio'] for row in cursor.fetchall()]
-        else:
-            cursor.execute('SELECT municipio FROM usuario_municipios WHERE usuario_id = ?', (session['user_id'],))
-            municipios = [row['municipio'] for row in cursor.fetchall()]
-            if not municipios and user['municipio']:
-                municipios = [user['municipio']]
-
-        # === 3. FILTROS ===
-        filtro_municipio = request.form.get('municipio') or request.args.get('municipio')
-        filtro_data_inicio = request.form.get('data_inicio') or request.args.get('data_inicio')
-        filtro_data_fim = request.form.get('data_fim') or request.args.get('data_fim')
-
-        if filtro_municipio and filtro_municipio not in municipios:
+        # Fichas e agregados vêm da cópia de relatórios; usuário e permissões, do banco principal
+        leitura = get_db_leitura().cursor()
+
+        # === 2-4. MUNICÍPIOS VISÍVEIS, FILTROS E WHERE (compartilhados com a exportação) ===
+        escopo = escopo_relatorio(cursor, user, leitura)
+        municipios = escopo['municipios']
+        filtro_municipio = escopo['filtro_municipio']
+        filtro_data_inicio = escopo['filtro_data_inicio']
+        filtro_data_fim = escopo['filtro_data_fim']
+        data_inicio_iso = escopo['data_inicio_iso']
+        data_fim_iso = escopo['data_fim_iso']
+        municipios_escopo = escopo['municipios_escopo']
+        where_full = escopo['where_full']
+        params = escopo['params']
+        if escopo['municipio_negado']:
             flash('Acesso negado ao município.', 'error')
-            filtro_municipio = None
-
-        # === 4. WHERE DINÂMICO ===
-        where_parts = []
-        params = []
-
-        if municipios and (is_admin == 1 or is_super_admin == 0):
-            placeholders = ','.join(['?'] * len(municipios))
-            where_parts.append(f"municipio IN ({placeholders})")
-            params.extend(municipios)
-            if filtro_municipio:
-                where_parts.append("municipio = ?")
-                params.append(filtro_municipio)
-        elif is_super_admin == 1 and user_role == 'estadual' and filtro_municipio:
-            where_parts.append("municipio = ?")
-            params.append(filtro_municipio)
 
-        if filtro_data_inicio:
-            where_parts.append("data_envio >= ?")
-            params.append(filtro_data_inicio)
-        if filtro_data_fim:
-            where_parts.append("data_envio <= ?")
-            params.append(filtro_data_fim + " 23:59:59")
-
-        where_clause = " AND ".join(where_parts)
-        where_full = f"WHERE {where_clause}" if where_clause else "WHERE 1=1"
-
-        # === 5. GESTANTES ATIVAS DISTINTAS ===
-        latest_sql = f'''
-            SELECT COALESCE(NULLIF(TRIM(cpf), ''), NULLIF(TRIM(cpf), '000.000.000-00'), 'sem_cpf') AS cpf_limpo,
-                   nome_gestante, data_nasc, MAX(id) as max_id
-            FROM calculos
-            {where_full} AND desfecho IS NULL AND fa = 0
-            GROUP BY cpf_limpo, nome_gestante, data_nasc
-        '''
-        cursor.execute(f'SELECT c.* FROM calculos c INNER JOIN ({latest_sql}) l ON c.id = l.max_id', params)
-        ultimos_registros = [dict(row) for row in cursor.fetchall()]
-        total_gestantes_ativas = len(ultimos_registros)
-
-        # === 6. TODOS OS REGISTROS ===
-        cursor.execute(f'SELECT * FROM calculos {where_full} ORDER BY data_envio DESC', params)
-        todos_registros = [dict(row) for row in cursor.fetchall()]
+        # === 5. AGREGADOS DAS GESTANTES NO ESCOPO (por município/dia, sem varrer as fichas) ===
+        agregados = ler_agregados(leitura, municipios=municipios_escopo, dia_inicio=data_inicio_iso,
+                                  dia_fim=data_fim_iso)
+        agregados_municipio = ler_agregados(leitura, municipios=municipios_escopo, dia_inicio=data_inicio_iso,
+                                            dia_fim=data_fim_iso, por_municipio=True)
+        total_gestantes_ativas = sum(agregados.get('ativas', {}).values())
+
+        # === 6. REGISTROS DA PÁGINA (por chave: cursores 'depois'/'antes' em data de envio + id) ===
+        # A tabela mostra uma página por vez; todas as fichas do escopo só saem pela exportação
+        # O arquivo só entra quando o período alcança fichas arquivadas
+        tabela = tabela_fichas(leitura, data_inicio_iso)
+        page = request.args.get('page', 1, type=int)
+        per_page = 100
+        # Rótulos calculados na leitura, como na exportação
+        cursor_fichas = get_db_leitura().cursor()
+        cursor_fichas.row_factory = fabrica_fichas(ROTULOS_RELATORIO)
+        try:
+            pagina = paginar(
+                cursor_fichas, '*', f'{tabela} {where_full}', params,
+                "COALESCE(data_envio_iso, '')", 'DESC', per_page,
+                depois=request.args.get('depois') or None, antes=request.args.get('antes') or None
+            )
+        except CursorInvalido:
+            conn.close()
+            return redirect(url_for('admin_relatorio'))
 
-        # === 7. FORA DE ÁREA + DESFECHOS DISTINTOS ===
-        vista = set()
-        fora_de_area_distinto = 0
+        # === 7. FORA DE ÁREA + DESFECHOS DISTINTOS (situação atual de cada gestante) ===
+        total_gestantes_distintas = sum(agregados.get('gestantes', {}).values())
+        fora_de_area_distinto = sum(agregados.get('fora_area', {}).values())
         desfechos_distintos = Counter()
-        for r in todos_registros:
-            chave = ((r.get('cpf') or '').strip() or 'sem_cpf', r.get('nome_gestante'), r.get('data_nasc'))
-            if chave not in vista:
-                vista.add(chave)
-                if r.get('fa') == 1:
-                    fora_de_area_distinto += 1
-                d = DESFECHO_MAP.get(r.get('desfecho'))
-                if d and d != 'Não informado':
-                    desfechos_distintos[d] += 1
-
-        # === 8. FORMATAR CAMPOS DA TABELA ===
-        for r in todos_registros:
-            r['etnia_indigena'] = get_etnia_nome(r.get('etnia_indigena', ''))
-            r['genero'] = GENERO_MAP.get(r.get('genero', '').strip().lower(), 'Não informado')
-            r['sexualidade'] = SEXUALIDADE_MAP.get(r.get('sexualidade', '').strip().lower(), 'Não informado')
-            r['raca_cor_etnia'] = RACA_COR_ETNIA_MAP.get(r.get('raca_cor_etnia', '').strip().lower(), 'Não informado')
-            r['fa'] = 'Sim' if r.get('fa') == 1 else 'Não'
-            r['desfecho'] = DESFECHO_MAP.get(r.get('desfecho'), '-') if r.get('desfecho') else '-'
-
-            risco = (r.get('classificacao_risco') or '').strip().lower()
-            r['classificacao_risco'] = {
-                'risco habitual': 'Risco Habitual',
-                'habitual': 'Risco Habitual',
-                'médio risco': 'Risco Intermediário',
-                'risco intermediário': 'Risco Intermediário',
-                'alto risco': 'Risco Alto',
-                'risco alto': 'Risco Alto'
-            }.get(risco, 'Não informado')
+        for codigo, total in agregados.get('desfecho', {}).items():
+            d = DESFECHO_MAP.get(codigo)
+            if d and d != 'Não informado':
+                desfechos_distintos[d] += total
 
-        # === 9. CONTADORES PRINCIPAIS (SÓ GESTANTES ATIVAS) ===
+        # === 8-9. CONTADORES PRINCIPAIS (SÓ GESTANTES ATIVAS) ===
         periodo_gestacional = Counter()
         genero_counts = Counter()
         sexualidade_counts = Counter()
         raca_counts = Counter()
         etnia_indigena_final = {}
-
-        for reg in ultimos_registros:
-            if reg.get('periodo_gestacional'):
-                periodo_gestacional[reg['periodo_gestacional']] += 1
-
-            genero_counts[GENERO_MAP.get(reg.get('genero', '').strip().lower(), 'Não informado')] += 1
-            sexualidade_counts[SEXUALIDADE_MAP.get(reg.get('sexualidade', '').strip().lower(), 'Não informado')] += 1
-            raca_counts[RACA_COR_ETNIA_MAP.get(reg.get('raca_cor_etnia', '').strip().lower(), 'Não informado')] += 1
-
-            cod = reg.get('etnia_indigena', '').strip()
+        total_indigenas = 0
+
+        for periodo, total in agregados.get('periodo', {}).items():
+            if periodo:
+                periodo_gestacional[periodo] += total
+        for codigo, total in agregados.get('genero', {}).items():
+            genero_counts[GENERO_MAP.get(codigo.lower(), 'Não informado')] += total
+        for codigo, total in agregados.get('sexualidade', {}).items():
+            sexualidade_counts[SEXUALIDADE_MAP.get(codigo.lower(), 'Não informado')] += total
+        for codigo, total in agregados.get('raca', {}).items():
+            raca_counts[RACA_COR_ETNIA_MAP.get(codigo.lower(), 'Não informado')] += total
+
+        for cod, total in agregados.get('etnia', {}).items():
             if cod and cod not in ['', 'Não indígena', 'Não informado']:
-                nome = get_etnia_nome(cod)
+                total_indigenas += total
+                nome = nome_etnia(cod)
                 if nome and nome not in ['Não indígena', 'Não informado', '-']:
-                    etnia_indigena_final[nome] = etnia_indigena_final.get(nome, 0) + 1
+                    etnia_indigena_final[nome] = etnia_indigena_final.get(nome, 0) + total
 
         # === 10. CONTADORES SECUNDÁRIOS ===
         caracteristicas_counts = Counter()
@@ -3827,49 +3602,42 @@ def admin_relatorio():
         deficiencia_counts = Counter({'Sim': 0, 'Não': 0, 'Não informado': 0})
         risco_counts = Counter()
 
-        for reg in ultimos_registros:
-            # Campos múltiplos
-            for campo, mapa, cont in [
-                ('caracteristicas', CARACTERISTICAS_MAP, caracteristicas_counts),
-                ('avaliacao_nutricional', AVALIACAO_NUTRICIONAL_MAP, avaliacao_nutricional_counts),
-                ('comorbidades', COMORBIDADES_MAP, comorbidades_counts),
-                ('historia_obstetrica', HISTORIA_OBSTETRICA_MAP, historia_counts),
-                ('condicoes_gestacionais', CONDICOES_GESTACIONAIS_MAP, condicoes_counts),
-            ]:
-                try:
-                    itens = json.loads(reg[campo]) if reg.get(campo) and isinstance(reg[campo], str) else (reg[campo] or [])
-                    if not isinstance(itens, list): itens = [itens] if itens else []
-                    for i in itens:
-                        if i and str(i).strip():
-                            nome = mapa.get(i, i)
-                            if nome != '-':
-                                cont[nome] += 1
-                except: pass
-
-            # Deficiência
-            d = (reg.get('deficiencia') or '').strip().lower()
+        # Campos múltiplos
+        for campo, mapa, cont in [
+            ('caracteristicas', CARACTERISTICAS_MAP, caracteristicas_counts),
+            ('avaliacao_nutricional', AVALIACAO_NUTRICIONAL_MAP, avaliacao_nutricional_counts),
+            ('comorbidades', COMORBIDADES_MAP, comorbidades_counts),
+            ('historia_obstetrica', HISTORIA_OBSTETRICA_MAP, historia_counts),
+            ('condicoes_gestacionais', CONDICOES_GESTACIONAIS_MAP, condicoes_counts),
+        ]:
+            for codigo, total in agregados.get('item:' + campo, {}).items():
+                nome = mapa.get(codigo, codigo)
+                if nome != '-':
+                    cont[nome] += total
+
+        # Deficiência
+        for valor, total in agregados.get('deficiencia', {}).items():
+            d = valor.lower()
             if d in ['sim', 's', '1', 'yes', 'true']:
-                deficiencia_counts['Sim'] += 1
+                deficiencia_counts['Sim'] += total
             elif d in ['não', 'nao', 'n', '0', 'no', 'false', '']:
-                deficiencia_counts['Não'] += 1
+                deficiencia_counts['Não'] += total
             else:
-                deficiencia_counts['Não informado'] += 1
-
-            # Risco
-            risco_raw = (reg.get('classificacao_risco') or '').strip().lower()
-            risco_map = {
-                'risco habitual': 'Risco Habitual', 'habitual': 'Risco Habitual',
-                'médio risco': 'Risco Intermediário', 'risco intermediário': 'Risco Intermediário',
-                'alto risco': 'Risco Alto', 'risco alto': 'Risco Alto'
-            }
-            risco_counts[risco_map.get(risco_raw, 'Não informado')] += 1
+                deficiencia_counts['Não informado'] += total
 
-        # === 11. MÉDIA DA PONTUAÇÃO (CORRIGIDA!) ===
-        pontuacoes_validas = [
-            float(r['pontuacao_total']) for r in ultimos_registros
-            if r.get('pontuacao_total') and str(r['pontuacao_total']).replace('.', '', 1).replace(',', '.', 1).isdigit()
-        ]
-        media_pontuacao = round(sum(pontuacoes_validas) / len(pontuacoes_validas), 1) if pontuacoes_validas else 0.0
+        # Risco
+        risco_map = {
+            'risco habitual': 'Risco Habitual', 'habitual': 'Risco Habitual',
+            'médio risco': 'Risco Intermediário', 'risco intermediário': 'Risco Intermediário',
+            'alto risco': 'Risco Alto', 'risco alto': 'Risco Alto'
+        }
+        for valor, total in agregados.get('risco', {}).items():
+            risco_counts[risco_map.get(valor.lower(), 'Não informado')] += total
+
+        # === 11. MÉDIA DA PONTUAÇÃO ===
+        soma_pontuacao = agregados.get('pontuacao_soma', {}).get('', 0)
+        qtd_pontuacao = agregados.get('pontuacao_n', {}).get('', 0)
+        media_pontuacao = round(soma_pontuacao / qtd_pontuacao, 1) if qtd_pontuacao else 0.0
 
         # === 12. PORCENTAGENS FINAIS ===
         def fmt(counter, total):
@@ -3882,10 +3650,6 @@ def admin_relatorio():
         risco_alt = risco_counts.get('Risco Alto', 0)
 
 # === CORREÇÃO FINAL: PORCENTAGEM ENTRE AS INDÍGENAS (100% se só tiver uma) ===
-        total_indigenas = len([r for r in ultimos_registros 
-                              if r.get('etnia_indigena') and str(r.get('etnia_indigena')).strip() 
-                              and str(r.get('etnia_indigena')).strip() not in ['', 'Não indígena', 'Não informado']])
-
         etnia_final_fmt = {}
         for nome, qtd in etnia_indigena_final.items():
             porcentagem = round(qtd / total_indigenas * 100, 1) if total_indigenas > 0 else 0.0
@@ -3897,8 +3661,7 @@ def admin_relatorio():
         # === 13. ESTATÍSTICAS FINAIS ===
         estatisticas = {
             'total_registros': total_gestantes_ativas,
-            'total_registros_filtrados': len(todos_registros),
-            'municipios_unicos': len({r['municipio'] for r in ultimos_registros if r['municipio']}),
+            'municipios_unicos': sum(1 for dimensoes in agregados_municipio.values() if dimensoes.get('ativas')),
             'periodo_gestacional': dict(periodo_gestacional),
             'genero_counts': fmt(genero_counts, total_gestantes_ativas),
             'sexualidade_counts': fmt(sexualidade_counts, total_gestantes_ativas),
@@ -3922,13 +3685,15 @@ def admin_relatorio():
             'desfecho_counts': dict(desfechos_distintos),
             'total_desfechos': sum(desfechos_distintos.values()),
             'fora_area_count': fora_de_area_distinto,
-            'total_gestantes_distintas': len(vista)
+            'total_gestantes_distintas': total_gestantes_distintas
         }
 
         conn.close()
         return render_template('admin_relatorio.html',
                                municipios=municipios,
-                               registros=todos_registros,
+                               registros=pagina.itens,
+                               pagina=pagina,
+                               page=page,
                                filtro_municipio=filtro_municipio,
                                filtro_data_inicio=filtro_data_inicio,
                                filtro_data_fim=filtro_data_fim,
@@ -3936,6 +3701,7 @@ def admin_relatorio():
                                is_super_admin=is_super_admin,
                                user_role=user_role,
                                full_name=full_name,
+                               atualizacao=atualizacao_relatorio(),
                                current_user={'role': user_role, 'name': full_name})
 
     except Exception as e:
@@ -3945,6 +3711,64 @@ def admin_relatorio():
         flash('Erro ao gerar relatório. Tente novamente.', 'error')
         return redirect(url_for('calculadora'))
 
+# Rótulos dos itens de cada seção na exportação (o relatório em tela mostra o JSON cru)
+SECOES_RELATORIO_MAPS = {
+    'caracteristicas': CARACTERISTICAS_MAP,
+    'avaliacao_nutricional': AVALIACAO_NUTRICIONAL_MAP,
+    'comorbidades': COMORBIDADES_MAP,
+    'historia_obstetrica': HISTORIA_OBSTETRICA_MAP,
+    'condicoes_gestacionais': CONDICOES_GESTACIONAIS_MAP,
+}
+
+ROTULOS_EXPORTACAO = dict(ROTULOS_RELATORIO, **{
+    secao: (lambda valor, mapa=mapa: '; '.join(mapa.get(codigo, codigo) for codigo in decodificar_secao(valor)))
+    for secao, mapa in SECOES_RELATORIO_MAPS.items()
+})
+
+@app.route('/admin/relatorio/exportar', methods=['GET'])
+@admin_required
+def admin_relatorio_exportar():
+    """Exporta os registros do relatório (mesmos filtros e escopo) em CSV ou XLSX, em streaming."""
+    formato = (request.args.get('formato') or 'csv').lower()
+    if formato not in EXPORTACAO_FORMATOS:
+        return jsonify({'success': False, 'message': 'Formato inválido. Use csv ou xlsx.'}), 400
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    user = usuario_logado(USUARIOS)
+    if not user:
+        return jsonify({'success': False, 'message': 'Usuário não encontrado.'}), 404
+    leitura = get_db_leitura().cursor()
+    escopo = escopo_relatorio(cursor, user, leitura)
+    if escopo['municipio_negado']:
+        return jsonify({'success': False, 'message': 'Acesso negado ao município.'}), 403
+    tabela = tabela_fichas(leitura, escopo['data_inicio_iso'])
+    sql = f"SELECT * FROM {tabela} {escopo['where_full']} ORDER BY data_envio_iso DESC, id DESC"
+    params = escopo['params']
+
+    def registros():
+        # Conexão própria: a da requisição volta ao pool antes de a resposta terminar de ser enviada.
+        # Lê da cópia de relatórios quando ela está em dia, como a página do relatório
+        copia = abrir_copia()
+        conn_exportacao = copia[0] if copia else db_pool.adquirir()
+        try:
+            cursor_exportacao = conn_exportacao.cursor()
+            cursor_exportacao.row_factory = fabrica_fichas(ROTULOS_EXPORTACAO)
+            cursor_exportacao.execute(sql, params)
+            while True:
+                linhas = cursor_exportacao.fetchmany(500)
+                if not linhas:
+                    break
+                yield from linhas
+        finally:
+            conn_exportacao.close()
+
+    gerador = csv_em_blocos(registros()) if formato == 'csv' else xlsx_em_blocos(registros())
+    nome_arquivo = f"relatorio_administrativo_{datetime.now().strftime('%Y%m%d_%H%M')}.{formato}"
+    logging.info(f"Exportação do relatório ({formato}) pelo usuário {session['user_id']}")
+    return Response(gerador, content_type=EXPORTACAO_FORMATOS[formato],
+                    headers={'Content-Disposition': f'attachment; filename="{nome_arquivo}"'})
+
 @app.route('/gerar_pdf/<code>')
 def gerar_pdf(code):
     if 'user_id' not in session:
@@ -3958,14 +3782,14 @@ def gerar_pdf(code):
 
         # Consulta com verificação de permissão
         if session.get('role') in ['municipal', 'estadual']:
-            cursor.execute('SELECT * FROM calculos WHERE codigo_ficha = ?', (code,))
+            cursor.execute(f'SELECT * FROM {FICHAS} WHERE codigo_ficha = ?', (code,))
         else:
-            cursor.execute('SELECT * FROM calculos WHERE codigo_ficha = ? AND user_id = ?', 
+            cursor.execute(f'SELECT * FROM {FICHAS} WHERE codigo_ficha = ? AND user_id = ?', 
                            (code, session['user_id']))
         ficha = cursor.fetchone()
 
         if not ficha:
-            cursor.execute('SELECT * FROM calculos WHERE codigo_ficha = ?', (code,))
+            cursor.execute(f'SELECT * FROM {FICHAS} WHERE codigo_ficha = ?', (code,))
             if cursor.fetchone():
                 logging.warning(f"Ficha {code} existe, mas usuário {session['user_id']} não tem acesso")
             else:
@@ -3995,16 +3819,7 @@ def gerar_pdf(code):
             try:
                 raw_value = ficha_dict.get(campo)
                 logging.debug(f"Processando {campo} com valor bruto: {raw_value} (tipo: {type(raw_value)})")
-                items = []
-                if raw_value and isinstance(raw_value, str) and raw_value.strip():
-                    try:
-                        items = json.loads(raw_value)
-                        if not isinstance(items, list):
-                            items = [items] if items else []
-                        items = [str(item).strip() for item in items if item and str(item).strip()]
-                    except json.JSONDecodeError as e:
-                        logging.warning(f"JSON inválido para {campo}: {raw_value} - {str(e)}")
-                        items = [raw_value.strip()] if raw_value.strip() else []
+                items = decodificar_secao(raw_value) if isinstance(raw_value, str) else ()
                 
                 # PROCESSAMENTO ESPECIAL: SUBMENU EM UMA LINHA
                 mapped_items = []
@@ -4032,7 +3847,7 @@ def gerar_pdf(code):
         mapped_data['genero'] = [map_item('genero', ficha_dict.get('genero', 'nao_informado'))]
         mapped_data['sexualidade'] = [map_item('sexualidade', ficha_dict.get('sexualidade', 'nao_informado'))]
         mapped_data['raca_cor_etnia'] = [map_item('raca_cor_etnia', ficha_dict.get('raca_cor_etnia', 'nao_informado'))]
-        mapped_data['etnia_indigena'] = [get_etnia_nome(ficha_dict.get('etnia_indigena', ''))]
+        mapped_data['etnia_indigena'] = [nome_etnia(ficha_dict.get('etnia_indigena', ''))]
         mapped_data['deficiencia'] = [DEFICIENCIA_MAP.get(ficha_dict.get('deficiencia', 'Não'), 'Não informado')]  # ✅ Novo mapeamento
 
         # Determinar rótulos dinâmicos para UBS e ACS
@@ -0,0 +1,105 @@
+import os
+import time
+from datetime import date, timedelta
+
+# Fichas encerradas (com desfecho ou fora de área) e antigas saem de calculos para
+# calculos_arquivo, mantendo o mesmo id. As telas do dia a dia (histórico, PNAR, lotes) só
+# leem calculos, que fica pequena; quem precisa de tudo (agregados, gestantes, PDF por código)
+# lê a visão calculos_completo, e os relatórios só incluem o arquivo quando o período pedido
+# alcança fichas arquivadas (tabela_fichas).
+FICHAS = 'calculos_completo'
+
+IDADE_DIAS = int(os.environ.get('ARQUIVO_IDADE_DIAS', '365'))
+LOTE = 500
+
+ENCERRADA = '(desfecho IS NOT NULL OR fa = 1)'
+
+SQL_INDICES = [
+    'CREATE INDEX IF NOT EXISTS idx_calculos_arquivo_codigo_ficha ON calculos_arquivo(codigo_ficha)',
+    'CREATE INDEX IF NOT EXISTS idx_calculos_arquivo_gestante_id ON calculos_arquivo(gestante_id, id)',
+    'CREATE INDEX IF NOT EXISTS idx_calculos_arquivo_cpf ON calculos_arquivo(cpf, data_envio_iso)',
+    'CREATE INDEX IF NOT EXISTS idx_calculos_arquivo_envio ON calculos_arquivo(data_envio_iso, id)',
+    'CREATE INDEX IF NOT EXISTS idx_calculos_arquivo_municipio ON calculos_arquivo(municipio, data_envio_iso)',
+]
+
+
+def _colunas(cursor, tabela):
+    return [(row[1], row[2]) for row in cursor.execute(f'PRAGMA table_info({tabela})').fetchall()]
+
+
+def garantir_arquivo(cursor):
+    """Cria/acompanha calculos_arquivo com as colunas de calculos e recria a visão calculos_completo.
+
+    Migrações que acrescentarem colunas em calculos devem chamar esta função de novo.
+    """
+    colunas = _colunas(cursor, 'calculos')
+    cursor.execute('CREATE TABLE IF NOT EXISTS calculos_arquivo (id INTEGER PRIMARY KEY)')
+    existentes = {nome for nome, _ in _colunas(cursor, 'calculos_arquivo')}
+    for nome, tipo in colunas:
+        if nome not in existentes:
+            cursor.execute(f'ALTER TABLE calculos_arquivo ADD COLUMN {nome} {tipo}')
+    for sql in SQL_INDICES:
+        cursor.execute(sql)
+
+    lista = ', '.join(nome for nome, _ in colunas)
+    cursor.execute(f'DROP VIEW IF EXISTS {FICHAS}')
+    cursor.execute(f'''
+        CREATE VIEW {FICHAS} AS
+        SELECT {lista} FROM calculos
+        UNION ALL
+        SELECT {lista} FROM calculos_arquivo
+    ''')
+
+
+def horizonte_arquivo(cursor):
+    """Data de envio (ISO) da ficha arquivada mais recente; None com o arquivo vazio."""
+    row = cursor.execute('SELECT MAX(data_envio_iso) FROM calculos_arquivo').fetchone()
+    return row[0] if row else None
+
+
+def tabela_fichas(cursor, data_inicio_iso=None):
+    """Tabela de fichas para um relatório que começa em data_inicio_iso (None = desde sempre)."""
+    horizonte = horizonte_arquivo(cursor)
+    if horizonte is None or (data_inicio_iso and data_inicio_iso > horizonte):
+        return 'calculos'
+    return FICHAS
+
+
+def arquivar_fichas(conn, idade_dias=IDADE_DIAS, lote=LOTE):
+    """Move para calculos_arquivo as fichas encerradas enviadas há mais de idade_dias dias.
+
+    Cada lote é uma transação curta (BEGIN IMMEDIATE) para não segurar o lock de escrita.
+    conn deve estar em autocommit (isolation_level=None). Agregados e gestantes não mudam:
+    eles leem calculos_completo. Retorna {'arquivadas', 'corte', 'duracao_ms'}.
+    """
+    inicio = time.perf_counter()
+    corte = (date.today() - timedelta(days=idade_dias)).isoformat()
+    lista = ', '.join(nome for nome, _ in _colunas(conn, 'calculos'))
+    arquivadas = 0
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ids = [row[0] for row in conn.execute(f'''
+                SELECT id FROM calculos
+                WHERE data_envio_iso < ? AND {ENCERRADA}
+                ORDER BY id LIMIT ?
+            ''', (corte, lote)).fetchall()]
+            if ids:
+                placeholders = ','.join(['?'] * len(ids))
+                conn.execute(f'''
+                    INSERT INTO calculos_arquivo ({lista})
+                    SELECT {lista} FROM calculos WHERE id IN ({placeholders})
+                ''', ids)
+                conn.execute(f'DELETE FROM calculos WHERE id IN ({placeholders})', ids)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        arquivadas += len(ids)
+        if len(ids) < lote:
+            break
+    return {
+        'arquivadas': arquivadas,
+        'corte': corte,
+        'duracao_ms': round((time.perf_counter() - inicio) * 1000, 1),
+    }
@@ -0,0 +1,218 @@
+import gc
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import threading
+import tracemalloc
+from datetime import date, timedelta
+
+import bcrypt
+
+from ficha_registro import fabrica_fichas
+from init_db import migrar
+from senhas import ROUNDS, verificar_senha
+
+# Medições reproduzíveis das rotas pesadas, rodadas sobre um banco sintético temporário
+# (python gerenciar.py benchmark ...). Nada aqui toca o banco de produção.
+
+# Campos que a tabela de admin_relatorio.html lê de cada registro
+CAMPOS_TABELA = (
+    'user_id', 'codigo_ficha', 'nome_gestante', 'genero', 'sexualidade', 'raca_cor_etnia', 'etnia_indigena',
+    'deficiencia', 'data_nasc', 'telefone', 'municipio', 'ubs', 'acs', 'periodo_gestacional', 'data_envio',
+    'pontuacao_total', 'classificacao_risco', 'imc', 'caracteristicas', 'avaliacao_nutricional', 'comorbidades',
+    'historia_obstetrica', 'condicoes_gestacionais', 'desfecho', 'profissional', 'fa', 'pdf_compartilhado_municipal',
+)
+
+_MUNICIPIOS = ('João Pessoa', 'Campina Grande', 'Santa Rita', 'Patos', 'Bayeux', 'Sousa', 'Cajazeiras', 'Guarabira')
+_RISCOS = ('Risco Habitual', 'Risco Intermediário', 'Risco Alto')
+_GENEROS = ('mulher_cisgenero', 'mulher_cisgenero', 'homem_trans', 'pessoa_nao_binaria', 'nao_informado', '')
+_SEXUALIDADES = ('heterossexual', 'heterossexual', 'homossexual', 'bissexual', 'nao_informado', '')
+_RACAS = ('branca', 'preta', 'parda', 'indigena', 'amarela', '')
+
+
+def popular_fichas(caminho, linhas, semente=1):
+    """Cria o schema em caminho e grava `linhas` fichas sintéticas em calculos."""
+    migrar(caminho)
+    aleatorio = random.Random(semente)
+    inicio = date.today() - timedelta(days=730)
+
+    def secao(maximo):
+        return json.dumps(sorted({str(aleatorio.randint(1, 12)) for _ in range(aleatorio.randint(0, maximo))}))
+
+    def ficha(numero):
+        envio = inicio + timedelta(days=aleatorio.randint(0, 729))
+        return (
+            aleatorio.randint(1, 200), f'F{numero:08d}', f'Gestante Sintética {numero}',
+            f'{aleatorio.randint(1, 28):02d}/{aleatorio.randint(1, 12):02d}/{aleatorio.randint(1980, 2008)}',
+            f'{aleatorio.randint(0, 99999999999):011d}', f'83 9{aleatorio.randint(0, 99999999):08d}',
+            aleatorio.choice(_MUNICIPIOS), f'UBS {aleatorio.randint(1, 40)}', f'ACS {aleatorio.randint(1, 300)}',
+            aleatorio.choice(('1º trimestre', '2º trimestre', '3º trimestre')),
+            envio.strftime('%d/%m/%Y'), envio.isoformat(), str(aleatorio.randint(0, 40)), aleatorio.choice(_RISCOS),
+            f'{aleatorio.uniform(17, 40):.1f}', secao(4), secao(2), secao(3), secao(3), secao(2),
+            f'Profissional {aleatorio.randint(1, 150)}', aleatorio.choice((None, None, None, '1', '2')),
+            aleatorio.choice((0, 0, 0, 1)), aleatorio.choice(('sim', 'não', '')), aleatorio.choice(_GENEROS),
+            aleatorio.choice(_SEXUALIDADES), aleatorio.choice(_RACAS),
+            aleatorio.choice(('', '', '', 'nao_declarar', '0057', '0232')), aleatorio.choice((0, 1)),
+        )
+
+    conn = sqlite3.connect(caminho)
+    try:
+        conn.executemany('''
+            INSERT INTO calculos (user_id, codigo_ficha, nome_gestante, data_nasc, cpf, telefone, municipio, ubs, acs,
+                                  periodo_gestacional, data_envio, data_envio_iso, pontuacao_total, classificacao_risco,
+                                  imc, caracteristicas, avaliacao_nutricional, comorbidades, historia_obstetrica,
+                                  condicoes_gestacionais, profissional, desfecho, fa, deficiencia, genero, sexualidade,
+                                  raca_cor_etnia, etnia_indigena, pdf_compartilhado_municipal)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (ficha(numero) for numero in range(1, linhas + 1)))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _registros_dict(conn, sql, rotulos):
+    # Caminho anterior do relatório: um dict por linha, rótulos aplicados no lugar
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    registros = [dict(row) for row in cursor.execute(sql).fetchall()]
+    for r in registros:
+        for campo, rotulo in rotulos.items():
+            r[campo] = rotulo(r.get(campo))
+    return registros
+
+
+def _registros_ficha(conn, sql, rotulos):
+    cursor = conn.cursor()
+    cursor.row_factory = fabrica_fichas(rotulos)
+    return cursor.execute(sql).fetchall()
+
+
+def _ler_tabela(registros):
+    # O que o template faz com cada linha: lê todos os campos exibidos
+    for registro in registros:
+        for campo in CAMPOS_TABELA:
+            registro[campo]
+
+
+def medir_relatorio(linhas=100000, rotulos=None, repeticoes=3, caminho=None):
+    """Tempo e memória da listagem de admin_relatorio com dicts e com Fichas, sobre `linhas` fichas.
+
+    Retorna {modo: {'carga_ms', 'tabela_ms', 'total_ms', 'memoria_mb', 'pico_mb'}}; os tempos são o
+    melhor de `repeticoes` execuções e a memória é medida com tracemalloc numa execução à parte.
+    """
+    rotulos = rotulos or {}
+    temporario = None
+    if caminho is None:
+        descritor, temporario = tempfile.mkstemp(prefix='benchmark_relatorio.', suffix='.db')
+        os.close(descritor)
+        popular_fichas(temporario, linhas)
+        caminho = temporario
+    sql = 'SELECT * FROM calculos ORDER BY data_envio_iso DESC, id DESC'
+    resultado = {}
+    try:
+        conn = sqlite3.connect(caminho)
+        try:
+            for modo, carregar in (('dict', _registros_dict), ('ficha', _registros_ficha)):
+                carga = tabela = float('inf')
+                for _ in range(repeticoes):
+                    gc.collect()
+                    inicio = time.perf_counter()
+                    registros = carregar(conn, sql, rotulos)
+                    meio = time.perf_counter()
+                    _ler_tabela(registros)
+                    fim = time.perf_counter()
+                    carga, tabela = min(carga, meio - inicio), min(tabela, fim - meio)
+                    del registros
+
+                gc.collect()
+                tracemalloc.start()
+                try:
+                    registros = carregar(conn, sql, rotulos)
+                    _ler_tabela(registros)
+                    memoria, pico = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+                total = len(registros)
+                del registros
+
+                resultado[modo] = {
+                    'registros': total,
+                    'carga_ms': round(carga * 1000, 1),
+                    'tabela_ms': round(tabela * 1000, 1),
+                    'total_ms': round((carga + tabela) * 1000, 1),
+                    'memoria_mb': round(memoria / 2 ** 20, 1),
+                    'pico_mb': round(pico / 2 ** 20, 1),
+                }
+        finally:
+            conn.close()
+    finally:
+        if temporario:
+            for sufixo in ('', '-wal', '-shm'):
+                try:
+                    os.remove(temporario + sufixo)
+                except OSError:
+                    pass
+    return resultado
+
+
+def _percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))] if ordenados else 0.0
+
+
+def _verificar_inline(senha, senha_hash):
+    # Caminho anterior do login: bcrypt na própria thread da requisição
+    return bcrypt.checkpw(senha.encode('utf-8'), senha_hash.encode('utf-8'))
+
+
+def medir_login(tentativas=64, concorrencia=8, rounds=ROUNDS):
+    """Rajada de logins: `concorrencia` threads verificando `tentativas` senhas no total.
+
+    Compara bcrypt na thread da requisição com o pool de senhas.py. Enquanto a rajada dura, uma
+    thread faz uma requisição leve (um pouco de Python puro) a cada 5 ms, para medir quanto o
+    resto do worker espera. Retorna {modo: {'logins_s', 'p50_ms', 'p95_ms', 'leve_p95_ms'}}.
+    """
+    senha = 'senha-de-teste'
+    senha_hash = bcrypt.hashpw(senha.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+    resultado = {}
+    for modo, verificar in (('inline', _verificar_inline), ('pool', verificar_senha)):
+        verificar(senha, senha_hash)   # aquece (pool criado fora da medição)
+        latencias, leves = [], []
+        fim_rajada = threading.Event()
+
+        def requisicao_leve():
+            while not fim_rajada.is_set():
+                inicio = time.perf_counter()
+                sum(range(2000))
+                leves.append(time.perf_counter() - inicio)
+                time.sleep(0.005)
+
+        def requisitante(quantidade):
+            for _ in range(quantidade):
+                inicio = time.perf_counter()
+                assert verificar(senha, senha_hash)
+                latencias.append(time.perf_counter() - inicio)
+
+        por_thread = [tentativas // concorrencia + (1 if i < tentativas % concorrencia else 0) for i in range(concorrencia)]
+        leve = threading.Thread(target=requisicao_leve)
+        threads = [threading.Thread(target=requisitante, args=(quantidade,)) for quantidade in por_thread]
+        leve.start()
+        inicio = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duracao = time.perf_counter() - inicio
+        fim_rajada.set()
+        leve.join()
+
+        resultado[modo] = {
+            'logins_s': round(tentativas / duracao, 1),
+            'p50_ms': round(_percentil(latencias, 0.5) * 1000, 1),
+            'p95_ms': round(_percentil(latencias, 0.95) * 1000, 1),
+            'leve_p95_ms': round(_percentil(leves, 0.95) * 1000, 2),
+        }
+    return resultado
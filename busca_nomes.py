@@ -0,0 +1,84 @@
+import re
+import sqlite3
+
+# Índices FTS5 de nomes (gestantes em calculos, profissionais em usuarios).
+# unicode61 remove_diacritics 2: "joao" encontra "João"; prefix='2 3' acelera o autocomplete.
+# São tabelas de conteúdo externo: guardam só o índice, o texto continua na tabela original,
+# e os triggers abaixo mantêm os dois em sincronia.
+_TOKENIZER = "unicode61 remove_diacritics 2"
+
+INDICES_FTS = (
+    # (tabela FTS, tabela de origem, coluna)
+    ('calculos_nome_fts', 'calculos', 'nome_gestante'),
+    ('usuarios_nome_fts', 'usuarios', 'nome'),
+)
+
+
+def _fts5_disponivel():
+    try:
+        conn = sqlite3.connect(':memory:')
+        conn.execute(f"CREATE VIRTUAL TABLE teste USING fts5(x, tokenize='{_TOKENIZER}')")
+        conn.close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+FTS5_DISPONIVEL = _fts5_disponivel()
+
+
+def criar_indices_fts(cursor):
+    if not FTS5_DISPONIVEL:
+        print("⚠️ SQLite sem FTS5: busca por nome continua usando LIKE.")
+        return
+    for fts, tabela, coluna in INDICES_FTS:
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                {coluna}, content='{tabela}', content_rowid='id',
+                tokenize='{_TOKENIZER}', prefix='2 3'
+            )
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {tabela} BEGIN
+                INSERT INTO {fts}(rowid, {coluna}) VALUES (new.id, new.{coluna});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {tabela} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {coluna}) VALUES ('delete', old.id, old.{coluna});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {coluna} ON {tabela} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {coluna}) VALUES ('delete', old.id, old.{coluna});
+                INSERT INTO {fts}(rowid, {coluna}) VALUES (new.id, new.{coluna});
+            END
+        ''')
+        cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+        print(f"Índice de busca '{fts}' verificado/reconstruído.")
+
+
+def termo_fts(texto):
+    """Converte o texto digitado em consulta FTS5: todas as palavras, cada uma como prefixo.
+
+    'joao sil' -> '"joao"* "sil"*'. Retorna None se não houver palavra pesquisável.
+    """
+    palavras = re.findall(r'\w+', texto or '')
+    if not palavras:
+        return None
+    return ' '.join(f'"{palavra}"*' for palavra in palavras)
+
+
+def filtro_nome(fts, coluna_id, texto):
+    """Trecho SQL + parâmetros para filtrar por nome (FTS5 se houver, senão LIKE).
+
+    Ex.: filtro_nome('calculos_nome_fts', 'id', 'joao') ->
+         ('id IN (SELECT rowid FROM calculos_nome_fts WHERE calculos_nome_fts MATCH ?)', ['"joao"*'])
+    """
+    if FTS5_DISPONIVEL:
+        termo = termo_fts(texto)
+        if termo is None:
+            return '0', []
+        return f'{coluna_id} IN (SELECT rowid FROM {fts} WHERE {fts} MATCH ?)', [termo]
+    coluna = next(coluna for nome, _, coluna in INDICES_FTS if nome == fts)
+    return f'lower({coluna}) LIKE ?', [f'%{texto.lower()}%']
@@ -0,0 +1,167 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Caminho do banco (mesmo arquivo usado por init_db.criar_banco)
+DB_PATH = 'banco.db'
+
+# PRAGMAs aplicados a cada conexão nova do pool
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+PRAGMAS = (
+    ('journal_mode', 'WAL'),                       # leitores não bloqueiam o escritor
+    ('busy_timeout', BUSY_TIMEOUT_MS),             # espera pelo lock em vez de "database is locked"
+    ('synchronous', 'NORMAL'),                     # seguro em WAL, fsync só no checkpoint
+    ('cache_size', -int(os.environ.get('DB_CACHE_KB', 16000))),       # em KiB (valor negativo)
+    ('mmap_size', int(os.environ.get('DB_MMAP_BYTES', 256 * 1024 * 1024))),
+    ('temp_store', 'MEMORY'),
+)
+
+# Máximo de conexões ociosas guardadas por processo (worker)
+MAX_OCIOSAS = int(os.environ.get('DB_POOL_MAX_IDLE', 8))
+
+
+class ConexaoPool:
+    """Envoltório de sqlite3.Connection que devolve a conexão ao pool em vez de fechá-la.
+
+    Quando a conexão pertence a uma requisição (escopo_requisicao=True), close() apenas
+    descarta a transação pendente, como faria um close() real; a devolução ao pool
+    acontece no teardown da requisição.
+    """
+
+    __slots__ = ('_conn', '_pool', '_pid', 'escopo_requisicao')
+
+    def __init__(self, conn, pool, escopo_requisicao=False):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_pid', os.getpid())
+        object.__setattr__(self, 'escopo_requisicao', escopo_requisicao)
+
+    def __getattr__(self, nome):
+        return getattr(self._conn, nome)
+
+    def __setattr__(self, nome, valor):
+        if nome in ConexaoPool.__slots__:
+            object.__setattr__(self, nome, valor)
+        else:
+            setattr(self._conn, nome, valor)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self):
+        if self.escopo_requisicao:
+            if self._conn.in_transaction:
+                self._conn.rollback()
+            return
+        self._pool.devolver(self)
+
+
+class PoolConexoes:
+    """Pool de conexões SQLite por processo, reutilizadas entre requisições."""
+
+    def __init__(self, caminho=DB_PATH, pragmas=PRAGMAS, max_ociosas=MAX_OCIOSAS):
+        self.caminho = caminho
+        self.pragmas = pragmas
+        self.max_ociosas = max_ociosas
+        self._ociosas = []
+        self._lock = threading.Lock()
+        self._stats = {
+            'aquisicoes': 0,
+            'reaproveitadas': 0,   # conexão ociosa do pool
+            'reusos_requisicao': 0,  # mesma conexão pedida de novo na requisição
+            'abertas': 0,          # sqlite3.connect() efetivamente executados
+            'fechadas': 0,
+            'devolvidas': 0,
+            'tempo_aquisicao_total_ms': 0.0,
+            'tempo_aquisicao_max_ms': 0.0,
+        }
+
+    def _abrir(self):
+        conn = sqlite3.connect(self.caminho, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma, valor in self.pragmas:
+            conn.execute(f'PRAGMA {pragma} = {valor}')
+        return conn
+
+    def adquirir(self, escopo_requisicao=False):
+        inicio = time.perf_counter()
+        conn = None
+        pid = os.getpid()
+        with self._lock:
+            while self._ociosas:
+                candidata = self._ociosas.pop()
+                if candidata._pid == pid:
+                    conn = candidata
+                    self._stats['reaproveitadas'] += 1
+                    break
+                # Conexão herdada de antes do fork do worker: não pode ser usada aqui
+                self._stats['fechadas'] += 1
+        if conn is None:
+            conn = ConexaoPool(self._abrir(), self)
+            with self._lock:
+                self._stats['abertas'] += 1
+        conn.escopo_requisicao = escopo_requisicao
+        decorrido = (time.perf_counter() - inicio) * 1000
+        with self._lock:
+            self._stats['aquisicoes'] += 1
+            self._stats['tempo_aquisicao_total_ms'] += decorrido
+            self._stats['tempo_aquisicao_max_ms'] = max(self._stats['tempo_aquisicao_max_ms'], decorrido)
+        return conn
+
+    def registrar_reuso(self):
+        with self._lock:
+            self._stats['reusos_requisicao'] += 1
+
+    def devolver(self, conn):
+        bruta = conn._conn
+        try:
+            if bruta.in_transaction:
+                bruta.rollback()
+            bruta.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            # Conexão em estado inválido: descarta
+            self._fechar(bruta)
+            return
+        conn.escopo_requisicao = False
+        with self._lock:
+            self._stats['devolvidas'] += 1
+            if conn._pid == os.getpid() and len(self._ociosas) < self.max_ociosas:
+                self._ociosas.append(conn)
+                return
+        self._fechar(bruta)
+
+    def _fechar(self, bruta):
+        try:
+            bruta.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._stats['fechadas'] += 1
+
+    def fechar_todas(self):
+        with self._lock:
+            ociosas, self._ociosas = self._ociosas, []
+        for conn in ociosas:
+            self._fechar(conn._conn)
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['ociosas'] = len(self._ociosas)
+        pedidos = stats['aquisicoes'] + stats['reusos_requisicao']
+        stats['taxa_acerto'] = round(
+            (stats['reaproveitadas'] + stats['reusos_requisicao']) / pedidos, 4) if pedidos else 0.0
+        stats['tempo_aquisicao_medio_ms'] = round(
+            stats['tempo_aquisicao_total_ms'] / stats['aquisicoes'], 4) if stats['aquisicoes'] else 0.0
+        stats['tempo_aquisicao_total_ms'] = round(stats['tempo_aquisicao_total_ms'], 3)
+        stats['tempo_aquisicao_max_ms'] = round(stats['tempo_aquisicao_max_ms'], 3)
+        stats['pid'] = os.getpid()
+        return stats
+
+
+pool = PoolConexoes()
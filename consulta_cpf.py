@@ -0,0 +1,122 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from ficha_itens import SECOES, decodificar_secao
+from fichas import CPF_NAO_INFORMADO
+
+# Última ficha de um CPF para o preenchimento da calculadora (buscar_por_cpf, chamado a cada CPF
+# digitado). As fichas gravam o CPF só com dígitos; o índice (cpf, data_envio_iso) de calculos e o
+# de calculos_arquivo respondem "a mais recente" com um LIMIT 1 em cada tabela, sem ordenar nada.
+# O resultado (inclusive "não encontrado") fica num LRU do worker por até TTL_S segundos;
+# salvar_calculadora, a sincronização e a importação invalidam os CPFs que gravam.
+MAXIMO = int(os.environ.get('CPF_CACHE_MAXIMO', 2048))
+TTL_S = float(os.environ.get('CPF_CACHE_TTL_S', 60))
+
+# Só o que a calculadora preenche (preencherComUltimaFicha), além de código e data para referência
+CAMPOS = ('codigo_ficha', 'data_envio', 'periodo_gestacional', 'imc') + SECOES
+
+SQL_INDICE = 'CREATE INDEX IF NOT EXISTS idx_calculos_cpf_envio ON calculos(cpf, data_envio_iso)'
+
+_SEM_PONTUACAO = "replace(replace(replace(cpf, '.', ''), '-', ''), ' ', '')"
+
+_trava = threading.Lock()
+_cache = OrderedDict()   # cpf -> (expira_em, ficha ou None)
+_stats = {'acertos': 0, 'falhas': 0, 'invalidacoes': 0}
+_geracao = [0]           # muda a cada invalidação: leitura feita antes dela não entra no cache
+
+
+def normalizar_cpf(cpf):
+    """CPF só com os 11 dígitos; None se não for um CPF (ou for o de "não informado")."""
+    digitos = re.sub(r'\D', '', cpf or '')
+    if len(digitos) != 11 or digitos == re.sub(r'\D', '', CPF_NAO_INFORMADO):
+        return None
+    return digitos
+
+
+def normalizar_cpfs(cursor):
+    """Regrava só com dígitos os CPFs formatados de fichas antigas; devolve quantas mudaram."""
+    alteradas = 0
+    for tabela in ('calculos', 'calculos_arquivo'):
+        cursor.execute(f'''
+            UPDATE {tabela} SET cpf = {_SEM_PONTUACAO}
+            WHERE cpf GLOB '*[^0-9]*' AND cpf <> ?
+              AND length({_SEM_PONTUACAO}) = 11 AND {_SEM_PONTUACAO} NOT GLOB '*[^0-9]*'
+        ''', (CPF_NAO_INFORMADO,))
+        alteradas += cursor.rowcount
+    return alteradas
+
+
+def ultima_ficha(cursor, cpf):
+    """Campos de preenchimento da ficha mais recente (data de envio, depois id) do CPF; None se não houver."""
+    colunas = ', '.join(CAMPOS)
+    row = cursor.execute(f'''
+        SELECT {colunas} FROM (
+            SELECT * FROM (SELECT {colunas}, data_envio_iso, id FROM calculos WHERE cpf = ?
+                           ORDER BY data_envio_iso DESC, id DESC LIMIT 1)
+            UNION ALL
+            SELECT * FROM (SELECT {colunas}, data_envio_iso, id FROM calculos_arquivo WHERE cpf = ?
+                           ORDER BY data_envio_iso DESC, id DESC LIMIT 1)
+        )
+        ORDER BY data_envio_iso DESC, id DESC LIMIT 1
+    ''', (cpf, cpf)).fetchone()
+    if row is None:
+        return None
+    ficha = dict(zip(CAMPOS, row))
+    for secao in SECOES:
+        ficha[secao] = list(decodificar_secao(ficha[secao]))
+    return ficha
+
+
+def buscar_ultima_ficha(conectar, cpf, ttl=TTL_S):
+    """ultima_ficha pelo cache do worker; lê do banco com conectar() quando ausente ou vencido.
+
+    cpf já normalizado (normalizar_cpf). Devolve uma cópia: quem chama pode alterá-la.
+    """
+    agora = time.monotonic()
+    with _trava:
+        guardado = _cache.get(cpf)
+        if guardado and guardado[0] > agora:
+            _cache.move_to_end(cpf)
+            _stats['acertos'] += 1
+            return _copia(guardado[1])
+        _stats['falhas'] += 1
+        geracao = _geracao[0]
+    ficha = ultima_ficha(conectar().cursor(), cpf)
+    with _trava:
+        if geracao == _geracao[0]:
+            _cache[cpf] = (agora + ttl, ficha)
+            _cache.move_to_end(cpf)
+            while len(_cache) > MAXIMO:
+                _cache.popitem(last=False)
+    return _copia(ficha)
+
+
+def _copia(ficha):
+    if ficha is None:
+        return None
+    copia = dict(ficha)
+    for secao in SECOES:
+        copia[secao] = list(ficha[secao])
+    return copia
+
+
+def invalidar_cpf(*cpfs):
+    """Descarta do cache os CPFs informados (formatados ou não); sem argumentos, todos."""
+    with _trava:
+        _stats['invalidacoes'] += 1
+        _geracao[0] += 1
+        if not cpfs:
+            _cache.clear()
+            return
+        for cpf in cpfs:
+            _cache.pop(normalizar_cpf(cpf), None)
+
+
+def estatisticas_cache():
+    with _trava:
+        consultas = _stats['acertos'] + _stats['falhas']
+        return dict(_stats, tamanho=len(_cache), maximo=MAXIMO, ttl_s=TTL_S,
+                    taxa_acerto=round(_stats['acertos'] / consultas, 4) if consultas else 0.0)
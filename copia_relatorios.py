@@ -0,0 +1,118 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from conexao_db import BUSY_TIMEOUT_MS, DB_PATH
+
+# Cópia somente leitura do banco para os relatórios pesados (admin_relatorio, saude_indigena,
+# monitoramento e exportação), gerada com a API de backup do SQLite. A cópia é escrita num
+# arquivo temporário e trocada com os.replace: quem já está lendo continua com o arquivo antigo
+# e ninguém lê uma cópia pela metade. Em WAL o backup só abre uma transação de leitura, então
+# salvar_calculadora não espera por ele.
+COPIA_PATH = os.environ.get('DB_COPIA_RELATORIOS', os.path.splitext(DB_PATH)[0] + '_relatorios.db')
+
+# Intervalo entre atualizações, em segundos (0 desliga a cópia: relatórios leem o banco principal)
+INTERVALO_S = int(os.environ.get('COPIA_RELATORIOS_INTERVALO', 300))
+
+# Cópia mais velha que isso é ignorada (atualização parada): os relatórios voltam ao banco principal
+IDADE_MAXIMA_S = int(os.environ.get('COPIA_RELATORIOS_IDADE_MAXIMA', 3 * INTERVALO_S))
+
+SQL_INFO = '''
+    CREATE TABLE copia_info (
+        gerada_em TEXT NOT NULL,     -- início do backup (estado do banco que a cópia reflete)
+        duracao_ms REAL NOT NULL
+    )
+'''
+
+_trava = threading.Lock()
+_tarefa = None
+
+
+def atualizar_copia(origem=DB_PATH, destino=COPIA_PATH):
+    """Gera uma cópia nova do banco e a coloca no lugar da anterior. Retorna {'gerada_em', 'duracao_ms'}."""
+    inicio = time.perf_counter()
+    gerada_em = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    descritor, temporario = tempfile.mkstemp(
+        prefix=os.path.basename(destino) + '.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(destino)))
+    os.close(descritor)
+    try:
+        fonte = sqlite3.connect(origem, timeout=BUSY_TIMEOUT_MS / 1000)
+        copia = sqlite3.connect(temporario)
+        try:
+            # Um passo só (pages=-1): em WAL a leitura não bloqueia escritores, e copiar em
+            # vários passos recomeçaria o backup a cada escrita no meio do caminho
+            fonte.backup(copia)
+            duracao_ms = round((time.perf_counter() - inicio) * 1000, 1)
+            copia.execute('PRAGMA journal_mode = DELETE')
+            copia.execute('DROP TABLE IF EXISTS copia_info')
+            copia.execute(SQL_INFO)
+            copia.execute('INSERT INTO copia_info (gerada_em, duracao_ms) VALUES (?, ?)', (gerada_em, duracao_ms))
+            copia.commit()
+        finally:
+            copia.close()
+            fonte.close()
+        os.replace(temporario, destino)
+    except Exception:
+        try:
+            os.remove(temporario)
+        except OSError:
+            pass
+        raise
+    return {'gerada_em': gerada_em, 'duracao_ms': duracao_ms}
+
+
+def idade_copia(destino=COPIA_PATH):
+    """Segundos desde a última troca da cópia; None se ela ainda não existe."""
+    try:
+        return time.time() - os.path.getmtime(destino)
+    except OSError:
+        return None
+
+
+def abrir_copia(destino=COPIA_PATH, idade_maxima=IDADE_MAXIMA_S):
+    """(conexão somente leitura, gerada_em) da cópia, ou None se desligada, ausente ou velha demais."""
+    if INTERVALO_S <= 0:
+        return None
+    idade = idade_copia(destino)
+    if idade is None or idade > idade_maxima:
+        return None
+    try:
+        conn = sqlite3.connect(Path(destino).resolve().as_uri() + '?mode=ro', uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        gerada_em = conn.execute('SELECT gerada_em FROM copia_info').fetchone()[0]
+    except sqlite3.Error as e:
+        logging.warning(f"Cópia de relatórios indisponível ({destino}): {str(e)}")
+        return None
+    return conn, gerada_em
+
+
+def _executar(intervalo, origem, destino):
+    while True:
+        idade = idade_copia(destino)
+        # Vários workers dividem o mesmo arquivo: quem acorda com a cópia ainda nova não refaz
+        if idade is None or idade >= intervalo:
+            try:
+                resultado = atualizar_copia(origem, destino)
+                logging.info(f"Cópia de relatórios atualizada em {resultado['duracao_ms']:g} ms.")
+            except Exception as e:
+                logging.error(f"Falha ao atualizar a cópia de relatórios: {str(e)}", exc_info=True)
+            idade = 0
+        time.sleep(max(1, intervalo - idade))
+
+
+def iniciar_atualizacao_periodica(intervalo=INTERVALO_S, origem=DB_PATH, destino=COPIA_PATH):
+    """Inicia (uma vez por processo) a tarefa que mantém a cópia em dia; None com a cópia desligada."""
+    global _tarefa
+    if intervalo <= 0:
+        return None
+    with _trava:
+        if _tarefa is None or not _tarefa.is_alive():
+            _tarefa = threading.Thread(
+                target=_executar, args=(intervalo, origem, destino), name='copia-relatorios', daemon=True)
+            _tarefa.start()
+    return _tarefa
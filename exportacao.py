@@ -0,0 +1,93 @@
+import csv
+import io
+import os
+import tempfile
+
+# Exportação em streaming dos registros do relatório administrativo.
+# As linhas chegam de um gerador (cursor lido com fetchmany) e saem em blocos: o CSV vai
+# direto para a resposta; o XLSX é escrito com openpyxl em write_only (linha a linha em disco)
+# e depois enviado em pedaços. A memória não cresce com o número de fichas.
+
+# (campo do registro formatado, cabeçalho) na mesma ordem da tabela de admin_relatorio.html
+COLUNAS_RELATORIO = (
+    ('user_id', 'ID Usuário'),
+    ('codigo_ficha', 'Código Ficha'),
+    ('nome_gestante', 'Nome Gestante'),
+    ('genero', 'Identidade de Gênero'),
+    ('sexualidade', 'Orientação Sexual'),
+    ('raca_cor_etnia', 'Raça/Cor/Etnia'),
+    ('etnia_indigena', 'Etnia Indígena'),
+    ('deficiencia', 'Pessoa com Deficiência'),
+    ('data_nasc', 'Data Nascimento'),
+    ('telefone', 'Telefone'),
+    ('municipio', 'Município'),
+    ('ubs', 'UBS'),
+    ('acs', 'ACS'),
+    ('periodo_gestacional', 'Período Gestacional'),
+    ('data_envio', 'Data Envio'),
+    ('pontuacao_total', 'Pontuação Total'),
+    ('classificacao_risco', 'Classificação de Risco'),
+    ('imc', 'IMC'),
+    ('caracteristicas', 'Características individuais, condições socioeconômicas e familiares'),
+    ('avaliacao_nutricional', 'Avaliação Nutricional'),
+    ('comorbidades', 'Comorbidades prévias à gestação atual'),
+    ('historia_obstetrica', 'Condições clínicas específicas e relacionadas às gestações prévias'),
+    ('condicoes_gestacionais', 'Condições clínicas específicas e relacionadas à gestação atual'),
+    ('desfecho', 'Desfecho'),
+    ('profissional', 'Profissional'),
+    ('fa', 'Fora de Área'),
+)
+
+FORMATOS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+LINHAS_POR_BLOCO = 500
+BYTES_POR_BLOCO = 64 * 1024
+
+
+def _valor(valor):
+    return '' if valor is None else valor
+
+
+def csv_em_blocos(linhas, colunas=COLUNAS_RELATORIO, delimitador=';'):
+    """Gera o CSV em blocos de bytes (UTF-8 com BOM e ';', como o Excel em português espera)."""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer, delimiter=delimitador)
+    buffer.write('\ufeff')
+    escritor.writerow([rotulo for _, rotulo in colunas])
+    for numero, linha in enumerate(linhas, start=1):
+        escritor.writerow([_valor(linha.get(campo)) for campo, _ in colunas])
+        if numero % LINHAS_POR_BLOCO == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def xlsx_em_blocos(linhas, colunas=COLUNAS_RELATORIO, titulo='Relatório'):
+    """Escreve a planilha em write_only num arquivo temporário e gera o arquivo em blocos de bytes."""
+    from openpyxl import Workbook
+
+    descritor, caminho = tempfile.mkstemp(prefix='relatorio_', suffix='.xlsx')
+    os.close(descritor)
+    try:
+        livro = Workbook(write_only=True)
+        planilha = livro.create_sheet(title=titulo[:31])
+        planilha.append([rotulo for _, rotulo in colunas])
+        for linha in linhas:
+            planilha.append([_valor(linha.get(campo)) for campo, _ in colunas])
+        livro.save(caminho)
+        with open(caminho, 'rb') as arquivo:
+            while True:
+                bloco = arquivo.read(BYTES_POR_BLOCO)
+                if not bloco:
+                    break
+                yield bloco
+    finally:
+        try:
+            os.remove(caminho)
+        except OSError:
+            pass
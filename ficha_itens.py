@@ -0,0 +1,113 @@
+import json
+import os
+from functools import lru_cache
+
+# Seções da ficha gravadas em calculos como JSON e normalizadas em ficha_itens
+SECOES = (
+    'caracteristicas',
+    'avaliacao_nutricional',
+    'comorbidades',
+    'historia_obstetrica',
+    'condicoes_gestacionais',
+)
+
+SQL_TABELA = '''
+    CREATE TABLE IF NOT EXISTS ficha_itens (
+        ficha_id INTEGER NOT NULL REFERENCES calculos(id) ON DELETE CASCADE,
+        secao TEXT NOT NULL,
+        codigo TEXT NOT NULL,
+        PRIMARY KEY (ficha_id, secao, codigo)
+    ) WITHOUT ROWID
+'''
+
+# A PK (ficha_id, ...) atende o JOIN a partir das fichas; este índice atende "quais fichas têm o item X"
+SQL_INDICE = 'CREATE INDEX IF NOT EXISTS idx_ficha_itens_secao_codigo ON ficha_itens(secao, codigo)'
+
+
+# Decodificações guardadas (LRU por texto bruto): poucas combinações de itens se repetem em
+# milhares de fichas, então cada texto JSON distinto é decodificado uma vez por processo
+DECODIFICADAS_MAXIMO = int(os.environ.get('SECOES_CACHE_MAXIMO', 4096))
+
+
+def _codigos(valor):
+    try:
+        itens = json.loads(valor) if isinstance(valor, str) else valor
+    except json.JSONDecodeError:
+        itens = [valor]
+    if not isinstance(itens, list):
+        itens = [itens] if itens else []
+    if len(itens) == 1 and isinstance(itens[0], str):
+        try:
+            aninhado = json.loads(itens[0])
+            if isinstance(aninhado, list):
+                itens = aninhado
+        except json.JSONDecodeError:
+            pass
+    codigos = []
+    for item in itens:
+        codigo = str(item).strip() if item is not None else ''
+        if codigo and codigo not in codigos:
+            codigos.append(codigo)
+    return tuple(codigos)
+
+
+_codigos_do_texto = lru_cache(maxsize=DECODIFICADAS_MAXIMO)(_codigos)
+
+
+def decodificar_secao(valor):
+    """Tupla (imutável, compartilhada) dos códigos de uma seção, aceitando lista, JSON e JSON
+    duplamente serializado (fichas antigas)."""
+    if valor is None or valor == '':
+        return ()
+    if isinstance(valor, str):
+        return _codigos_do_texto(valor)
+    return _codigos(valor)
+
+
+def extrair_codigos(valor):
+    """Lista de códigos de uma seção (cópia de decodificar_secao, que pode ser alterada)."""
+    return list(decodificar_secao(valor))
+
+
+def estatisticas_decodificacao():
+    info = _codigos_do_texto.cache_info()
+    consultas = info.hits + info.misses
+    return {
+        'acertos': info.hits,
+        'falhas': info.misses,
+        'taxa_acerto': round(info.hits / consultas, 4) if consultas else 0.0,
+        'tamanho': info.currsize,
+        'maximo': info.maxsize,
+    }
+
+
+def gravar_itens(cursor, ficha_id, itens_por_secao):
+    """Grava os itens de uma ficha; itens_por_secao mapeia seção -> lista/JSON de códigos."""
+    linhas = [
+        (ficha_id, secao, codigo)
+        for secao in SECOES
+        for codigo in extrair_codigos(itens_por_secao.get(secao))
+    ]
+    cursor.executemany(
+        'INSERT OR IGNORE INTO ficha_itens (ficha_id, secao, codigo) VALUES (?, ?, ?)', linhas)
+    return len(linhas)
+
+
+def preencher_ficha_itens(cursor, lote=1000):
+    """Backfill das fichas gravadas antes da tabela existir (ids acima do último já normalizado)."""
+    ultimo = cursor.execute('SELECT COALESCE(MAX(ficha_id), 0) FROM ficha_itens').fetchone()[0]
+    colunas = ', '.join(SECOES)
+    total_fichas = total_itens = 0
+    while True:
+        rows = cursor.execute(
+            f'SELECT id, {colunas} FROM calculos WHERE id > ? ORDER BY id LIMIT ?', (ultimo, lote)
+        ).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            total_itens += gravar_itens(cursor, row[0], dict(zip(SECOES, row[1:])))
+        total_fichas += len(rows)
+        ultimo = rows[-1][0]
+    if total_fichas:
+        print(f"✅ ficha_itens: {total_itens} item(ns) de {total_fichas} ficha(s) normalizados.")
+
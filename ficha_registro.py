@@ -0,0 +1,112 @@
+from ficha_itens import decodificar_secao
+
+# Registro compacto para listagens grandes de calculos (relatório administrativo e exportação).
+# Cada linha vira um objeto com __slots__ que guarda só a tupla de valores; o índice coluna ->
+# posição e as funções de rótulo ficam na classe, geradas uma vez por consulta pela row factory.
+# Os rótulos (genero -> 'Mulher cisgênero', fa -> 'Sim', ...) são calculados na leitura do campo
+# (e memorizados por valor na consulta) e as seções JSON só são decodificadas quando pedidas
+# (itens()), em vez de um dict por linha alterado no lugar.
+
+# Colunas TEXT de poucos valores distintos (municípios, rótulos, seções JSON): cada valor repetido
+# é guardado uma vez por consulta em vez de uma str nova por linha vinda do sqlite3
+COMPARTILHADOS = frozenset({
+    'municipio', 'ubs', 'acs', 'periodo_gestacional', 'data_envio', 'data_envio_iso', 'pontuacao_total',
+    'classificacao_risco', 'imc', 'caracteristicas', 'avaliacao_nutricional', 'comorbidades', 'historia_obstetrica',
+    'condicoes_gestacionais', 'profissional', 'desfecho', 'deficiencia', 'genero', 'sexualidade', 'raca_cor_etnia',
+    'etnia_indigena',
+})
+
+
+class Ficha:
+    """Linha de calculos: ficha.genero / ficha['genero'] devolvem o valor já rotulado."""
+
+    __slots__ = ('_valores',)
+    _indice = {}    # coluna -> posição em _valores
+    _rotulos = {}   # coluna -> função(valor) com o texto exibido
+    _memo = {}      # coluna -> {valor gravado: rótulo}, da consulta inteira (rótulos são funções puras)
+
+    def __init__(self, valores):
+        self._valores = valores
+
+    def __getitem__(self, campo):
+        valor = self._valores[self._indice[campo]]
+        rotulo = self._rotulos.get(campo)
+        if rotulo is None:
+            return valor
+        memo = self._memo[campo]
+        try:
+            return memo[valor]
+        except KeyError:
+            texto = memo[valor] = rotulo(valor)
+            return texto
+
+    def __getattr__(self, campo):
+        if campo.startswith('_'):
+            raise AttributeError(campo)
+        try:
+            return self[campo]
+        except KeyError:
+            raise AttributeError(campo) from None
+
+    def __contains__(self, campo):
+        return campo in self._indice
+
+    def __iter__(self):
+        return iter(self._indice)
+
+    def __len__(self):
+        return len(self._indice)
+
+    def __repr__(self):
+        return f"<Ficha {self.bruto('codigo_ficha') if 'codigo_ficha' in self._indice else ''}>"
+
+    def keys(self):
+        return self._indice.keys()
+
+    def get(self, campo, padrao=None):
+        return self[campo] if campo in self._indice else padrao
+
+    def bruto(self, campo):
+        """Valor gravado no banco, sem rótulo."""
+        return self._valores[self._indice[campo]]
+
+    def itens(self, secao):
+        """Códigos de uma seção JSON (caracteristicas, comorbidades, ...), decodificados só agora."""
+        return decodificar_secao(self.bruto(secao))
+
+def classe_ficha(colunas, rotulos=None):
+    """Subclasse de Ficha para uma consulta com estas colunas e estes rótulos."""
+    return type('Ficha', (Ficha,), {
+        '__slots__': (),
+        '_indice': {coluna: posicao for posicao, coluna in enumerate(colunas)},
+        '_rotulos': dict(rotulos or {}),
+        '_memo': {campo: {} for campo in (rotulos or {})},
+    })
+
+
+def fabrica_fichas(rotulos=None, compartilhados=COMPARTILHADOS):
+    """Row factory (cursor.row_factory = fabrica_fichas(...)) que devolve Fichas.
+
+    A classe é montada na primeira linha de cada consulta (cursor.description é o mesmo
+    objeto para todas as linhas de um execute) e reaproveitada nas seguintes. Valores
+    repetidos das colunas em `compartilhados` viram um único objeto na consulta toda.
+    """
+    atual = [None, None, (), None]   # [description, classe, posições compartilhadas, valores vistos]
+
+    def fabrica(cursor, valores):
+        descricao = cursor.description
+        if descricao is not atual[0]:
+            colunas = [coluna[0] for coluna in descricao]
+            atual[:] = [descricao, classe_ficha(colunas, rotulos),
+                        [posicao for posicao, coluna in enumerate(colunas) if coluna in compartilhados], {}]
+        posicoes = atual[2]
+        if posicoes:
+            vistos = atual[3]
+            valores = list(valores)
+            for posicao in posicoes:
+                valor = valores[posicao]
+                valores[posicao] = vistos.setdefault(valor, valor)
+            valores = tuple(valores)
+        return atual[1](valores)
+
+    return fabrica
@@ -0,0 +1,170 @@
+import json
+import logging
+import re
+from datetime import datetime
+
+from agregados import manter_agregados
+from ficha_itens import SECOES, gravar_itens
+from gestantes import atualizar_gestantes, obter_gestante_id
+
+# Validação e gravação de uma ficha da calculadora, compartilhadas por salvar_calculadora
+# e pela importação de planilhas (importacao.py).
+
+CPF_NAO_INFORMADO = '000.000.000-00'
+
+CAMPOS_OBRIGATORIOS = (
+    ('nome_gestante', 'Nome da Gestante'),
+    ('data_nasc', 'Data de Nascimento'),
+    ('telefone', 'Telefone'),
+    ('municipio', 'Município'),
+    ('ubs', 'UBS'),
+    ('acs', 'ACS'),
+    ('periodo_gestacional', 'Período Gestacional'),
+    ('classificacao_risco', 'Classificação de Risco'),
+    ('genero', 'Gênero'),
+    ('raca_cor_etnia', 'Raça/Cor/Etnia'),
+    # etnia_indigena NÃO é obrigatório (só aparece se indígena)
+)
+
+_DATA_BR = re.compile(r'^\d{2}/\d{2}/\d{4}$')
+
+SQL_INSERIR = '''
+    INSERT INTO calculos (
+        user_id, codigo_ficha, nome_gestante, data_nasc, cpf, telefone, municipio, ubs, acs,
+        periodo_gestacional, data_envio, pontuacao_total, classificacao_risco, imc,
+        caracteristicas, avaliacao_nutricional, comorbidades, historia_obstetrica,
+        condicoes_gestacionais, profissional, genero, sexualidade, raca_cor_etnia, etnia_indigena,
+        data_envio_iso, data_nasc_iso, gestante_id
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+class FichaInvalida(ValueError):
+    pass
+
+
+def data_br_para_iso(data):
+    """Converte 'DD/MM/YYYY' (ou 'YYYY-MM-DD') em 'YYYY-MM-DD'; None se não reconhecer."""
+    if not data:
+        return None
+    data = data.strip()
+    for formato in ('%d/%m/%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(data[:10], formato).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+
+def _texto(valor):
+    return valor if valor is None or isinstance(valor, str) else str(valor)
+
+
+def _lista(campos, secao):
+    """Itens de uma seção: lista já pronta ou JSON (como vem do formulário da calculadora)."""
+    valor = campos.get(secao, '[]')
+    if isinstance(valor, (list, tuple)):
+        itens = list(valor)
+    else:
+        try:
+            itens = json.loads(valor or '[]')
+        except json.JSONDecodeError as e:
+            logging.warning(f"Erro ao desserializar {secao}: {str(e)} - Valor bruto: {valor}")
+            return []
+        if not isinstance(itens, list):
+            itens = [itens] if itens else []
+    return [str(item) for item in itens if item and str(item).strip()]
+
+
+def validar_ficha(campos):
+    """Valida os campos de uma ficha e devolve os valores normalizados para gravação.
+
+    campos é qualquer mapeamento com .get (request.form, linha de planilha). Levanta
+    FichaInvalida com a mensagem mostrada ao usuário.
+    """
+    dados = {
+        'nome_gestante': _texto(campos.get('nome_gestante')),
+        'deficiencia': _texto(campos.get('deficiencia')),
+        'data_nasc': _texto(campos.get('data_nasc')),
+        'cpf': _texto(campos.get('cpf', CPF_NAO_INFORMADO)),
+        'telefone': _texto(campos.get('telefone')),
+        'municipio': _texto(campos.get('municipio')),
+        'ubs': _texto(campos.get('ubs')),
+        'acs': _texto(campos.get('acs')),
+        'periodo_gestacional': _texto(campos.get('periodo_gestacional')),
+        'data_envio': _texto(campos.get('data_envio', datetime.now().strftime('%d/%m/%Y'))),
+        'pontuacao_total': _texto(campos.get('pontuacao_total')),
+        'classificacao_risco': _texto(campos.get('classificacao_risco', 'Risco Habitual')),
+        'imc': _texto(campos.get('imc', None)),
+        'genero': _texto(campos.get('genero')),
+        'sexualidade': _texto(campos.get('sexualidade')),
+        'raca_cor_etnia': _texto(campos.get('raca_cor_etnia')),
+        'etnia_indigena': _texto(campos.get('etnia_indigena', '')),
+    }
+    for secao in SECOES:
+        dados[secao] = _lista(campos, secao)
+
+    for campo, rotulo in CAMPOS_OBRIGATORIOS:
+        if not dados[campo] or dados[campo].strip() == '':
+            raise FichaInvalida(f'O campo "{rotulo}" é obrigatório.')
+
+    cpf = dados['cpf']
+    if cpf and cpf != CPF_NAO_INFORMADO:
+        cpf = re.sub(r'[^\d]', '', cpf)
+        if not re.match(r'^\d{11}$', cpf):
+            raise FichaInvalida('CPF inválido. Deve conter exatamente 11 dígitos.')
+    else:
+        cpf = CPF_NAO_INFORMADO
+    dados['cpf'] = cpf
+
+    pontuacao = dados['pontuacao_total']
+    try:
+        dados['pontuacao_total'] = int(pontuacao) if pontuacao and pontuacao.strip() else 0
+    except (ValueError, TypeError):
+        raise FichaInvalida('Pontuação total inválida.')
+
+    if not _DATA_BR.match(dados['data_nasc']):
+        raise FichaInvalida('Data de nascimento inválida. Use o formato DD/MM/YYYY.')
+    if not dados['data_envio'] or not _DATA_BR.match(dados['data_envio']):
+        raise FichaInvalida('Data de envio inválida. Use o formato DD/MM/YYYY.')
+
+    imc = dados['imc']
+    try:
+        dados['imc'] = float(imc) if imc and imc.strip() else None
+    except ValueError:
+        raise FichaInvalida('IMC inválido.')
+
+    dados['data_envio_iso'] = data_br_para_iso(dados['data_envio'])
+    dados['data_nasc_iso'] = data_br_para_iso(dados['data_nasc'])
+    return dados
+
+
+def valores_insercao(dados, user_id, codigo_ficha, profissional, gestante_id):
+    """Parâmetros de SQL_INSERIR para uma ficha validada por validar_ficha."""
+    return (
+        user_id, codigo_ficha, dados['nome_gestante'], dados['data_nasc'], dados['cpf'], dados['telefone'],
+        dados['municipio'], dados['ubs'], dados['acs'],
+        dados['periodo_gestacional'], dados['data_envio'], dados['pontuacao_total'], dados['classificacao_risco'],
+        dados['imc'],
+        json.dumps(dados['caracteristicas']), json.dumps(dados['avaliacao_nutricional']),
+        json.dumps(dados['comorbidades']), json.dumps(dados['historia_obstetrica']),
+        json.dumps(dados['condicoes_gestacionais']), profissional,
+        dados['genero'], dados['sexualidade'], dados['raca_cor_etnia'], dados['etnia_indigena'],
+        dados['data_envio_iso'], dados['data_nasc_iso'], gestante_id,
+    )
+
+
+def gravar_ficha(cursor, dados, user_id, codigo_ficha, profissional):
+    """Grava uma ficha validada com a gestante, os itens e os agregados; devolve o id da ficha.
+
+    Não faz commit: roda na transação do chamador (a fila de escrita em salvar_calculadora).
+    """
+    # Gestante da ficha (ponteiro para a ficha atual usado pelos relatórios)
+    gestante_id = obter_gestante_id(cursor, dados['cpf'], dados['nome_gestante'], dados['data_nasc'])
+    with manter_agregados(cursor, [gestante_id]):
+        cursor.execute(SQL_INSERIR, valores_insercao(dados, user_id, codigo_ficha, profissional, gestante_id))
+        ficha_id = cursor.lastrowid
+        # Itens normalizados em ficha_itens (contagens dos relatórios via GROUP BY)
+        gravar_itens(cursor, ficha_id, {secao: dados[secao] for secao in SECOES})
+        atualizar_gestantes(cursor, [gestante_id])
+    return ficha_id
@@ -0,0 +1,207 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FuturoTimeout
+
+from conexao_db import BUSY_TIMEOUT_MS, DB_PATH, PRAGMAS
+
+# Escritas das rotas mais concorridas (salvar_calculadora, registrar_pnar, compartilhar_tudo)
+# passam por uma única thread escritora por worker. Ela junta as tarefas que chegam enquanto
+# o commit anterior acontece (e, no máximo, ESPERA_MS depois da primeira) e grava todas numa
+# só transação: um fsync por lote e um único disputante do lock de escrita por processo.
+# Cada tarefa roda dentro de um SAVEPOINT: a falha de uma não desfaz as outras do lote.
+# O ganho depende de requisições simultâneas no mesmo processo (gunicorn com threads ou gthread):
+# com workers sync cada worker atende uma requisição por vez, todo lote tem tamanho 1 e a fila
+# só acrescenta a troca de thread.
+ESPERA_MS = float(os.environ.get('FILA_ESCRITA_ESPERA_MS', 2))
+LOTE_MAXIMO = int(os.environ.get('FILA_ESCRITA_LOTE_MAXIMO', 64))
+TIMEOUT_S = float(os.environ.get('FILA_ESCRITA_TIMEOUT_S', 30))
+
+# Faixas do histograma de tamanho dos lotes
+_FAIXAS = ((1, '1'), (4, '2-4'), (16, '5-16'), (64, '17-64'), (None, '65+'))
+
+
+def _faixa(tamanho):
+    return next(rotulo for limite, rotulo in _FAIXAS if limite is None or tamanho <= limite)
+
+
+class FilaEscrita:
+    """Fila de escritas com commit em grupo, servida por uma thread com conexão própria."""
+
+    def __init__(self, caminho=DB_PATH, espera_ms=ESPERA_MS, lote_maximo=LOTE_MAXIMO):
+        self.caminho = caminho
+        self.espera_s = espera_ms / 1000
+        self.lote_maximo = lote_maximo
+        self._lock = threading.Lock()
+        self._fila = None
+        self._thread = None
+        self._pid = None
+        self._stats = self._stats_zerados()
+
+    @staticmethod
+    def _stats_zerados():
+        return {
+            'tarefas': 0,
+            'tarefas_com_erro': 0,
+            'tarefas_canceladas': 0,   # desistidas por timeout antes de entrar num lote
+            'commits': 0,
+            'commits_com_erro': 0,
+            'maior_lote': 0,
+            'maior_profundidade': 0,
+            'lotes_por_tamanho': {rotulo: 0 for _, rotulo in _FAIXAS},
+            'tempo_commit_total_ms': 0.0,
+            'tempo_commit_max_ms': 0.0,
+            'espera_total_ms': 0.0,   # da entrada na fila até o fim do commit
+        }
+
+    def _garantir_thread(self):
+        pid = os.getpid()
+        with self._lock:
+            # Depois do fork do worker a thread do processo pai não existe aqui
+            if self._pid != pid or self._thread is None or not self._thread.is_alive():
+                if self._pid != pid:
+                    self._fila = queue.Queue()
+                    self._stats = self._stats_zerados()
+                self._pid = pid
+                self._thread = threading.Thread(target=self._executar, name='fila-escrita', daemon=True)
+                self._thread.start()
+            return self._fila
+
+    def executar(self, funcao, *args, timeout=TIMEOUT_S):
+        """Roda funcao(cursor, *args) na thread escritora e devolve o resultado depois do commit.
+
+        Exceções da tarefa (ou do commit) são relançadas aqui; a tarefa que falhou não grava nada.
+        O timeout vale para a espera na fila: a tarefa que não entrou num lote até lá é cancelada
+        (nunca é gravada) e levanta TimeoutError; a que já está num lote é esperada até o commit,
+        para que o chamador nunca receba erro de algo que foi gravado.
+        """
+        fila = self._garantir_thread()
+        futuro = Future()
+        fila.put((funcao, args, futuro, time.perf_counter()))
+        profundidade = fila.qsize()
+        with self._lock:
+            self._stats['maior_profundidade'] = max(self._stats['maior_profundidade'], profundidade)
+        try:
+            return futuro.result(timeout)
+        except FuturoTimeout:
+            if futuro.cancel():
+                with self._lock:
+                    self._stats['tarefas_canceladas'] += 1
+                raise TimeoutError(f'Fila de escrita: tarefa não executada em {timeout:g} s (cancelada).')
+            return futuro.result()
+
+    def _conectar(self):
+        conn = sqlite3.connect(self.caminho, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        for pragma, valor in PRAGMAS:
+            conn.execute(f'PRAGMA {pragma} = {valor}')
+        return conn
+
+    def _executar(self):
+        fila = self._fila
+        conn = self._conectar()
+        while True:
+            lote = [fila.get()]
+            limite = time.perf_counter() + self.espera_s
+            while len(lote) < self.lote_maximo:
+                try:
+                    lote.append(fila.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                restante = limite - time.perf_counter()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(fila.get(timeout=restante))
+                except queue.Empty:
+                    break
+            try:
+                self._gravar(conn, lote)
+            except Exception as e:
+                # Conexão em estado inválido: as tarefas pendentes recebem o erro e a conexão é refeita
+                logging.error(f"Fila de escrita: erro fora das tarefas: {str(e)}", exc_info=True)
+                for _, _, futuro, _ in lote:
+                    if not futuro.done():
+                        futuro.set_exception(e)
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+                conn = self._conectar()
+
+    def _gravar(self, conn, lote):
+        # Daqui em diante a tarefa não pode mais ser cancelada; as já canceladas ficam de fora
+        lote = [tarefa for tarefa in lote if tarefa[2].set_running_or_notify_cancel()]
+        if not lote:
+            return
+        inicio = time.perf_counter()
+        resultados = []
+        erro_commit = None
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error as e:
+            erro_commit = e
+        else:
+            cursor = conn.cursor()
+            for funcao, args, _, _ in lote:
+                conn.execute('SAVEPOINT tarefa')
+                try:
+                    resultados.append((funcao(cursor, *args), None))
+                except Exception as e:
+                    resultados.append((None, e))
+                    conn.execute('ROLLBACK TO tarefa')
+                conn.execute('RELEASE tarefa')
+            try:
+                conn.execute('COMMIT')
+            except sqlite3.Error as e:
+                erro_commit = e
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+        fim = time.perf_counter()
+
+        erros = 0
+        for indice, (_, _, futuro, entrada) in enumerate(lote):
+            resultado, erro = resultados[indice] if indice < len(resultados) else (None, None)
+            erro = erro_commit or erro
+            if erro is not None:
+                erros += 1
+                futuro.set_exception(erro)
+            else:
+                futuro.set_result(resultado)
+        with self._lock:
+            stats = self._stats
+            duracao = (fim - inicio) * 1000
+            stats['tarefas'] += len(lote)
+            stats['tarefas_com_erro'] += erros
+            stats['commits'] += 1
+            stats['commits_com_erro'] += 1 if erro_commit else 0
+            stats['maior_lote'] = max(stats['maior_lote'], len(lote))
+            stats['lotes_por_tamanho'][_faixa(len(lote))] += 1
+            stats['tempo_commit_total_ms'] += duracao
+            stats['tempo_commit_max_ms'] = max(stats['tempo_commit_max_ms'], duracao)
+            stats['espera_total_ms'] += sum((fim - entrada) * 1000 for _, _, _, entrada in lote)
+        if erro_commit:
+            logging.error(f"Fila de escrita: commit de {len(lote)} tarefa(s) falhou: {str(erro_commit)}")
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['lotes_por_tamanho'] = dict(self._stats['lotes_por_tamanho'])
+            stats['profundidade'] = self._fila.qsize() if self._fila is not None and self._pid == os.getpid() else 0
+        commits = stats['commits']
+        stats['lote_medio'] = round(stats['tarefas'] / commits, 2) if commits else 0.0
+        stats['tempo_commit_medio_ms'] = round(stats['tempo_commit_total_ms'] / commits, 3) if commits else 0.0
+        stats['espera_media_ms'] = round(stats['espera_total_ms'] / stats['tarefas'], 3) if stats['tarefas'] else 0.0
+        for chave in ('tempo_commit_total_ms', 'tempo_commit_max_ms', 'espera_total_ms'):
+            stats[chave] = round(stats[chave], 3)
+        stats['espera_maxima_configurada_ms'] = self.espera_s * 1000
+        stats['lote_maximo_configurado'] = self.lote_maximo
+        stats['pid'] = os.getpid()
+        return stats
+
+
+fila = FilaEscrita()
@@ -1,10 +1,10 @@
-import bcrypt
+from senhas import gerar_hash
 
 # Senha para o administrador
 senha = 'senha_admin'
 
-# Gerar o hash
-hashed = bcrypt.hashpw(senha.encode('utf-8'), bcrypt.gensalt())
+# Gerar o hash (custo de BCRYPT_ROUNDS, o mesmo do login)
+hashed = gerar_hash(senha)
 
 # Exibir o hash
-print(hashed.decode('utf-8'))
\ No newline at end of file
+print(hashed)
\ No newline at end of file
@@ -0,0 +1,290 @@
+import argparse
+import json
+import sqlite3
+import sys
+
+from agregados import reconstruir_agregados, verificar_agregados
+from arquivo import IDADE_DIAS, LOTE as ARQUIVO_LOTE, arquivar_fichas
+from benchmarks import medir_login, medir_relatorio
+from conexao_db import DB_PATH
+from copia_relatorios import COPIA_PATH, atualizar_copia
+from importacao import importar_planilha
+from init_db import MIGRACOES, VERSAO_ATUAL, migrar, versao_schema
+from manutencao import (BACKUP_DIR, BACKUPS_MANTIDOS, MODOS_BACKUP, ativar_auto_vacuum, executar_manutencao,
+                        registrar_manutencao)
+from reclassificacao import (LOTE as RECLASSIFICACAO_LOTE, PAUSA_MS as RECLASSIFICACAO_PAUSA_MS,
+                             obter_reclassificacao, reclassificar_fichas, registrar_reclassificacao)
+from senhas import ROUNDS as BCRYPT_ROUNDS, THREADS as BCRYPT_THREADS
+
+
+def cmd_migrar(args):
+    aplicadas = migrar(args.banco)
+    if aplicadas:
+        print(f"Migrações aplicadas: {', '.join(str(v) for v in aplicadas)}")
+    return 0
+
+
+def cmd_status(args):
+    conn = sqlite3.connect(args.banco)
+    try:
+        versao = versao_schema(conn)
+        registradas = {}
+        if versao:
+            registradas = {
+                row[0]: row[1]
+                for row in conn.execute('SELECT versao, aplicada_em FROM schema_version')
+            }
+    finally:
+        conn.close()
+    print(f"Schema na versão {versao} (código espera {VERSAO_ATUAL}).")
+    for numero, nome, _ in MIGRACOES:
+        situacao = f"aplicada em {registradas[numero]}" if numero in registradas else 'PENDENTE'
+        print(f"  {numero:>3} {nome:<30} {situacao}")
+    return 0 if versao >= VERSAO_ATUAL else 1
+
+
+def cmd_agregados(args):
+    conn = sqlite3.connect(args.banco, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        # Leitura e eventual reconstrução na mesma transação: nenhuma escrita entra no meio
+        conn.execute('BEGIN IMMEDIATE')
+        divergencias = verificar_agregados(conn.cursor())
+        for chave, gravado, esperado in divergencias[:50]:
+            print(f"  {chave}: gravado={gravado:g} esperado={esperado:g}")
+        print(f"{len(divergencias)} divergência(s) entre agregados_diarios e as fichas.")
+        if args.reconstruir and divergencias:
+            linhas = reconstruir_agregados(conn.cursor())
+            print(f"agregados_diarios reconstruída ({linhas} linha(s)).")
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return 1 if divergencias and not args.reconstruir else 0
+
+
+def cmd_importar(args):
+    conn = sqlite3.connect(args.banco)
+    conn.row_factory = sqlite3.Row
+    try:
+        usuario = conn.execute('SELECT nome FROM usuarios WHERE id = ?', (args.usuario,)).fetchone()
+        if not usuario:
+            print(f"Usuário {args.usuario} não encontrado.")
+            return 1
+
+        def progresso(relatorio):
+            print(f"  {relatorio['linhas_lidas']} linha(s) lida(s), {relatorio['importadas']} importada(s), "
+                  f"{relatorio['rejeitadas']} rejeitada(s)", flush=True)
+
+        relatorio = importar_planilha(conn, args.arquivo, args.usuario, usuario['nome'],
+                                      lote=args.lote, ao_progredir=progresso)
+    finally:
+        conn.close()
+    for rejeicao in relatorio['rejeicoes'][:50]:
+        print(f"  linha {rejeicao['linha']}: {rejeicao['motivo']}")
+    print(f"{relatorio['importadas']} ficha(s) importada(s), {relatorio['rejeitadas']} linha(s) rejeitada(s).")
+    return 0 if not relatorio['rejeitadas'] else 2
+
+
+def cmd_arquivar(args):
+    conn = sqlite3.connect(args.banco, isolation_level=None)
+    try:
+        resultado = arquivar_fichas(conn, idade_dias=args.idade_dias, lote=args.lote)
+    finally:
+        conn.close()
+    print(f"{resultado['arquivadas']} ficha(s) encerrada(s) enviada(s) antes de {resultado['corte']} "
+          f"movida(s) para calculos_arquivo em {resultado['duracao_ms']:g} ms.")
+    return 0
+
+
+def cmd_copia_relatorios(args):
+    resultado = atualizar_copia(args.banco, args.destino)
+    print(f"Cópia de relatórios gravada em {args.destino} ({resultado['duracao_ms']:g} ms, "
+          f"estado de {resultado['gerada_em']}).")
+    return 0
+
+
+def cmd_manutencao(args):
+    if args.ativar_auto_vacuum:
+        print("Ativando auto_vacuum = INCREMENTAL (VACUUM completo: as escritas esperam até o fim)...")
+        ativar_auto_vacuum(args.banco)
+    opcoes = {'backup': not args.sem_backup, 'modo_backup': args.modo, 'diretorio': args.diretorio,
+              'manter': args.manter, 'analisar': not args.sem_analyze, 'compactacao': not args.sem_compactar}
+    conn = sqlite3.connect(args.banco)
+    try:
+        # Registrada como as iniciadas pela rota: impede duas manutenções ao mesmo tempo
+        manutencao_id = registrar_manutencao(conn.cursor(), None, {k: v for k, v in opcoes.items() if k != 'diretorio'})
+        conn.commit()
+    finally:
+        conn.close()
+
+    ultima = [None]
+
+    def progresso(etapa, percentual):
+        if etapa != ultima[0]:
+            print(f"  [{percentual:>3}%] {etapa}", flush=True)
+            ultima[0] = etapa
+
+    status, mensagem, resultado = 'concluida', None, {}
+    try:
+        resultado = executar_manutencao(args.banco, ao_progredir=progresso, **opcoes)
+    except Exception as e:
+        status, mensagem = 'falhou', f'Erro na manutenção: {str(e)}'
+        raise
+    finally:
+        conn = sqlite3.connect(args.banco)
+        try:
+            conn.execute('''
+                UPDATE manutencoes SET status = ?, etapa = ?, progresso = ?, resultado = ?, mensagem = ?,
+                       atualizada_em = datetime('now', 'localtime'), concluida_em = datetime('now', 'localtime')
+                WHERE id = ?
+            ''', (status, ultima[0], 100 if status == 'concluida' else 0, json.dumps(resultado), mensagem,
+                  manutencao_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    if 'backup' in resultado:
+        print(f"Backup: {resultado['backup']['arquivo']} ({resultado['backup']['bytes']} bytes, "
+              f"{resultado['backup']['duracao_ms']:g} ms)")
+    for removido in resultado.get('backups_removidos', []):
+        print(f"Backup antigo removido: {removido}")
+    if 'compactacao' in resultado:
+        compactacao = resultado['compactacao']
+        print(f"Páginas livres: {compactacao['paginas_livres_antes']} -> {compactacao['paginas_livres_depois']} "
+              f"(auto_vacuum {compactacao['auto_vacuum']})")
+    checkpoint = resultado['checkpoint']
+    print(f"Checkpoint {checkpoint['modo']}: {checkpoint['paginas_copiadas']}/{checkpoint['paginas_log']} página(s) do WAL.")
+    print(f"Tamanho do banco (com WAL): {resultado['tamanho_antes']} -> {resultado['tamanho_depois']} bytes.")
+    return 0
+
+
+def cmd_reclassificar(args):
+    conn = sqlite3.connect(args.banco, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        # Registrada como as iniciadas pela rota: retoma a interrompida e impede duas ao mesmo tempo
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            reclassificacao_id, retomada = registrar_reclassificacao(conn.cursor(), None)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        print(f"Reclassificação {reclassificacao_id}{' retomada' if retomada else ''}:")
+
+        def progresso(andamento):
+            print(f"  {andamento['processadas']}/{andamento['total']} ficha(s), {andamento['alteradas']} alterada(s)",
+                  flush=True)
+
+        try:
+            reclassificar_fichas(conn, reclassificacao_id, lote=args.lote, pausa_ms=args.pausa_ms, ao_progredir=progresso)
+        except Exception as e:
+            conn.execute("UPDATE reclassificacoes SET status = 'falhou', mensagem = ?, concluida_em = datetime('now', 'localtime') "
+                         "WHERE id = ?", (f'Erro na reclassificação: {str(e)}', reclassificacao_id))
+            raise
+        resultado = obter_reclassificacao(conn.cursor(), reclassificacao_id)
+    finally:
+        conn.close()
+    print(f"{resultado['alteradas']} de {resultado['processadas']} ficha(s) alterada(s), "
+          f"{resultado['ignoradas']} sem itens mantida(s); {resultado['para_alto']} passaram a Alto Risco e "
+          f"{resultado['sairam_de_alto']} deixaram de ser.")
+    for transicao, quantidade in sorted(resultado['transicoes'].items()):
+        print(f"  {transicao}: {quantidade}")
+    return 0
+
+
+def cmd_benchmark(args):
+    if args.alvo == 'login':
+        return cmd_benchmark_login(args)
+    # Mesmos rótulos da rota: importar app sobe o módulo como um worker (schema e cópia de relatórios)
+    from app import ROTULOS_RELATORIO
+    print(f"Relatório administrativo com {args.linhas} ficha(s) sintética(s), melhor de {args.repeticoes}:")
+    resultado = medir_relatorio(args.linhas, ROTULOS_RELATORIO, repeticoes=args.repeticoes)
+    for modo, medidas in resultado.items():
+        print(f"  {modo:>5}: carga {medidas['carga_ms']:g} ms + tabela {medidas['tabela_ms']:g} ms = "
+              f"{medidas['total_ms']:g} ms; memória {medidas['memoria_mb']:g} MB (pico {medidas['pico_mb']:g} MB)")
+    antes, depois = resultado['dict'], resultado['ficha']
+    print(f"  Fichas: {depois['total_ms'] / antes['total_ms']:.0%} do tempo e "
+          f"{depois['memoria_mb'] / antes['memoria_mb']:.0%} da memória dos dicts.")
+    return 0
+
+
+def cmd_benchmark_login(args):
+    print(f"Rajada de {args.tentativas} login(s) com {args.concorrencia} thread(s), bcrypt custo {args.rounds} "
+          f"(pool de {BCRYPT_THREADS} thread(s)):")
+    resultado = medir_login(args.tentativas, args.concorrencia, args.rounds)
+    for modo, medidas in resultado.items():
+        print(f"  {modo:>6}: {medidas['logins_s']:g} login(s)/s; latência p50 {medidas['p50_ms']:g} ms, "
+              f"p95 {medidas['p95_ms']:g} ms; requisição leve p95 {medidas['leve_p95_ms']:g} ms")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Tarefas de manutenção do banco da calculadora de risco gestacional.')
+    parser.add_argument('--banco', default=DB_PATH, help=f'arquivo SQLite (padrão: {DB_PATH})')
+    sub = parser.add_subparsers(dest='comando', required=True)
+
+    sub.add_parser('migrar', help='aplica as migrações de schema pendentes').set_defaults(func=cmd_migrar)
+    sub.add_parser('status', help='mostra a versão do schema e as migrações pendentes').set_defaults(func=cmd_status)
+
+    agregados = sub.add_parser('agregados', help='confere agregados_diarios contra as fichas')
+    agregados.add_argument('--reconstruir', action='store_true', help='recalcula a tabela se houver divergência')
+    agregados.set_defaults(func=cmd_agregados)
+
+    importar = sub.add_parser('importar', help='importa fichas de uma planilha CSV/XLSX')
+    importar.add_argument('arquivo', help='planilha .csv ou .xlsx (primeira linha com os nomes das colunas)')
+    importar.add_argument('--usuario', type=int, required=True, help='id do usuário registrado como autor das fichas')
+    importar.add_argument('--lote', type=int, default=1000, help='fichas gravadas por transação (padrão: 1000)')
+    importar.set_defaults(func=cmd_importar)
+
+    arquivar = sub.add_parser('arquivar', help='move fichas encerradas e antigas para calculos_arquivo')
+    arquivar.add_argument('--idade-dias', type=int, default=IDADE_DIAS,
+                          help=f'idade mínima da ficha, pela data de envio (padrão: {IDADE_DIAS})')
+    arquivar.add_argument('--lote', type=int, default=ARQUIVO_LOTE,
+                          help=f'fichas movidas por transação (padrão: {ARQUIVO_LOTE})')
+    arquivar.set_defaults(func=cmd_arquivar)
+
+    copia = sub.add_parser('copia-relatorios', help='atualiza agora a cópia somente leitura dos relatórios')
+    copia.add_argument('--destino', default=COPIA_PATH, help=f'arquivo da cópia (padrão: {COPIA_PATH})')
+    copia.set_defaults(func=cmd_copia_relatorios)
+
+    manutencao = sub.add_parser('manutencao', help='backup, ANALYZE, PRAGMA optimize, compactação e checkpoint do WAL')
+    manutencao.add_argument('--sem-backup', action='store_true', help='não gera backup (nem faz a rotação)')
+    manutencao.add_argument('--modo', choices=MODOS_BACKUP, default='vacuum',
+                            help='vacuum (VACUUM INTO, compactado) ou incremental (API de backup em passos)')
+    manutencao.add_argument('--diretorio', default=BACKUP_DIR, help=f'pasta dos backups (padrão: {BACKUP_DIR})')
+    manutencao.add_argument('--manter', type=int, default=BACKUPS_MANTIDOS,
+                            help=f'backups mantidos na rotação (padrão: {BACKUPS_MANTIDOS})')
+    manutencao.add_argument('--sem-analyze', action='store_true', help='pula o ANALYZE completo')
+    manutencao.add_argument('--sem-compactar', action='store_true', help='pula o incremental_vacuum')
+    manutencao.add_argument('--ativar-auto-vacuum', action='store_true',
+                            help='antes, passa o banco para auto_vacuum = INCREMENTAL (VACUUM completo, uma vez)')
+    manutencao.set_defaults(func=cmd_manutencao)
+
+    reclassificar = sub.add_parser('reclassificar',
+                                   help='recalcula pontuação e classificação das fichas com os pesos atuais (retomável)')
+    reclassificar.add_argument('--lote', type=int, default=RECLASSIFICACAO_LOTE,
+                               help=f'fichas por transação (padrão: {RECLASSIFICACAO_LOTE})')
+    reclassificar.add_argument('--pausa-ms', type=float, default=RECLASSIFICACAO_PAUSA_MS,
+                               help=f'pausa entre as transações (padrão: {RECLASSIFICACAO_PAUSA_MS:g})')
+    reclassificar.set_defaults(func=cmd_reclassificar)
+
+    benchmark = sub.add_parser('benchmark', help='medições: relatório (dicts x Fichas) ou rajada de logins (bcrypt)')
+    benchmark.add_argument('alvo', nargs='?', choices=('relatorio', 'login'), default='relatorio')
+    benchmark.add_argument('--linhas', type=int, default=100000, help='relatorio: fichas sintéticas (padrão: 100000)')
+    benchmark.add_argument('--repeticoes', type=int, default=3, help='relatorio: execuções cronometradas (padrão: 3)')
+    benchmark.add_argument('--tentativas', type=int, default=64, help='login: senhas verificadas (padrão: 64)')
+    benchmark.add_argument('--concorrencia', type=int, default=8, help='login: threads simultâneas (padrão: 8)')
+    benchmark.add_argument('--rounds', type=int, default=BCRYPT_ROUNDS,
+                           help=f'login: custo do bcrypt (padrão: BCRYPT_ROUNDS = {BCRYPT_ROUNDS})')
+    benchmark.set_defaults(func=cmd_benchmark)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+import re
+
+from arquivo import FICHAS
+
+# Uma linha por gestante. A chave é o CPF quando válido; sem CPF, nome + data de nascimento.
+# ultima_ficha_id aponta para a ficha ativa mais recente (ou, se nenhuma estiver ativa, para a
+# mais recente de todas) e ativa = 1 enquanto houver ficha sem desfecho e dentro da área.
+# Os dois valem para a gestante inteira, em qualquer município: a ficha fora de área em A deixa
+# de ser a atual quando chega ficha mais nova em B. Os relatórios por município não partem deles:
+# agregados_diarios conta a ficha mais recente de cada escopo (agregados.py), então o desfecho e o
+# fora de área registrados em A continuam contando em A.
+SQL_TABELA = '''
+    CREATE TABLE IF NOT EXISTS gestantes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chave TEXT NOT NULL UNIQUE,
+        ultima_ficha_id INTEGER,
+        ativa INTEGER NOT NULL DEFAULT 1,
+        atualizada_em TEXT
+    )
+'''
+
+SQL_INDICES = [
+    # Ficha atual -> gestante
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_gestantes_ultima_ficha ON gestantes(ultima_ficha_id)',
+    # Manutenção do ponteiro e atualizações em lote por gestante
+    'CREATE INDEX IF NOT EXISTS idx_calculos_gestante_id ON calculos(gestante_id, id)',
+]
+
+
+def chave_gestante(cpf, nome_gestante, data_nasc):
+    digitos = re.sub(r'\D', '', cpf or '')
+    if len(digitos) == 11 and len(set(digitos)) > 1:
+        return f'cpf:{digitos}'
+    nome = ' '.join((nome_gestante or '').split()).upper()
+    return f"nome:{nome}|{(data_nasc or '').strip()}"
+
+
+def obter_gestante_id(cursor, cpf, nome_gestante, data_nasc):
+    chave = chave_gestante(cpf, nome_gestante, data_nasc)
+    cursor.execute('INSERT OR IGNORE INTO gestantes (chave) VALUES (?)', (chave,))
+    return cursor.execute('SELECT id FROM gestantes WHERE chave = ?', (chave,)).fetchone()[0]
+
+
+def atualizar_gestantes(cursor, gestante_ids, fonte=FICHAS):
+    """Recalcula ultima_ficha_id/ativa das gestantes informadas a partir das fichas delas.
+
+    Fichas ativas nunca são arquivadas; só a mais recente de todas precisa olhar o arquivo (fonte).
+    """
+    ids = sorted({gid for gid in gestante_ids if gid is not None})
+    for inicio in range(0, len(ids), 500):
+        lote = ids[inicio:inicio + 500]
+        placeholders = ','.join(['?'] * len(lote))
+        cursor.execute(f'''
+            UPDATE gestantes SET
+                ultima_ficha_id = COALESCE(
+                    (SELECT MAX(id) FROM calculos
+                     WHERE gestante_id = gestantes.id AND desfecho IS NULL AND fa = 0),
+                    (SELECT MAX(id) FROM {fonte} WHERE gestante_id = gestantes.id)),
+                ativa = EXISTS(SELECT 1 FROM calculos
+                               WHERE gestante_id = gestantes.id AND desfecho IS NULL AND fa = 0),
+                atualizada_em = datetime('now', 'localtime')
+            WHERE id IN ({placeholders})
+        ''', lote)
+
+
+def vincular_ficha(cursor, ficha_id, cpf, nome_gestante, data_nasc):
+    """Associa uma ficha recém-gravada à sua gestante e atualiza o ponteiro. Retorna o gestante_id."""
+    gestante_id = obter_gestante_id(cursor, cpf, nome_gestante, data_nasc)
+    cursor.execute('UPDATE calculos SET gestante_id = ? WHERE id = ?', (gestante_id, ficha_id))
+    atualizar_gestantes(cursor, [gestante_id])
+    return gestante_id
+
+
+def preencher_gestantes(cursor, lote=1000, fonte=FICHAS):
+    """Backfill: cria as gestantes das fichas sem gestante_id e recalcula os ponteiros."""
+    ultimo = 0
+    afetadas = set()
+    while True:
+        rows = cursor.execute('''
+            SELECT id, cpf, nome_gestante, data_nasc FROM calculos
+            WHERE gestante_id IS NULL AND id > ? ORDER BY id LIMIT ?
+        ''', (ultimo, lote)).fetchall()
+        if not rows:
+            break
+        for ficha_id, cpf, nome_gestante, data_nasc in rows:
+            gestante_id = obter_gestante_id(cursor, cpf, nome_gestante, data_nasc)
+            cursor.execute('UPDATE calculos SET gestante_id = ? WHERE id = ?', (gestante_id, ficha_id))
+            afetadas.add(gestante_id)
+        ultimo = rows[-1][0]
+    atualizar_gestantes(cursor, afetadas, fonte)
+    if afetadas:
+        print(f"✅ gestantes: {len(afetadas)} gestante(s) vinculada(s) às fichas existentes.")
@@ -0,0 +1,285 @@
+import csv
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+import uuid
+from datetime import date
+
+from agregados import manter_agregados
+from conexao_db import pool
+from consulta_cpf import invalidar_cpf
+from etnias import codigo_por_nome
+from ficha_itens import SECOES, gravar_itens
+from fichas import FichaInvalida, SQL_INSERIR, validar_ficha, valores_insercao
+from gestantes import atualizar_gestantes, chave_gestante
+
+# Importação de fichas de planilhas (CSV/XLSX) de municípios que não usavam a calculadora.
+# O arquivo é lido em streaming (csv linha a linha, openpyxl em read_only) e gravado em lotes:
+# cada lote é uma transação curta, então o lock de escrita nunca fica preso pelo arquivo inteiro
+# e uma planilha de 200 mil linhas não precisa caber na memória.
+# O andamento fica na tabela importacoes, atualizada na mesma transação de cada lote.
+SQL_TABELA = '''
+    CREATE TABLE IF NOT EXISTS importacoes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        arquivo TEXT NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES usuarios(id),
+        status TEXT NOT NULL DEFAULT 'pendente',   -- pendente, processando, concluida, falhou
+        linhas_lidas INTEGER NOT NULL DEFAULT 0,
+        importadas INTEGER NOT NULL DEFAULT 0,
+        rejeitadas INTEGER NOT NULL DEFAULT 0,
+        rejeicoes TEXT NOT NULL DEFAULT '[]',      -- [{"linha": n, "motivo": "..."}], até MAX_REJEICOES
+        mensagem TEXT,
+        iniciada_em TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+        atualizada_em TEXT,
+        concluida_em TEXT
+    )
+'''
+
+LOTE = int(os.environ.get('IMPORTACAO_LOTE', 1000))
+MAX_REJEICOES = 1000   # rejeições guardadas com o motivo; o total continua sendo contado
+EXTENSOES = ('.csv', '.xlsx')
+
+# Cabeçalhos aceitos além dos nomes das colunas de calculos (já sem acento, minúsculos, com _)
+APELIDOS = {
+    'nome': 'nome_gestante',
+    'gestante': 'nome_gestante',
+    'nome_da_gestante': 'nome_gestante',
+    'data_de_nascimento': 'data_nasc',
+    'data_nascimento': 'data_nasc',
+    'nascimento': 'data_nasc',
+    'data_de_envio': 'data_envio',
+    'data': 'data_envio',
+    'periodo': 'periodo_gestacional',
+    'periodo_gestacao': 'periodo_gestacional',
+    'pontuacao': 'pontuacao_total',
+    'classificacao': 'classificacao_risco',
+    'risco': 'classificacao_risco',
+    'raca': 'raca_cor_etnia',
+    'raca_cor': 'raca_cor_etnia',
+    'etnia': 'etnia_indigena',
+    'caracteristicas_individuais': 'caracteristicas',
+    'historia_reprodutiva': 'historia_obstetrica',
+}
+_CAMPOS_DATA = ('data_nasc', 'data_envio')
+
+
+class ArquivoInvalido(ValueError):
+    pass
+
+
+def _normalizar_cabecalho(nome):
+    texto = unicodedata.normalize('NFKD', str(nome or '')).encode('ascii', 'ignore').decode('ascii')
+    texto = re.sub(r'[^a-z0-9]+', '_', texto.lower()).strip('_')
+    return APELIDOS.get(texto, texto)
+
+
+def _celula(valor):
+    """Valor de célula como texto no formato do formulário da calculadora."""
+    if valor is None:
+        return ''
+    if isinstance(valor, date):   # inclui datetime
+        return valor.strftime('%d/%m/%Y')
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor).strip()
+
+
+def _campos_da_linha(cabecalho, valores):
+    campos = {}
+    for coluna, valor in zip(cabecalho, valores):
+        if coluna:
+            campos[coluna] = _celula(valor)
+    for coluna in _CAMPOS_DATA:
+        # Planilhas exportadas de outros sistemas costumam trazer YYYY-MM-DD
+        iso = re.match(r'^(\d{4})-(\d{2})-(\d{2})', campos.get(coluna, ''))
+        if iso:
+            campos[coluna] = f'{iso.group(3)}/{iso.group(2)}/{iso.group(1)}'
+    for secao in SECOES:
+        texto = campos.get(secao, '')
+        if texto and not texto.startswith('['):
+            # Fora do formato JSON da calculadora: códigos separados por ; , ou |
+            campos[secao] = [codigo.strip() for codigo in re.split(r'[;,|]', texto) if codigo.strip()]
+    if campos.get('etnia_indigena'):
+        # Planilhas costumam trazer o nome da etnia ('Potiguara'); a ficha grava o código do catálogo
+        campos['etnia_indigena'] = codigo_por_nome(campos['etnia_indigena']) or campos['etnia_indigena']
+    return campos
+
+
+def _abrir_csv(caminho):
+    with open(caminho, 'rb') as arquivo:
+        amostra = arquivo.read(64 * 1024)
+    try:
+        amostra.decode('utf-8-sig')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError:
+        encoding = 'latin-1'   # planilhas salvas pelo Excel em português
+    primeira = amostra.decode(encoding, 'ignore').splitlines()[0] if amostra else ''
+    delimitador = ';' if primeira.count(';') > primeira.count(',') else ','
+    return open(caminho, newline='', encoding=encoding), delimitador
+
+
+def ler_planilha(caminho):
+    """Gera (número da linha na planilha, campos) sem carregar o arquivo inteiro."""
+    extensao = os.path.splitext(caminho)[1].lower()
+    if extensao == '.csv':
+        arquivo, delimitador = _abrir_csv(caminho)
+        with arquivo:
+            leitor = csv.reader(arquivo, delimiter=delimitador)
+            cabecalho = [_normalizar_cabecalho(c) for c in next(leitor, [])]
+            for numero, valores in enumerate(leitor, start=2):
+                if any(v.strip() for v in valores):
+                    yield numero, _campos_da_linha(cabecalho, valores)
+    elif extensao == '.xlsx':
+        from openpyxl import load_workbook
+        livro = load_workbook(caminho, read_only=True, data_only=True)
+        try:
+            linhas = livro.active.iter_rows(values_only=True)
+            cabecalho = [_normalizar_cabecalho(c) for c in next(linhas, ())]
+            for numero, valores in enumerate(linhas, start=2):
+                if any(v not in (None, '') for v in valores):
+                    yield numero, _campos_da_linha(cabecalho, valores)
+        finally:
+            livro.close()
+    else:
+        raise ArquivoInvalido(f"Formato não suportado: use {' ou '.join(EXTENSOES)}.")
+
+
+def _gravar_lote(conn, fichas, user_id, importacao_id, relatorio):
+    """Grava um lote de fichas válidas [(dados, profissional)] numa transação curta."""
+    cursor = conn.cursor()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if fichas:
+            chaves = [chave_gestante(d['cpf'], d['nome_gestante'], d['data_nasc']) for d, _ in fichas]
+            cursor.executemany('INSERT OR IGNORE INTO gestantes (chave) VALUES (?)', [(c,) for c in set(chaves)])
+            ids_por_chave = {}
+            distintas = sorted(set(chaves))
+            for inicio in range(0, len(distintas), 500):
+                bloco = distintas[inicio:inicio + 500]
+                ids_por_chave.update(cursor.execute(
+                    f"SELECT chave, id FROM gestantes WHERE chave IN ({','.join(['?'] * len(bloco))})", bloco
+                ).fetchall())
+            gestante_ids = [ids_por_chave[chave] for chave in chaves]
+            codigos = [str(uuid.uuid4())[:8].upper() for _ in fichas]
+
+            with manter_agregados(cursor, set(gestante_ids)):
+                cursor.executemany(SQL_INSERIR, [
+                    valores_insercao(dados, user_id, codigo, profissional, gestante_id)
+                    for (dados, profissional), codigo, gestante_id in zip(fichas, codigos, gestante_ids)
+                ])
+                ficha_ids = {}
+                for inicio in range(0, len(codigos), 500):
+                    bloco = codigos[inicio:inicio + 500]
+                    ficha_ids.update(cursor.execute(
+                        f"SELECT codigo_ficha, MAX(id) FROM calculos WHERE codigo_ficha IN ({','.join(['?'] * len(bloco))}) "
+                        "GROUP BY codigo_ficha", bloco
+                    ).fetchall())
+                for (dados, _), codigo in zip(fichas, codigos):
+                    gravar_itens(cursor, ficha_ids[codigo], {secao: dados[secao] for secao in SECOES})
+                atualizar_gestantes(cursor, set(gestante_ids))
+            relatorio['importadas'] += len(fichas)
+        if importacao_id is not None:
+            _salvar_andamento(cursor, importacao_id, relatorio, 'processando')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _salvar_andamento(cursor, importacao_id, relatorio, status, mensagem=None):
+    cursor.execute('''
+        UPDATE importacoes SET status = ?, linhas_lidas = ?, importadas = ?, rejeitadas = ?, rejeicoes = ?,
+               mensagem = COALESCE(?, mensagem), atualizada_em = datetime('now', 'localtime'),
+               concluida_em = CASE WHEN ? IN ('concluida', 'falhou') THEN datetime('now', 'localtime') END
+        WHERE id = ?
+    ''', (status, relatorio['linhas_lidas'], relatorio['importadas'], relatorio['rejeitadas'],
+          json.dumps(relatorio['rejeicoes'], ensure_ascii=False), mensagem, status, importacao_id))
+
+
+def importar_planilha(conn, caminho, user_id, profissional, municipios_permitidos=None,
+                      importacao_id=None, lote=LOTE, ao_progredir=None):
+    """Valida e grava as fichas da planilha em lotes; devolve o relatório final.
+
+    Cada linha passa pela mesma validação de salvar_calculadora (fichas.validar_ficha).
+    municipios_permitidos (admin municipal) rejeita linhas de outros municípios.
+    ao_progredir(relatorio) é chamado após cada lote gravado.
+    """
+    relatorio = {'linhas_lidas': 0, 'importadas': 0, 'rejeitadas': 0, 'rejeicoes': []}
+
+    def rejeitar(numero, motivo):
+        relatorio['rejeitadas'] += 1
+        if len(relatorio['rejeicoes']) < MAX_REJEICOES:
+            relatorio['rejeicoes'].append({'linha': numero, 'motivo': motivo})
+
+    pendentes = []
+    for numero, campos in ler_planilha(caminho):
+        relatorio['linhas_lidas'] += 1
+        try:
+            dados = validar_ficha(campos)
+        except FichaInvalida as e:
+            rejeitar(numero, str(e))
+            continue
+        if municipios_permitidos is not None and dados['municipio'] not in municipios_permitidos:
+            rejeitar(numero, f"Município fora do escopo do administrador: {dados['municipio']}.")
+            continue
+        pendentes.append((dados, campos.get('profissional') or profissional))
+        if len(pendentes) >= lote:
+            _gravar_lote(conn, pendentes, user_id, importacao_id, relatorio)
+            pendentes = []
+            if ao_progredir:
+                ao_progredir(relatorio)
+    _gravar_lote(conn, pendentes, user_id, importacao_id, relatorio)
+    if ao_progredir:
+        ao_progredir(relatorio)
+    return relatorio
+
+
+def registrar_importacao(cursor, arquivo, user_id):
+    cursor.execute('INSERT INTO importacoes (arquivo, user_id) VALUES (?, ?)', (arquivo, user_id))
+    return cursor.lastrowid
+
+
+def obter_importacao(cursor, importacao_id):
+    row = cursor.execute('SELECT * FROM importacoes WHERE id = ?', (importacao_id,)).fetchone()
+    if not row:
+        return None
+    importacao = dict(row)
+    importacao['rejeicoes'] = json.loads(importacao['rejeicoes'] or '[]')
+    return importacao
+
+
+def _executar(importacao_id, caminho, user_id, profissional, municipios_permitidos):
+    conn = pool.adquirir()
+    relatorio = {'linhas_lidas': 0, 'importadas': 0, 'rejeitadas': 0, 'rejeicoes': []}
+    try:
+        # Cada lote gravado pode trazer fichas mais recentes de qualquer CPF: o cache de buscar_por_cpf é descartado
+        relatorio = importar_planilha(conn, caminho, user_id, profissional, municipios_permitidos,
+                                      importacao_id=importacao_id, ao_progredir=lambda _: invalidar_cpf())
+        _salvar_andamento(conn.cursor(), importacao_id, relatorio, 'concluida')
+        conn.commit()
+        logging.info(f"Importação {importacao_id}: {relatorio['importadas']} ficha(s) importada(s), "
+                     f"{relatorio['rejeitadas']} linha(s) rejeitada(s).")
+    except Exception as e:
+        logging.error(f"Importação {importacao_id} falhou: {str(e)}", exc_info=True)
+        # Os lotes já gravados ficam; o relatório registra até onde chegou
+        atual = obter_importacao(conn.cursor(), importacao_id) or relatorio
+        _salvar_andamento(conn.cursor(), importacao_id, atual, 'falhou', f'Erro na importação: {str(e)}')
+        conn.commit()
+    finally:
+        conn.close()
+        try:
+            os.remove(caminho)
+        except OSError:
+            pass
+
+
+def iniciar_importacao(importacao_id, caminho, user_id, profissional, municipios_permitidos=None):
+    """Processa a planilha em segundo plano; o andamento é consultado em importacoes."""
+    tarefa = threading.Thread(
+        target=_executar, args=(importacao_id, caminho, user_id, profissional, municipios_permitidos),
+        name=f'importacao-{importacao_id}', daemon=True)
+    tarefa.start()
+    return tarefa
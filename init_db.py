@@ -1,246 +1,471 @@
+import os
 import sqlite3
+from conexao_db import DB_PATH, BUSY_TIMEOUT_MS
+from ficha_itens import SQL_TABELA as SQL_FICHA_ITENS, SQL_INDICE as SQL_INDICE_FICHA_ITENS, preencher_ficha_itens
+from gestantes import SQL_TABELA as SQL_GESTANTES, SQL_INDICES as SQL_INDICES_GESTANTES, preencher_gestantes
+from agregados import SQL_TABELA as SQL_AGREGADOS, reconstruir_agregados
+from busca_nomes import criar_indices_fts
+from importacao import SQL_TABELA as SQL_IMPORTACOES
+from arquivo import garantir_arquivo
+from manutencao import SQL_TABELA as SQL_MANUTENCOES
+from reclassificacao import SQL_TABELA as SQL_RECLASSIFICACOES
+from sincronizacao import SQL_TABELA as SQL_SINCRONIZACOES
+from consulta_cpf import SQL_INDICE as SQL_INDICE_CPF, normalizar_cpfs
 
-def criar_banco():
-    try:
-        conn = sqlite3.connect('banco.db')
-        conn.row_factory = sqlite3.Row  # Para retornar dicionários
-        cursor = conn.cursor()
-        print("Conectado ao banco de dados 'banco.db'.")
-
-        # Criando a tabela de usuários (cadastros normais)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS usuarios (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL,
-            municipio TEXT NOT NULL,
-            cpf TEXT NOT NULL,
-            telefone TEXT NOT NULL,
-            email TEXT NOT NULL UNIQUE,
-            cnes TEXT NOT NULL,
-            profissao TEXT NOT NULL,
-            senha TEXT NOT NULL,
-            approved INTEGER DEFAULT 0,
-            ativo INTEGER DEFAULT 1,
-            is_admin INTEGER DEFAULT 0,
-            is_super_admin INTEGER DEFAULT 0,
-            role TEXT DEFAULT 'comum' CHECK (role IN ('comum', 'municipal', 'estadual'))
-        )
-        ''')
-        print("Tabela 'usuarios' verificada/criada.")
-
-        # Criando a tabela de usuários de apoio
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS usuarios_apoio (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL,
-            cpf TEXT NOT NULL,
-            email TEXT NOT NULL UNIQUE,
-            senha TEXT NOT NULL,
-            municipio TEXT,  -- Opcional, associado ao admin municipal
-            acesso_saude_indigena INTEGER DEFAULT 0,  -- NOVO: 1 = acesso exclusivo ao relatório Saúde Indígena
-            approved INTEGER DEFAULT 1,  -- Usuários de apoio são aprovados automaticamente
-            ativo INTEGER DEFAULT 1
-        )
-        ''')
-        print("Tabela 'usuarios_apoio' verificada/criada.")
-
-        # Criando a tabela de mapeamento de usuários para múltiplos municípios
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS usuario_municipios (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            usuario_id INTEGER NOT NULL,
-            municipio TEXT NOT NULL,
-            FOREIGN KEY (usuario_id) REFERENCES usuarios(id) ON DELETE CASCADE,
-            UNIQUE (usuario_id, municipio)  -- Evita duplicatas de município para o mesmo usuário
-        )
-        ''')
-        print("Tabela 'usuario_municipios' verificada/criada.")
-
-        # Criando a tabela calculos (adicionando genero, sexualidade e raca_cor_etnia)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS calculos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            codigo_ficha TEXT NOT NULL,
-            nome_gestante TEXT NOT NULL,
-            data_nasc TEXT NOT NULL,
-            cpf TEXT NOT NULL,
-            telefone TEXT NOT NULL,
-            municipio TEXT NOT NULL,
-            ubs TEXT NOT NULL,
-            acs TEXT NOT NULL,
-            periodo_gestacional TEXT NOT NULL,
-            data_envio TEXT NOT NULL,
-            pontuacao_total TEXT NOT NULL,
-            classificacao_risco TEXT NOT NULL,
-            imc TEXT,
-            caracteristicas TEXT,
-            avaliacao_nutricional TEXT,
-            comorbidades TEXT,
-            historia_obstetrica TEXT,
-            condicoes_gestacionais TEXT,
-            profissional TEXT,
-            desfecho TEXT,
-            fa INTEGER DEFAULT 0,
-            deficiencia TEXT,
-            genero TEXT,  -- Novo campo
-            sexualidade TEXT,  -- Novo campo
-            raca_cor_etnia TEXT,  -- Novo campo
-            pdf_compartilhado_municipal INTEGER DEFAULT 0,  -- ✅ NOVA COLUNA!
-            FOREIGN KEY (user_id) REFERENCES usuarios(id) ON DELETE CASCADE
-        )
-        ''')
-        print("Tabela 'calculos' verificada/criada.")
-
-        # Criando a tabela acoes_administrativas
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS acoes_administrativas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            admin_id INTEGER NOT NULL,
-            usuario_id INTEGER,  -- Pode referenciar usuarios ou usuarios_apoio
-            acao TEXT NOT NULL,
-            data_acao TEXT NOT NULL,
-            detalhes TEXT,
-            tipo_usuario TEXT,  -- Para distinguir entre 'usuario' e 'apoio'
-            FOREIGN KEY (admin_id) REFERENCES usuarios(id) ON DELETE CASCADE
-        )
+# Índices da base, cada um justificado pela consulta que atende em app.py
+INDICES = [
+    # gerar_pdf, obter_ficha_completa, calculadora, registrar_pnar, verificar_compartilhamento
+    ('idx_calculos_codigo_ficha', 'calculos(codigo_ficha)'),
+    # buscar_historico: fichas ativas do profissional, ordenadas por id
+    ('idx_calculos_user_ativas', 'calculos(user_id, id) WHERE desfecho IS NULL AND fa = 0'),
+    # compartilhar_tudo / compartilhar_tudo_preview: fichas do profissional por município
+    ('idx_calculos_user_municipio', 'calculos(user_id, municipio)'),
+    # registrar_desfecho_lote, marcar_fora_area sem CPF, registrar_pnar
+    ('idx_calculos_gestante', 'calculos(nome_gestante, data_nasc)'),
+    # admin_relatorio / saude_indigena / monitoramento: município + intervalo de datas, DISTINCT municipio
+    ('idx_calculos_municipio_envio_iso', 'calculos(municipio, data_envio_iso)'),
+    # relatórios estaduais: intervalo de datas e ORDER BY data_envio_iso DESC sem ordenar a tabela toda
+    ('idx_calculos_envio_iso', 'calculos(data_envio_iso)'),
+    # admin_relatorio / saude_indigena: gestantes ativas (MAX(id) por gestante) no escopo de municípios
+    ('idx_calculos_ativas_municipio', 'calculos(municipio, id) WHERE desfecho IS NULL AND fa = 0'),
+    # saude_indigena: raca_cor_etnia = 'Indígena' [AND municipio IN (...)]
+    ('idx_calculos_raca_municipio', 'calculos(raca_cor_etnia, municipio)'),
+    # buscar_pnar: fila de alto risco sinalizada, filtrada por ambulatório e ordenada por nome
+    ('idx_calculos_pnar', "calculos(pnar_ambulatorio, nome_gestante) "
+                          "WHERE pnar_sinalizado = 1 AND desfecho IS NULL AND classificacao_risco = 'Alto Risco'"),
+    # monitoramento / admin_senha / admin_painel: usuários por município
+    ('idx_usuarios_municipio', 'usuarios(municipio, ativo)'),
+    # admin_painel: últimas 100 ações administrativas
+    ('idx_acoes_data', 'acoes_administrativas(data_acao)'),
+]
+
+# Índices antigos cobertos pelos acima (idx_calculos_user_municipio cobre user_id;
+# idx_calculos_municipio_envio ordenava data_envio em texto DD/MM/YYYY)
+INDICES_OBSOLETOS = ['idx_calculos_user_id', 'idx_calculos_municipio_envio']
+
+def criar_indices(cursor):
+    for nome in INDICES_OBSOLETOS:
+        cursor.execute(f'DROP INDEX IF EXISTS {nome}')
+    for nome, definicao in INDICES:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {nome} ON {definicao}')
+    # Atualiza as estatísticas do planejador só para as tabelas que mudaram
+    cursor.execute('PRAGMA optimize')
+    print(f"✅ {len(INDICES)} índices verificados/criados.")
+
+# Converte DD/MM/YYYY[ ...] (ou YYYY-MM-DD[ ...]) em YYYY-MM-DD direto no SQL
+_DATA_ISO_SQL = '''
+    CASE
+        WHEN {col} GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]*'
+            THEN substr({col}, 7, 4) || '-' || substr({col}, 4, 2) || '-' || substr({col}, 1, 2)
+        WHEN {col} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'
+            THEN substr({col}, 1, 10)
+    END
+'''
+
+def preencher_datas_iso(cursor):
+    for col in ('data_envio', 'data_nasc'):
+        cursor.execute(f'''
+            UPDATE calculos SET {col}_iso = {_DATA_ISO_SQL.format(col=col)}
+            WHERE {col}_iso IS NULL AND {col} IS NOT NULL
         ''')
-        print("Tabela 'acoes_administrativas' verificada/criada.")
+        print(f"Coluna '{col}_iso' preenchida para {cursor.rowcount} registro(s) antigo(s).")
 
-        # Adicionar a coluna tipo_usuario se ela não existir
-        try:
-            cursor.execute('ALTER TABLE acoes_administrativas ADD COLUMN tipo_usuario TEXT')
-            print("Coluna 'tipo_usuario' adicionada à tabela 'acoes_administrativas'.")
-        except sqlite3.OperationalError as e:
-            if "duplicate column name" in str(e):
-                print("Coluna 'tipo_usuario' já existe na tabela 'acoes_administrativas'.")
-            else:
-                print(f"Erro ao adicionar coluna 'tipo_usuario': {str(e)}")
+def _migracao_estrutura_base(cursor):
+    """Tabelas e colunas do sistema até a introdução do schema_version (idempotente em bancos antigos)."""
+    # Criando a tabela de usuários (cadastros normais)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS usuarios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome TEXT NOT NULL,
+        municipio TEXT NOT NULL,
+        cpf TEXT NOT NULL,
+        telefone TEXT NOT NULL,
+        email TEXT NOT NULL UNIQUE,
+        cnes TEXT NOT NULL,
+        profissao TEXT NOT NULL,
+        senha TEXT NOT NULL,
+        approved INTEGER DEFAULT 0,
+        ativo INTEGER DEFAULT 1,
+        is_admin INTEGER DEFAULT 0,
+        is_super_admin INTEGER DEFAULT 0,
+        role TEXT DEFAULT 'comum' CHECK (role IN ('comum', 'municipal', 'estadual'))
+    )
+    ''')
+    print("Tabela 'usuarios' verificada/criada.")
 
-        # === NOVO: Adicionar coluna acesso_saude_indigena se não existir ===
-        try:
-            cursor.execute('ALTER TABLE usuarios_apoio ADD COLUMN acesso_saude_indigena INTEGER DEFAULT 0')
-            print("Coluna 'acesso_saude_indigena' adicionada à tabela 'usuarios_apoio'.")
-        except sqlite3.OperationalError as e:
-            if "duplicate column name" in str(e):
-                print("Coluna 'acesso_saude_indigena' já existe na tabela 'usuarios_apoio'.")
-            else:
-                print(f"Erro ao adicionar coluna 'acesso_saude_indigena': {str(e)}")
+    # Criando a tabela de usuários de apoio
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS usuarios_apoio (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nome TEXT NOT NULL,
+        cpf TEXT NOT NULL,
+        email TEXT NOT NULL UNIQUE,
+        senha TEXT NOT NULL,
+        municipio TEXT,  -- Opcional, associado ao admin municipal
+        acesso_saude_indigena INTEGER DEFAULT 0,  -- NOVO: 1 = acesso exclusivo ao relatório Saúde Indígena
+        approved INTEGER DEFAULT 1,  -- Usuários de apoio são aprovados automaticamente
+        ativo INTEGER DEFAULT 1
+    )
+    ''')
+    print("Tabela 'usuarios_apoio' verificada/criada.")
+
+    # Criando a tabela de mapeamento de usuários para múltiplos municípios
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS usuario_municipios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario_id INTEGER NOT NULL,
+        municipio TEXT NOT NULL,
+        FOREIGN KEY (usuario_id) REFERENCES usuarios(id) ON DELETE CASCADE,
+        UNIQUE (usuario_id, municipio)  -- Evita duplicatas de município para o mesmo usuário
+    )
+    ''')
+    print("Tabela 'usuario_municipios' verificada/criada.")
+
+    # Criando a tabela calculos (adicionando genero, sexualidade e raca_cor_etnia)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS calculos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        codigo_ficha TEXT NOT NULL,
+        nome_gestante TEXT NOT NULL,
+        data_nasc TEXT NOT NULL,
+        cpf TEXT NOT NULL,
+        telefone TEXT NOT NULL,
+        municipio TEXT NOT NULL,
+        ubs TEXT NOT NULL,
+        acs TEXT NOT NULL,
+        periodo_gestacional TEXT NOT NULL,
+        data_envio TEXT NOT NULL,
+        pontuacao_total TEXT NOT NULL,
+        classificacao_risco TEXT NOT NULL,
+        imc TEXT,
+        caracteristicas TEXT,
+        avaliacao_nutricional TEXT,
+        comorbidades TEXT,
+        historia_obstetrica TEXT,
+        condicoes_gestacionais TEXT,
+        profissional TEXT,
+        desfecho TEXT,
+        fa INTEGER DEFAULT 0,
+        deficiencia TEXT,
+        genero TEXT,  -- Novo campo
+        sexualidade TEXT,  -- Novo campo
+        raca_cor_etnia TEXT,  -- Novo campo
+        pdf_compartilhado_municipal INTEGER DEFAULT 0,  -- ✅ NOVA COLUNA!
+        FOREIGN KEY (user_id) REFERENCES usuarios(id) ON DELETE CASCADE
+    )
+    ''')
+    print("Tabela 'calculos' verificada/criada.")
+
+    # Criando a tabela acoes_administrativas
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS acoes_administrativas (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER NOT NULL,
+        usuario_id INTEGER,  -- Pode referenciar usuarios ou usuarios_apoio
+        acao TEXT NOT NULL,
+        data_acao TEXT NOT NULL,
+        detalhes TEXT,
+        tipo_usuario TEXT,  -- Para distinguir entre 'usuario' e 'apoio'
+        FOREIGN KEY (admin_id) REFERENCES usuarios(id) ON DELETE CASCADE
+    )
+    ''')
+    print("Tabela 'acoes_administrativas' verificada/criada.")
+
+    # Adicionar a coluna tipo_usuario se ela não existir
+    try:
+        cursor.execute('ALTER TABLE acoes_administrativas ADD COLUMN tipo_usuario TEXT')
+        print("Coluna 'tipo_usuario' adicionada à tabela 'acoes_administrativas'.")
+    except sqlite3.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("Coluna 'tipo_usuario' já existe na tabela 'acoes_administrativas'.")
+        else:
+            print(f"Erro ao adicionar coluna 'tipo_usuario': {str(e)}")
+
+    # === NOVO: Adicionar coluna acesso_saude_indigena se não existir ===
+    try:
+        cursor.execute('ALTER TABLE usuarios_apoio ADD COLUMN acesso_saude_indigena INTEGER DEFAULT 0')
+        print("Coluna 'acesso_saude_indigena' adicionada à tabela 'usuarios_apoio'.")
+    except sqlite3.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("Coluna 'acesso_saude_indigena' já existe na tabela 'usuarios_apoio'.")
+        else:
+            print(f"Erro ao adicionar coluna 'acesso_saude_indigena': {str(e)}")
 
 # === NOVO: Adicionar coluna pnar se não existir ===
+    try:
+        cursor.execute('ALTER TABLE usuarios_apoio ADD COLUMN pnar INTEGER DEFAULT 0')
+        print("Coluna 'pnar' adicionada à tabela 'usuarios_apoio'.")
+    except sqlite3.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("Coluna 'pnar' já existe na tabela 'usuarios_apoio'.")
+        else:
+            print(f"Erro ao adicionar coluna 'pnar': {str(e)}")
+
+# === NOVO: Adicionar coluna servico (AMBULATÓRIO) se não existir ===
+    try:
+        cursor.execute('ALTER TABLE usuarios_apoio ADD COLUMN servico TEXT')
+        print("Coluna 'servico' adicionada à tabela 'usuarios_apoio'.")
+    except sqlite3.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print("Coluna 'servico' já existe na tabela 'usuarios_apoio'.")
+        else:
+            print(f"Erro ao adicionar coluna 'servico': {str(e)}")
+
+    # Índice para listagem rápida de apoios ativos + PNAR
+    try:
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_apoio_ativo_pnar ON usuarios_apoio(ativo, pnar, municipio)')
+        print("Índice 'idx_apoio_ativo_pnar' criado com sucesso.")
+    except sqlite3.Error as e:
+        print(f"Aviso: Índice já existe ou erro: {str(e)}")
+
+    # Preencher registros existentes com tipo_usuario = 'usuario'
+    cursor.execute('''
+        UPDATE acoes_administrativas
+        SET tipo_usuario = 'usuario'
+        WHERE tipo_usuario IS NULL
+    ''')
+    print("Registros em 'acoes_administrativas' com tipo_usuario NULL atualizados para 'usuario'.")
+
+    # Atualizar registros existentes com municipio nulo em usuarios
+    cursor.execute('UPDATE usuarios SET municipio = "Não informado" WHERE municipio IS NULL')
+    print("Registros em 'usuarios' com municipio NULL atualizados para 'Não informado'.")
+
+    # Atualizar registros antigos em calculos com CPF padrão
+    cursor.execute('UPDATE calculos SET cpf = "000.000.000-00" WHERE cpf IS NULL OR cpf = ""')
+    print("Registros antigos em 'calculos' atualizados com CPF padrão '000.000.000-00'.")
+
+    # Migrar dados do campo municipio de usuarios para usuario_municipios (caso ainda não tenha sido feito)
+    cursor.execute('''
+        INSERT OR IGNORE INTO usuario_municipios (usuario_id, municipio)
+        SELECT id, municipio FROM usuarios WHERE municipio != "Não informado"
+    ''')
+    print("Dados do campo 'municipio' migrados para a tabela 'usuario_municipios'.")
+
+    # Verificar e adicionar colunas ausentes na tabela usuarios
+    colunas_usuarios = [
+        ('profissao', 'TEXT NOT NULL'),
+        ('approved', 'INTEGER DEFAULT 0'),
+        ('ativo', 'INTEGER DEFAULT 1'),
+        ('is_admin', 'INTEGER DEFAULT 0'),
+        ('is_super_admin', 'INTEGER DEFAULT 0'),
+        ('role', 'TEXT DEFAULT "comum"')
+    ]
+    for coluna, tipo in colunas_usuarios:
         try:
-            cursor.execute('ALTER TABLE usuarios_apoio ADD COLUMN pnar INTEGER DEFAULT 0')
-            print("Coluna 'pnar' adicionada à tabela 'usuarios_apoio'.")
+            cursor.execute(f'ALTER TABLE usuarios ADD COLUMN {coluna} {tipo}')
+            print(f"Coluna '{coluna}' adicionada à tabela 'usuarios'.")
         except sqlite3.OperationalError as e:
             if "duplicate column name" in str(e):
-                print("Coluna 'pnar' já existe na tabela 'usuarios_apoio'.")
+                print(f"Coluna '{coluna}' já existe na tabela 'usuarios'.")
             else:
-                print(f"Erro ao adicionar coluna 'pnar': {str(e)}")
+                print(f"Erro ao adicionar coluna '{coluna}': {str(e)}")
 
-# === NOVO: Adicionar coluna servico (AMBULATÓRIO) se não existir ===
+    # ✅ VERIFICAR E ADICIONAR COLUNAS AUSENTES NA TABELA CALCULOS
+    colunas_calculos = [
+        ('cpf', 'TEXT'),
+        ('fa', 'INTEGER DEFAULT 0'),
+        ('deficiencia', 'TEXT'),
+        ('genero', 'TEXT'),
+        ('sexualidade', 'TEXT'),
+        ('raca_cor_etnia', 'TEXT'),
+        ('etnia_indigena', 'TEXT'),
+        ('pdf_compartilhado_municipal', 'INTEGER DEFAULT 0'),
+        ('fora_area', 'INTEGER DEFAULT 0'),
+        ('pnar_sinalizado', 'INTEGER DEFAULT 0'),     # 1 = já foi pro PNAR
+        ('pnar_ambulatorio', 'TEXT DEFAULT NULL'),    # Nome do ambulatório
+        ('pnar_data_registro', 'TEXT DEFAULT NULL'),  # Quando foi sinalizado
+        ('data_desfecho', 'TEXT'),                    # Data informada em registrar_desfecho_lote
+        ('data_envio_iso', 'TEXT'),                   # data_envio em YYYY-MM-DD (ordenável)
+        ('data_nasc_iso', 'TEXT'),                    # data_nasc em YYYY-MM-DD (ordenável)
+    ]
+    for coluna, tipo in colunas_calculos:
         try:
-            cursor.execute('ALTER TABLE usuarios_apoio ADD COLUMN servico TEXT')
-            print("Coluna 'servico' adicionada à tabela 'usuarios_apoio'.")
+            cursor.execute(f'ALTER TABLE calculos ADD COLUMN {coluna} {tipo}')
+            print(f"Coluna '{coluna}' adicionada à tabela 'calculos'.")
         except sqlite3.OperationalError as e:
             if "duplicate column name" in str(e):
-                print("Coluna 'servico' já existe na tabela 'usuarios_apoio'.")
+                print(f"Coluna '{coluna}' já existe na tabela 'calculos'.")
             else:
-                print(f"Erro ao adicionar coluna 'servico': {str(e)}")
+                print(f"Erro ao adicionar coluna '{coluna}': {str(e)}")
 
-        # Índice para listagem rápida de apoios ativos + PNAR
-        try:
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_apoio_ativo_pnar ON usuarios_apoio(ativo, pnar, municipio)')
-            print("Índice 'idx_apoio_ativo_pnar' criado com sucesso.")
-        except sqlite3.Error as e:
-            print(f"Aviso: Índice já existe ou erro: {str(e)}")
-
-        # Preencher registros existentes com tipo_usuario = 'usuario'
-        cursor.execute('''
-            UPDATE acoes_administrativas
-            SET tipo_usuario = 'usuario'
-            WHERE tipo_usuario IS NULL
-        ''')
-        print("Registros em 'acoes_administrativas' com tipo_usuario NULL atualizados para 'usuario'.")
+    # ✅ ATUALIZAR VALORES PADRÃO PARA TODAS COLUNAS
+    cursor.execute('UPDATE calculos SET deficiencia = "Não informado" WHERE deficiencia IS NULL')    
+    cursor.execute('UPDATE calculos SET genero = "Não informado" WHERE genero IS NULL')
+    cursor.execute('UPDATE calculos SET sexualidade = "Não informado" WHERE sexualidade IS NULL')
+    cursor.execute('UPDATE calculos SET raca_cor_etnia = "Não informado" WHERE raca_cor_etnia IS NULL')
+    cursor.execute('UPDATE calculos SET etnia_indigena = "" WHERE etnia_indigena IS NULL')
+    cursor.execute('UPDATE calculos SET pdf_compartilhado_municipal = 0 WHERE pdf_compartilhado_municipal IS NULL')
+    cursor.execute('UPDATE calculos SET fora_area = 0 WHERE fora_area IS NULL')
+    
+    print("✅ Registros em 'calculos' com deficiencia, genero, sexualidade, raca_cor_etnia, pdf_compartilhado_municipal e fora_area NULL atualizados!")
 
-        # Atualizar registros existentes com municipio nulo em usuarios
-        cursor.execute('UPDATE usuarios SET municipio = "Não informado" WHERE municipio IS NULL')
-        print("Registros em 'usuarios' com municipio NULL atualizados para 'Não informado'.")
+    # Normaliza "ficha ativa" para que os índices parciais (desfecho IS NULL AND fa = 0) sirvam às consultas
+    cursor.execute("UPDATE calculos SET desfecho = NULL WHERE desfecho = ''")
+    cursor.execute('UPDATE calculos SET fa = 0 WHERE fa IS NULL')
 
-        # Atualizar registros antigos em calculos com CPF padrão
-        cursor.execute('UPDATE calculos SET cpf = "000.000.000-00" WHERE cpf IS NULL OR cpf = ""')
-        print("Registros antigos em 'calculos' atualizados com CPF padrão '000.000.000-00'.")
+def _migracao_ficha_itens(cursor):
+    # Itens das seções da ficha (caracteristicas, comorbidades, ...) normalizados, um por linha
+    cursor.execute(SQL_FICHA_ITENS)
+    cursor.execute(SQL_INDICE_FICHA_ITENS)
+    print("Tabela 'ficha_itens' verificada/criada.")
+    preencher_ficha_itens(cursor)
 
-        # Migrar dados do campo municipio de usuarios para usuario_municipios (caso ainda não tenha sido feito)
-        cursor.execute('''
-            INSERT OR IGNORE INTO usuario_municipios (usuario_id, municipio)
-            SELECT id, municipio FROM usuarios WHERE municipio != "Não informado"
-        ''')
-        print("Dados do campo 'municipio' migrados para a tabela 'usuario_municipios'.")
-
-        # Verificar e adicionar colunas ausentes na tabela usuarios
-        colunas_usuarios = [
-            ('profissao', 'TEXT NOT NULL'),
-            ('approved', 'INTEGER DEFAULT 0'),
-            ('ativo', 'INTEGER DEFAULT 1'),
-            ('is_admin', 'INTEGER DEFAULT 0'),
-            ('is_super_admin', 'INTEGER DEFAULT 0'),
-            ('role', 'TEXT DEFAULT "comum"')
-        ]
-        for coluna, tipo in colunas_usuarios:
-            try:
-                cursor.execute(f'ALTER TABLE usuarios ADD COLUMN {coluna} {tipo}')
-                print(f"Coluna '{coluna}' adicionada à tabela 'usuarios'.")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    print(f"Coluna '{coluna}' já existe na tabela 'usuarios'.")
-                else:
-                    print(f"Erro ao adicionar coluna '{coluna}': {str(e)}")
-
-        # ✅ VERIFICAR E ADICIONAR COLUNAS AUSENTES NA TABELA CALCULOS
-        colunas_calculos = [
-            ('cpf', 'TEXT'),
-            ('fa', 'INTEGER DEFAULT 0'),
-            ('deficiencia', 'TEXT'),
-            ('genero', 'TEXT'),
-            ('sexualidade', 'TEXT'),
-            ('raca_cor_etnia', 'TEXT'),
-            ('etnia_indigena', 'TEXT'),
-            ('pdf_compartilhado_municipal', 'INTEGER DEFAULT 0'),
-            ('fora_area', 'INTEGER DEFAULT 0'),
-            ('pnar_sinalizado', 'INTEGER DEFAULT 0'),     # 1 = já foi pro PNAR
-            ('pnar_ambulatorio', 'TEXT DEFAULT NULL'),    # Nome do ambulatório
-            ('pnar_data_registro', 'TEXT DEFAULT NULL'),  # Quando foi sinalizado
-        ]
-        for coluna, tipo in colunas_calculos:
-            try:
-                cursor.execute(f'ALTER TABLE calculos ADD COLUMN {coluna} {tipo}')
-                print(f"Coluna '{coluna}' adicionada à tabela 'calculos'.")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    print(f"Coluna '{coluna}' já existe na tabela 'calculos'.")
-                else:
-                    print(f"Erro ao adicionar coluna '{coluna}': {str(e)}")
-
-        # ✅ ATUALIZAR VALORES PADRÃO PARA TODAS COLUNAS
-        cursor.execute('UPDATE calculos SET deficiencia = "Não informado" WHERE deficiencia IS NULL')    
-        cursor.execute('UPDATE calculos SET genero = "Não informado" WHERE genero IS NULL')
-        cursor.execute('UPDATE calculos SET sexualidade = "Não informado" WHERE sexualidade IS NULL')
-        cursor.execute('UPDATE calculos SET raca_cor_etnia = "Não informado" WHERE raca_cor_etnia IS NULL')
-        cursor.execute('UPDATE calculos SET etnia_indigena = "" WHERE etnia_indigena IS NULL')
-        cursor.execute('UPDATE calculos SET pdf_compartilhado_municipal = 0 WHERE pdf_compartilhado_municipal IS NULL')
-        cursor.execute('UPDATE calculos SET fora_area = 0 WHERE fora_area IS NULL')
-        
-        print("✅ Registros em 'calculos' com deficiencia, genero, sexualidade, raca_cor_etnia, pdf_compartilhado_municipal e fora_area NULL atualizados!")
-
-        conn.commit()
-        print("✅ Banco de dados inicializado com SUCESSO + Apoio Saúde Indígena + COMPARTILHAMENTO PDF + FORA DE ÁREA!")
+def _migracao_gestantes(cursor):
+    # Identidade da gestante + ponteiro para a ficha atual, mantidos pelas rotas que gravam fichas
+    cursor.execute(SQL_GESTANTES)
+    try:
+        cursor.execute('ALTER TABLE calculos ADD COLUMN gestante_id INTEGER REFERENCES gestantes(id)')
+    except sqlite3.OperationalError as e:
+        if "duplicate column name" not in str(e):
+            raise
+    for sql in SQL_INDICES_GESTANTES:
+        cursor.execute(sql)
+    print("Tabela 'gestantes' verificada/criada.")
+    # calculos_completo (com o arquivo) só existe a partir da migração 9
+    preencher_gestantes(cursor, fonte='calculos')
+
+def _migracao_agregados(cursor):
+    # Contadores dos painéis por município/dia, mantidos pelas rotas via agregados.manter_agregados
+    cursor.execute(SQL_AGREGADOS)
+    linhas = reconstruir_agregados(cursor, fonte='calculos')
+    print(f"✅ agregados_diarios: {linhas} linha(s) calculada(s).")
+
+def _migracao_importacoes(cursor):
+    # Andamento e rejeições das importações de planilhas (importacao.py)
+    cursor.execute(SQL_IMPORTACOES)
+
+def _migracao_arquivo(cursor):
+    # Fichas encerradas e antigas (arquivo.py) + visão calculos_completo usada por agregados e gestantes
+    garantir_arquivo(cursor)
+    print("Tabela 'calculos_arquivo' e visão 'calculos_completo' verificadas/criadas.")
+
+def _migracao_manutencoes(cursor):
+    # Andamento das manutenções do banco (backup, ANALYZE, optimize, checkpoint; manutencao.py)
+    cursor.execute(SQL_MANUTENCOES)
+
+def _migracao_reclassificacoes(cursor):
+    # Andamento das reclassificações de fichas após mudança de pesos (reclassificacao.py)
+    cursor.execute(SQL_RECLASSIFICACOES)
 
+def _migracao_sincronizacoes(cursor):
+    # Chaves de idempotência das fichas enviadas pela calculadora (sincronizacao.py)
+    cursor.execute(SQL_SINCRONIZACOES)
+
+def _migracao_cpf_ultima_ficha(cursor):
+    # buscar_por_cpf (consulta_cpf.py): CPF só com dígitos, como grava validar_ficha, e índice da última ficha
+    alteradas = normalizar_cpfs(cursor)
+    cursor.execute(SQL_INDICE_CPF)
+    # Substitui (cpf, municipio): marcar_fora_area passou a filtrar por gestante_id e nenhuma consulta
+    # usa mais CPF + município; dois índices de CPF só custariam mais uma escrita por INSERT/UPDATE
+    cursor.execute('DROP INDEX IF EXISTS idx_calculos_cpf')
+    print(f"CPF normalizado em {alteradas} ficha(s); índice 'idx_calculos_cpf_envio' criado no lugar de 'idx_calculos_cpf'.")
+
+def _migracao_agregados_por_municipio(cursor):
+    # Gestantes, fora de área, desfechos e perfis passam a contar pela ficha mais recente de cada
+    # município (agregados.contribuicoes), não pela ficha atual da gestante: recalcula tudo
+    linhas = reconstruir_agregados(cursor)
+    print(f"✅ agregados_diarios: {linhas} linha(s) recalculada(s) por município.")
+
+# Migrações em ordem. Cada uma roda uma única vez por banco e fica registrada em schema_version;
+# mudanças novas de schema entram SEMPRE no fim da lista, com o próximo número.
+MIGRACOES = [
+    (1, 'estrutura_base', _migracao_estrutura_base),
+    (2, 'datas_iso', preencher_datas_iso),
+    (3, 'ficha_itens', _migracao_ficha_itens),
+    (4, 'indices', criar_indices),
+    (5, 'gestantes', _migracao_gestantes),
+    (6, 'agregados_diarios', _migracao_agregados),
+    (7, 'busca_nomes_fts', criar_indices_fts),
+    (8, 'importacoes', _migracao_importacoes),
+    (9, 'arquivo', _migracao_arquivo),
+    (10, 'manutencoes', _migracao_manutencoes),
+    (11, 'reclassificacoes', _migracao_reclassificacoes),
+    (12, 'sincronizacoes', _migracao_sincronizacoes),
+    (13, 'cpf_ultima_ficha', _migracao_cpf_ultima_ficha),
+    (14, 'agregados_por_municipio', _migracao_agregados_por_municipio),
+]
+VERSAO_ATUAL = MIGRACOES[-1][0]
+
+SQL_SCHEMA_VERSION = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        versao INTEGER PRIMARY KEY,
+        nome TEXT NOT NULL,
+        aplicada_em TEXT NOT NULL
+    )
+"""
+
+def _conectar(caminho):
+    # isolation_level=None: as transações das migrações são controladas explicitamente
+    conn = sqlite3.connect(caminho, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    return conn
+
+def versao_schema(conn):
+    try:
+        return conn.execute('SELECT COALESCE(MAX(versao), 0) FROM schema_version').fetchone()[0]
+    except sqlite3.OperationalError:
+        # Banco anterior ao schema_version (ou ainda vazio)
+        return 0
+
+def migrar(caminho=DB_PATH):
+    """Aplica as migrações pendentes; retorna a lista de versões aplicadas nesta chamada."""
+    conn = _conectar(caminho)
+    aplicadas = []
+    try:
+        print(f"Conectado ao banco de dados '{caminho}'.")
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(SQL_SCHEMA_VERSION)
+        for versao, nome, migracao in MIGRACOES:
+            if versao <= versao_schema(conn):
+                continue
+            # BEGIN IMMEDIATE pega o lock de escrita: outro worker migrando ao mesmo tempo
+            # espera aqui e, ao entrar, encontra a versão já registrada
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if versao <= versao_schema(conn):
+                    conn.execute('COMMIT')
+                    continue
+                print(f"Aplicando migração {versao} ({nome})...")
+                migracao(conn.cursor())
+                conn.execute(
+                    "INSERT INTO schema_version (versao, nome, aplicada_em) VALUES (?, ?, datetime('now', 'localtime'))",
+                    (versao, nome))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            aplicadas.append(versao)
+        print(f"✅ Schema na versão {VERSAO_ATUAL} ({len(aplicadas)} migração(ões) aplicada(s) agora).")
+        return aplicadas
     except sqlite3.Error as e:
         print(f"Erro ao configurar o banco de dados: {str(e)}")
         raise
     finally:
         conn.close()
-        print("Conexão com o banco de dados fechada.")
+
+def garantir_schema(caminho=DB_PATH):
+    """Chamado no boot de cada worker: em regime normal é só uma leitura de schema_version.
+
+    Com DB_MIGRAR_NO_BOOT=0 o worker não migra e recusa subir com schema antigo
+    (as migrações ficam a cargo de "python gerenciar.py migrar" no deploy).
+    """
+    conn = _conectar(caminho)
+    try:
+        versao = versao_schema(conn)
+    finally:
+        conn.close()
+    if versao >= VERSAO_ATUAL:
+        return versao
+    if os.environ.get('DB_MIGRAR_NO_BOOT', '1') == '0':
+        raise RuntimeError(
+            f"Banco na versão {versao} do schema, esperada {VERSAO_ATUAL}: execute 'python gerenciar.py migrar'.")
+    migrar(caminho)
+    return VERSAO_ATUAL
+
+# Nome antigo, mantido para scripts que ainda chamam criar_banco()
+criar_banco = migrar
 
 if __name__ == "__main__":
-    criar_banco()
\ No newline at end of file
+    migrar()
\ No newline at end of file
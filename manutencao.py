@@ -0,0 +1,253 @@
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from conexao_db import BUSY_TIMEOUT_MS, DB_PATH
+
+# Manutenção do banco sem tirar o sistema do ar: backup compactado (VACUUM INTO) ou incremental
+# (API de backup), rotação dos arquivos de backup, ANALYZE, PRAGMA optimize, compactação
+# incremental e checkpoint do WAL. Em WAL nenhuma dessas etapas segura o lock de escrita por
+# muito tempo: o backup é uma leitura, a compactação anda em passos curtos e o checkpoint só
+# trunca o WAL quando não há leitor atrasado.
+# O andamento fica na tabela manutencoes (rota /admin/manutencao_banco e gerenciar.py).
+SQL_TABELA = '''
+    CREATE TABLE IF NOT EXISTS manutencoes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER REFERENCES usuarios(id),   -- NULL quando iniciada pela linha de comando
+        opcoes TEXT NOT NULL DEFAULT '{}',
+        status TEXT NOT NULL DEFAULT 'pendente',   -- pendente, executando, concluida, falhou
+        etapa TEXT,
+        progresso INTEGER NOT NULL DEFAULT 0,      -- 0 a 100
+        resultado TEXT NOT NULL DEFAULT '{}',
+        mensagem TEXT,
+        iniciada_em TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+        atualizada_em TEXT,
+        concluida_em TEXT
+    )
+'''
+
+BACKUP_DIR = os.environ.get('DB_BACKUP_DIR', 'backups')
+BACKUPS_MANTIDOS = int(os.environ.get('DB_BACKUPS_MANTIDOS', 7))
+MODOS_BACKUP = ('vacuum', 'incremental')
+PAGINAS_POR_PASSO = 1024    # backup incremental e incremental_vacuum: páginas por passo
+
+ETAPAS = ('backup', 'rotacao', 'analyze', 'optimize', 'compactacao', 'checkpoint')
+
+
+class ManutencaoEmAndamento(RuntimeError):
+    pass
+
+
+def _conectar(caminho):
+    conn = sqlite3.connect(caminho, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    return conn
+
+
+def _tamanho(caminho):
+    return sum(os.path.getsize(arquivo) for arquivo in (caminho, caminho + '-wal') if os.path.exists(arquivo))
+
+
+def _ms(inicio):
+    return round((time.perf_counter() - inicio) * 1000, 1)
+
+
+def fazer_backup(conn, diretorio=BACKUP_DIR, modo='vacuum', ao_progredir=None):
+    """Grava um backup em diretorio e devolve {'arquivo', 'bytes', 'duracao_ms', 'modo'}.
+
+    'vacuum' usa VACUUM INTO (cópia já compactada, uma leitura só); 'incremental' usa a API de
+    backup em passos de PAGINAS_POR_PASSO, informando o progresso (ao_progredir(feitas, total)).
+    """
+    if modo not in MODOS_BACKUP:
+        raise ValueError(f"Modo de backup inválido: {modo}.")
+    os.makedirs(diretorio, exist_ok=True)
+    inicio = time.perf_counter()
+    nome_base = os.path.splitext(os.path.basename(conn.execute('PRAGMA database_list').fetchone()['file']))[0]
+    carimbo = datetime.now().strftime('%Y%m%d_%H%M%S')
+    destino = os.path.join(diretorio, f'{nome_base}_{carimbo}.db')
+    sequencia = 1
+    while os.path.exists(destino):   # VACUUM INTO não sobrescreve; duas execuções no mesmo segundo
+        sequencia += 1
+        destino = os.path.join(diretorio, f'{nome_base}_{carimbo}_{sequencia}.db')
+    if modo == 'vacuum':
+        conn.execute('VACUUM INTO ?', (destino,))
+    else:
+        copia = sqlite3.connect(destino)
+        try:
+            def progresso(status, restantes, total):
+                if ao_progredir:
+                    ao_progredir(total - restantes, total)
+            conn.backup(copia, pages=PAGINAS_POR_PASSO, progress=progresso)
+        finally:
+            copia.close()
+    return {'arquivo': destino, 'bytes': os.path.getsize(destino), 'duracao_ms': _ms(inicio), 'modo': modo}
+
+
+def rotacionar_backups(diretorio=BACKUP_DIR, manter=BACKUPS_MANTIDOS, nome_base=None):
+    """Apaga os backups mais antigos além dos `manter` mais recentes; devolve os removidos."""
+    padrao = f'{nome_base}_*.db' if nome_base else '*.db'
+    arquivos = sorted(glob.glob(os.path.join(diretorio, padrao)), key=os.path.getmtime, reverse=True)
+    removidos = []
+    for arquivo in arquivos[max(manter, 0):]:
+        try:
+            os.remove(arquivo)
+            removidos.append(arquivo)
+        except OSError as e:
+            logging.warning(f"Não foi possível remover o backup {arquivo}: {str(e)}")
+    return removidos
+
+
+def compactar(conn, ao_progredir=None):
+    """Devolve as páginas livres ao sistema de arquivos com incremental_vacuum, em passos curtos.
+
+    Só tem efeito com auto_vacuum = INCREMENTAL (ativar_auto_vacuum); nos outros modos apenas
+    informa quantas páginas livres existem (o backup com VACUUM INTO já sai compactado).
+    """
+    modo = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    livres_antes = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    resultado = {'auto_vacuum': {0: 'none', 1: 'full', 2: 'incremental'}.get(modo, modo),
+                 'paginas_livres_antes': livres_antes}
+    if modo == 2:
+        restantes = livres_antes
+        while restantes:
+            # Cada passo é uma transação curta: as escritas da aplicação entram entre eles
+            conn.execute(f'PRAGMA incremental_vacuum({PAGINAS_POR_PASSO})').fetchall()
+            anteriores, restantes = restantes, conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if ao_progredir:
+                ao_progredir(max(livres_antes - restantes, 0), livres_antes)
+            if restantes >= anteriores:
+                break   # páginas liberadas por escritas concorrentes: fica para a próxima
+    resultado['paginas_livres_depois'] = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return resultado
+
+
+def checkpoint(conn):
+    """Checkpoint do WAL: PASSIVE (não espera ninguém) e TRUNCATE só se tudo já foi copiado."""
+    ocupado, paginas_log, copiadas = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    modo = 'PASSIVE'
+    if not ocupado and paginas_log >= 0 and paginas_log == copiadas:
+        ocupado, paginas_log, copiadas = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        modo = 'TRUNCATE'
+    return {'modo': modo, 'ocupado': ocupado, 'paginas_log': paginas_log, 'paginas_copiadas': copiadas}
+
+
+def ativar_auto_vacuum(caminho=DB_PATH):
+    """Passa o banco para auto_vacuum = INCREMENTAL. Exige um VACUUM completo (bloqueia as escritas)."""
+    conn = _conectar(caminho)
+    try:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    finally:
+        conn.close()
+
+
+def executar_manutencao(caminho=DB_PATH, backup=True, modo_backup='vacuum', diretorio=BACKUP_DIR,
+                        manter=BACKUPS_MANTIDOS, analisar=True, compactacao=True, ao_progredir=None):
+    """Roda as etapas pedidas e devolve o resultado de cada uma.
+
+    ao_progredir(etapa, progresso) recebe o nome da etapa e o progresso geral (0 a 100).
+    """
+    etapas = [etapa for etapa in ETAPAS
+              if (etapa not in ('backup', 'rotacao') or backup)
+              and (etapa != 'analyze' or analisar)
+              and (etapa != 'compactacao' or compactacao)]
+    resultado = {'tamanho_antes': _tamanho(caminho)}
+
+    def avisar(etapa, fracao=0.0):
+        if ao_progredir:
+            feitas = etapas.index(etapa) + fracao
+            ao_progredir(etapa, int(feitas * 100 / len(etapas)))
+
+    conn = _conectar(caminho)
+    try:
+        for etapa in etapas:
+            avisar(etapa)
+            inicio = time.perf_counter()
+            if etapa == 'backup':
+                resultado['backup'] = fazer_backup(
+                    conn, diretorio, modo_backup,
+                    lambda feitas, total: avisar('backup', feitas / total if total else 1))
+            elif etapa == 'rotacao':
+                nome_base = os.path.splitext(os.path.basename(caminho))[0]
+                resultado['backups_removidos'] = rotacionar_backups(diretorio, manter, nome_base)
+            elif etapa == 'analyze':
+                conn.execute('ANALYZE')
+                resultado['analyze_ms'] = _ms(inicio)
+            elif etapa == 'optimize':
+                conn.execute('PRAGMA optimize')
+                resultado['optimize_ms'] = _ms(inicio)
+            elif etapa == 'compactacao':
+                resultado['compactacao'] = compactar(
+                    conn, lambda feitas, total: avisar('compactacao', feitas / total if total else 1))
+                resultado['compactacao']['duracao_ms'] = _ms(inicio)
+            elif etapa == 'checkpoint':
+                resultado['checkpoint'] = checkpoint(conn)
+    finally:
+        conn.close()
+    resultado['tamanho_depois'] = _tamanho(caminho)
+    if ao_progredir:
+        ao_progredir('concluida', 100)
+    return resultado
+
+
+def registrar_manutencao(cursor, user_id, opcoes):
+    """Cria o registro da manutenção; recusa se já houver outra pendente ou executando."""
+    andamento = cursor.execute(
+        "SELECT id FROM manutencoes WHERE status IN ('pendente', 'executando') ORDER BY id DESC LIMIT 1").fetchone()
+    if andamento:
+        raise ManutencaoEmAndamento(f"Manutenção {andamento[0]} ainda em andamento.")
+    cursor.execute('INSERT INTO manutencoes (user_id, opcoes) VALUES (?, ?)', (user_id, json.dumps(opcoes)))
+    return cursor.lastrowid
+
+
+def obter_manutencao(cursor, manutencao_id):
+    row = cursor.execute('SELECT * FROM manutencoes WHERE id = ?', (manutencao_id,)).fetchone()
+    if not row:
+        return None
+    manutencao = dict(row)
+    manutencao['opcoes'] = json.loads(manutencao['opcoes'] or '{}')
+    manutencao['resultado'] = json.loads(manutencao['resultado'] or '{}')
+    return manutencao
+
+
+def _salvar_andamento(conn, manutencao_id, status, etapa, progresso, resultado=None, mensagem=None):
+    conn.execute('''
+        UPDATE manutencoes SET status = ?, etapa = ?, progresso = ?, resultado = COALESCE(?, resultado),
+               mensagem = COALESCE(?, mensagem), atualizada_em = datetime('now', 'localtime'),
+               concluida_em = CASE WHEN ? IN ('concluida', 'falhou') THEN datetime('now', 'localtime') END
+        WHERE id = ?
+    ''', (status, etapa, progresso, json.dumps(resultado) if resultado is not None else None,
+          mensagem, status, manutencao_id))
+
+
+def _executar(manutencao_id, caminho, opcoes):
+    conn = _conectar(caminho)
+    try:
+        def progresso(etapa, percentual):
+            _salvar_andamento(conn, manutencao_id, 'executando', etapa, percentual)
+
+        resultado = executar_manutencao(caminho, ao_progredir=progresso, **opcoes)
+        _salvar_andamento(conn, manutencao_id, 'concluida', 'concluida', 100, resultado)
+        logging.info(f"Manutenção {manutencao_id} concluída: {json.dumps(resultado)}")
+    except Exception as e:
+        logging.error(f"Manutenção {manutencao_id} falhou: {str(e)}", exc_info=True)
+        atual = obter_manutencao(conn.cursor(), manutencao_id) or {}
+        _salvar_andamento(conn, manutencao_id, 'falhou', atual.get('etapa'), atual.get('progresso', 0),
+                          mensagem=f'Erro na manutenção: {str(e)}')
+    finally:
+        conn.close()
+
+
+def iniciar_manutencao(manutencao_id, opcoes, caminho=DB_PATH):
+    """Roda a manutenção em segundo plano; o andamento é consultado em manutencoes."""
+    tarefa = threading.Thread(target=_executar, args=(manutencao_id, caminho, opcoes),
+                              name=f'manutencao-{manutencao_id}', daemon=True)
+    tarefa.start()
+    return tarefa
@@ -0,0 +1,146 @@
+from collections import Counter
+
+from agregados import manter_agregados
+from gestantes import atualizar_gestantes, vincular_ficha
+
+# Desfechos e fora de área de várias gestantes numa só transação (conciliação mensal do município).
+# As gestantes são resolvidas com um JOIN contra VALUES (...) e as fichas atualizadas com
+# UPDATE ... WHERE gestante_id IN (...) / executemany, em vez de uma requisição por gestante.
+LOTE_MAXIMO = 2000   # operações por requisição
+_BLOCO = 300         # linhas por VALUES / IN (...), abaixo do limite de 999 variáveis do SQLite antigo
+
+TIPOS = ('desfecho', 'fora_area')
+
+
+def _blocos(itens, tamanho=_BLOCO):
+    for inicio in range(0, len(itens), tamanho):
+        yield itens[inicio:inicio + tamanho]
+
+
+def _resolver_desfechos(cursor, pendentes):
+    """{indice: set(gestante_id)} das gestantes com ficha sem desfecho para cada (nome, data_nasc)."""
+    encontrados = {}
+    for bloco in _blocos(pendentes):
+        valores = ', '.join(['(?, ?, ?)'] * len(bloco))
+        params = [v for indice, op in bloco for v in (indice, op['nome_gestante'], op['data_nasc'])]
+        for row in cursor.execute(f'''
+            WITH alvo(indice, nome_gestante, data_nasc) AS (VALUES {valores})
+            SELECT DISTINCT alvo.indice, c.gestante_id
+            FROM alvo JOIN calculos c
+              ON c.nome_gestante = alvo.nome_gestante AND c.data_nasc = alvo.data_nasc
+            WHERE c.desfecho IS NULL AND c.gestante_id IS NOT NULL
+        ''', params).fetchall():
+            encontrados.setdefault(row[0], set()).add(row[1])
+    return encontrados
+
+
+def _resolver_fora_area(cursor, user_id, pendentes):
+    """{indice: (ficha_id, cpf, municipio, gestante_id)} da ficha informada, do próprio profissional e ainda na área."""
+    encontrados = {}
+    for bloco in _blocos(pendentes):
+        valores = ', '.join(['(?, ?, ?, ?)'] * len(bloco))
+        params = [v for indice, op in bloco
+                  for v in (indice, op['codigo_ficha'], op['nome_gestante'], op['data_nasc'])]
+        for row in cursor.execute(f'''
+            WITH alvo(indice, codigo_ficha, nome_gestante, data_nasc) AS (VALUES {valores})
+            SELECT alvo.indice, c.id, c.cpf, c.municipio, c.gestante_id
+            FROM alvo JOIN calculos c
+              ON c.nome_gestante = alvo.nome_gestante AND c.data_nasc = alvo.data_nasc
+             AND c.codigo_ficha = alvo.codigo_ficha
+            WHERE c.user_id = ? AND c.fa = 0
+        ''', params + [user_id]).fetchall():
+            encontrados.setdefault(row[0], tuple(row[1:]))
+    return encontrados
+
+
+def _contar_fichas(cursor, gestante_ids, condicao):
+    """{(gestante_id, municipio): fichas} que satisfazem a condição, contadas antes do UPDATE."""
+    contagem = {}
+    for bloco in _blocos(sorted(set(gestante_ids))):
+        for row in cursor.execute(f'''
+            SELECT gestante_id, municipio, COUNT(*) FROM calculos
+            WHERE gestante_id IN ({','.join(['?'] * len(bloco))}) AND {condicao}
+            GROUP BY gestante_id, municipio
+        ''', bloco).fetchall():
+            contagem[(row[0], row[1])] = row[2]
+    return contagem
+
+
+def aplicar_operacoes(cursor, user_id, operacoes, data_desfecho):
+    """Aplica as operações já validadas e devolve um resultado por operação, na mesma ordem.
+
+    Cada operação é {'tipo': 'desfecho', 'nome_gestante', 'data_nasc', 'desfecho'} ou
+    {'tipo': 'fora_area', 'codigo_ficha', 'nome_gestante', 'data_nasc'}. Roda na transação do
+    chamador: o commit (ou rollback) fica com a rota.
+    """
+    resultados = [None] * len(operacoes)
+    por_tipo = {tipo: [(i, op) for i, op in enumerate(operacoes) if op['tipo'] == tipo] for tipo in TIPOS}
+
+    # === RESOLUÇÃO (um JOIN por bloco de operações) ===
+    desfecho_ids = _resolver_desfechos(cursor, por_tipo['desfecho'])
+    fora_area_fichas = _resolver_fora_area(cursor, user_id, por_tipo['fora_area'])
+
+    desfechos = {}      # indice -> (desfecho, [gestante_id])
+    fora_area = {}      # indice -> (gestante_id, municipio)
+    com_desfecho = {}   # gestante_id -> indice da operação que já registra o desfecho dela
+    fora_vistas = {}    # (gestante_id, municipio) -> indice
+    for indice, op in por_tipo['desfecho']:
+        ids = sorted(desfecho_ids.get(indice, ()))
+        if not ids:
+            resultados[indice] = {'success': False, 'message': 'Nenhuma ficha sem desfecho para o nome e data de nascimento.'}
+            continue
+        repetida = next((com_desfecho[gid] for gid in ids if gid in com_desfecho), None)
+        if repetida is not None:
+            resultados[indice] = {'success': False, 'message': f'Gestante já incluída na operação {repetida}.'}
+            continue
+        for gid in ids:
+            com_desfecho[gid] = indice
+        desfechos[indice] = (op['desfecho'], ids)
+
+    for indice, op in por_tipo['fora_area']:
+        registro = fora_area_fichas.get(indice)
+        if not registro:
+            resultados[indice] = {'success': False, 'message': 'Registro não encontrado ou já marcado como fora de área.'}
+            continue
+        ficha_id, cpf, municipio, gestante_id = registro
+        if gestante_id is None:
+            gestante_id = vincular_ficha(cursor, ficha_id, cpf, op['nome_gestante'], op['data_nasc'])
+        if (gestante_id, municipio) in fora_vistas:
+            resultados[indice] = {'success': False,
+                                  'message': f'Gestante já incluída na operação {fora_vistas[(gestante_id, municipio)]}.'}
+            continue
+        fora_vistas[(gestante_id, municipio)] = indice
+        fora_area[indice] = (gestante_id, municipio)
+
+    # Fichas afetadas por operação, contadas antes das escritas
+    sem_desfecho = _contar_fichas(
+        cursor, [gid for _, ids in desfechos.values() for gid in ids], 'desfecho IS NULL')
+    na_area = _contar_fichas(cursor, [gid for gid, _ in fora_area.values()], 'fa = 0')
+
+    # === ESCRITA (set-based, dentro de uma única manutenção dos agregados) ===
+    gestante_ids = sorted({gid for _, ids in desfechos.values() for gid in ids}
+                          | {gid for gid, _ in fora_area.values()})
+    with manter_agregados(cursor, gestante_ids):
+        por_desfecho = {}
+        for desfecho, ids in desfechos.values():
+            por_desfecho.setdefault(desfecho, []).extend(ids)
+        for desfecho, ids in por_desfecho.items():
+            for bloco in _blocos(ids):
+                cursor.execute(f'''
+                    UPDATE calculos SET desfecho = ?, data_desfecho = ?
+                    WHERE gestante_id IN ({','.join(['?'] * len(bloco))}) AND desfecho IS NULL
+                ''', [desfecho, data_desfecho] + bloco)
+        cursor.executemany(
+            'UPDATE calculos SET fa = 1 WHERE gestante_id = ? AND municipio = ? AND fa = 0',
+            list(fora_area.values()))
+        atualizar_gestantes(cursor, gestante_ids)
+
+    sem_desfecho_por_gestante = Counter()
+    for (gid, _), total in sem_desfecho.items():
+        sem_desfecho_por_gestante[gid] += total
+    for indice, (_, ids) in desfechos.items():
+        fichas = sum(sem_desfecho_por_gestante[gid] for gid in ids)
+        resultados[indice] = {'success': True, 'fichas_atualizadas': fichas}
+    for indice, chave in fora_area.items():
+        resultados[indice] = {'success': True, 'fichas_atualizadas': na_area.get(chave, 0)}
+    return resultados
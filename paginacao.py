@@ -0,0 +1,77 @@
+import base64
+import binascii
+import json
+
+# Paginação por chave (keyset): a página seguinte começa depois da (coluna de ordenação, id)
+# da última linha, então a página 500 custa o mesmo que a página 1 (sem OFFSET).
+# O cursor é opaco para o cliente: base64 de {"o": "<ordem>:<direção>", "v": [valor, id]}.
+
+
+class CursorInvalido(ValueError):
+    pass
+
+
+def codificar_cursor(ordem, valores):
+    bruto = json.dumps({'o': ordem, 'v': list(valores)}, separators=(',', ':'), ensure_ascii=False)
+    return base64.urlsafe_b64encode(bruto.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor(token, ordem, tamanho):
+    try:
+        bruto = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        dados = json.loads(bruto.decode('utf-8'))
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise CursorInvalido('Cursor de paginação inválido.')
+    if not isinstance(dados, dict) or dados.get('o') != ordem or len(dados.get('v') or []) != tamanho:
+        raise CursorInvalido('Cursor de paginação não corresponde à ordenação pedida.')
+    return dados['v']
+
+
+class Pagina:
+    def __init__(self, itens, proximo, anterior):
+        self.itens = itens
+        self.proximo = proximo      # cursor para a página seguinte (None na última)
+        self.anterior = anterior    # cursor para a página anterior (None na primeira)
+
+
+def paginar(cursor, colunas, origem, params, ordem, direcao, por_pagina, depois=None, antes=None):
+    """Uma página de SELECT {colunas} FROM {origem} ordenada por (ordem, id).
+
+    origem deve terminar em uma cláusula WHERE (o filtro do cursor é acrescentado com AND).
+    ordem é a expressão SQL de ordenação ('id' para ordenar só pelo id); direcao é 'ASC' ou 'DESC'.
+    depois/antes são cursores recebidos do cliente (no máximo um dos dois).
+    """
+    chave = f'{ordem}:{direcao}'
+    expressoes = ['id'] if ordem == 'id' else [ordem, 'id']
+    recuando = bool(antes) and not depois
+    token = antes if recuando else depois
+
+    # Recuar é percorrer na direção oposta a partir do primeiro item e inverter o resultado
+    direcao_sql = direcao if not recuando else ('ASC' if direcao == 'DESC' else 'DESC')
+    operador = '<' if direcao_sql == 'DESC' else '>'
+
+    sql = f"SELECT {colunas}, {', '.join(f'{e} AS _chave{i}' for i, e in enumerate(expressoes))} FROM {origem}"
+    params = list(params)
+    if token:
+        valores = decodificar_cursor(token, chave, len(expressoes))
+        sql += f" AND ({', '.join(expressoes)}) {operador} ({', '.join(['?'] * len(expressoes))})"
+        params.extend(valores)
+    sql += f" ORDER BY {', '.join(f'{e} {direcao_sql}' for e in expressoes)} LIMIT ?"
+    params.append(por_pagina + 1)
+
+    linhas = [dict(row) for row in cursor.execute(sql, params).fetchall()]
+    tem_mais = len(linhas) > por_pagina
+    linhas = linhas[:por_pagina]
+    if recuando:
+        linhas.reverse()
+
+    chaves = [[linha.pop(f'_chave{i}') for i in range(len(expressoes))] for linha in linhas]
+    if not linhas:
+        return Pagina([], None, None)
+    if recuando:
+        proximo = codificar_cursor(chave, chaves[-1])
+        anterior = codificar_cursor(chave, chaves[0]) if tem_mais else None
+    else:
+        proximo = codificar_cursor(chave, chaves[-1]) if tem_mais else None
+        anterior = codificar_cursor(chave, chaves[0]) if token else None
+    return Pagina(linhas, proximo, anterior)
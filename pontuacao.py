@@ -0,0 +1,204 @@
+import hashlib
+import json
+
+import numpy as np
+
+from ficha_itens import SECOES, decodificar_secao
+
+# Pontuação de risco da calculadora no servidor: os mesmos pesos e faixas do calcularPontuacao()
+# de calculadora.html, que agora os recebe daqui (/pontuacao/pesos). Os códigos são os values dos
+# checkboxes de cada seção, gravados nas colunas JSON de calculos (e em ficha_itens).
+
+PESOS = {
+    'caracteristicas': {
+        '15anos': 3,
+        '40anos': 2,
+        'nao_aceita_gravidez': 1,
+        'violencia_domestica': 2,
+        'rua_indigena_quilombola': 2,
+        'sem_escolaridade': 1,
+        'tabagista_ativo': 2,
+        'raca_negra': 2,
+    },
+    'avaliacao_nutricional': {
+        'baixo_peso': 2,
+        'sobrepeso': 1,
+        'obesidade1': 5,
+        'obesidade_morbida': 10,
+    },
+    'comorbidades': {
+        'aids_hiv': 10,
+        'alteracoes_tireoide': 10,
+        'diabetes_mellitus': 10,
+        'endocrinopatias': 10,
+        'cardiopatia': 10,
+        'cancer': 10,
+        'cirurgia_bariatrica': 10,
+        'doencas_autoimunes': 10,
+        'doencas_psiquiatricas': 5,
+        'doenca_renal': 10,
+        'dependencia_drogas': 10,
+        'epilepsia': 10,
+        'hepatites': 5,
+        'has_controlada': 5,
+        'has_complicada': 10,
+        'ginecopatia': 5,
+        'pneumopatia': 10,
+        'tuberculose': 10,
+        'trombofilia': 10,
+        'teratogenico': 5,
+        'varizes': 1,
+        'doencas_hematologicas': 10,
+        'transplantada': 10,
+    },
+    'historia_obstetrica': {
+        'abortamentos': 5,
+        'abortamentos_consecutivos': 10,
+        'prematuros': 10,
+        'obito_fetal': 10,
+        'preeclampsia': 10,
+        'eclampsia': 10,
+        'hipertensao_gestacional': 5,
+        'acretismo': 2,
+        'descolamento_placenta': 5,
+        'insuficiencia_istmo': 10,
+        'restricao_crescimento': 2,
+        'malformacao_fetal': 2,
+        'isoimunizacao': 10,
+        'diabetes_gestacional': 2,
+        'psicose_puerperal': 5,
+        'tromboembolia': 10,
+    },
+    'condicoes_gestacionais': {
+        'ameaca_aborto': 2,
+        'acretismo_placentario_atual': 10,
+        'placenta_previa': 10,
+        'anemia_grave': 10,
+        'citologia_anormal': 3,
+        'tireoide_gestacao': 10,
+        'diabetes_gestacional_atual': 10,
+        'doenca_hipertensiva': 10,
+        'doppler_anormal': 5,
+        'doenca_hemolitica': 10,
+        'gemelar': 10,
+        'isoimunizacao_rh': 10,
+        'insuficiencia_istmo_atual': 10,
+        'colo_curto': 10,
+        'malformacao_congenita': 10,
+        'neoplasia_cancer': 10,
+        'polidramnio_oligodramnio': 10,
+        'restricao_crescimento_atual': 10,
+        'toxoplasmose': 10,
+        'sifilis_complicada': 10,
+        'infeccao_urinaria_repeticao': 10,
+        'hiv_htlv_hepatites': 10,
+        'condiloma_acuminado': 5,
+        'feto_percentil': 5,
+        'hepatopatias': 10,
+        'hanseníase': 10,
+        'tuberculose_gestacao': 10,
+        'dependencia_drogas_atual': 10,
+    },
+}
+
+# A calculadora grava os subitens do submenu (situação de rua, indígena, quilombola) no lugar de
+# rua_indigena_quilombola; eles não pontuam sozinhos, mas valem o item principal (uma vez só)
+SUBITENS = {
+    'caracteristicas': {
+        'situacao_rua': 'rua_indigena_quilombola',
+        'indigena': 'rua_indigena_quilombola',
+        'quilombola': 'rua_indigena_quilombola',
+    },
+}
+
+# Faixas: até MEDIO - 1 pontos Risco Habitual, de MEDIO a ALTO - 1 Médio Risco, ALTO ou mais Alto Risco
+LIMIAR_MEDIO = 5
+LIMIAR_ALTO = 10
+CLASSIFICACOES = ('Risco Habitual', 'Médio Risco', 'Alto Risco')
+
+# Coluna de cada (seção, código) na matriz de presença de pontuar_lote; subitens apontam para a do principal
+_COLUNAS = {}
+for _secao in SECOES:
+    for _codigo in PESOS[_secao]:
+        _COLUNAS[(_secao, _codigo)] = len(_COLUNAS)
+for _secao, _subitens in SUBITENS.items():
+    for _codigo, _principal in _subitens.items():
+        _COLUNAS[(_secao, _codigo)] = _COLUNAS[(_secao, _principal)]
+_VETOR_PESOS = np.array([PESOS[secao][codigo] for secao in SECOES for codigo in PESOS[secao]], dtype=np.int32)
+_VETOR_CLASSIFICACOES = np.array(CLASSIFICACOES, dtype=object)
+
+
+def classificar(pontos):
+    """Classificação de risco para uma pontuação total."""
+    if pontos >= LIMIAR_ALTO:
+        return CLASSIFICACOES[2]
+    if pontos >= LIMIAR_MEDIO:
+        return CLASSIFICACOES[1]
+    return CLASSIFICACOES[0]
+
+
+def _codigos(ficha, secao):
+    # Ficha (ficha_registro) decodifica a seção com cache; dicts e request.form trazem lista ou JSON
+    if hasattr(ficha, 'itens'):
+        return ficha.itens(secao)
+    return decodificar_secao(ficha.get(secao))
+
+
+def _colunas(ficha):
+    colunas = set()
+    for secao in SECOES:
+        for codigo in _codigos(ficha, secao):
+            coluna = _COLUNAS.get((secao, codigo))
+            if coluna is not None:
+                colunas.add(coluna)
+    return colunas
+
+
+def pontuar_ficha(ficha):
+    """(pontuacao_total, classificacao_risco) de uma ficha: mapeamento seção -> códigos (lista ou JSON).
+
+    Cada item conta uma vez; códigos desconhecidos não pontuam.
+    """
+    pontos = int(sum(int(_VETOR_PESOS[coluna]) for coluna in _colunas(ficha)))
+    return pontos, classificar(pontos)
+
+
+def classificar_lote(pontos):
+    """Classificações (array de str) para um array de pontuações."""
+    faixas = np.digitize(np.asarray(pontos), (LIMIAR_MEDIO, LIMIAR_ALTO))
+    return _VETOR_CLASSIFICACOES[faixas]
+
+
+def pontuar_lote(fichas):
+    """Pontuações e classificações de muitas fichas de uma vez: (array int32, array de str).
+
+    Monta a matriz de presença fichas x itens (uint8, repetições viram 1) e multiplica pelo vetor
+    de pesos, em vez de somar item a item em Python.
+    """
+    linhas, colunas = [], []
+    total = 0
+    for linha, ficha in enumerate(fichas):
+        total = linha + 1
+        for coluna in _colunas(ficha):
+            linhas.append(linha)
+            colunas.append(coluna)
+    presenca = np.zeros((total, len(_VETOR_PESOS)), dtype=np.uint8)
+    presenca[np.array(linhas, dtype=np.intp), np.array(colunas, dtype=np.intp)] = 1
+    pontos = presenca @ _VETOR_PESOS
+    return pontos, classificar_lote(pontos)
+
+
+def pesos_publicos():
+    """Pesos e faixas no formato que a calculadora usa (código -> pontos, sem seção)."""
+    return {
+        'pesos': {codigo: pontos for secao in SECOES for codigo, pontos in PESOS[secao].items()},
+        'limiar_medio': LIMIAR_MEDIO,
+        'limiar_alto': LIMIAR_ALTO,
+        'classificacoes': list(CLASSIFICACOES),
+    }
+
+
+def versao_pesos():
+    """Identificador curto dos pesos e faixas atuais; muda quando o protocolo muda algum peso."""
+    regras = dict(pesos_publicos(), subitens=SUBITENS)
+    return hashlib.sha1(json.dumps(regras, sort_keys=True).encode('utf-8')).hexdigest()[:12]
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, has_app_context, session
+
+# Quem está logado (linha de usuarios ou de usuarios_apoio), montado uma vez por requisição em
+# flask.g: os decoradores (admin_required, apoio_required, ...), load_user e a própria rota
+# usam o mesmo objeto em vez de cada um consultar o usuário de novo. Entre requisições o
+# principal fica TTL_S segundos num cache do worker; as rotas que alteram usuários chamam
+# invalidar_principal, e nos outros workers a mudança vale quando o TTL vence. O cache é um LRU
+# de até MAXIMO usuários, então o worker não guarda todo id que já atendeu.
+TTL_S = float(os.environ.get('PRINCIPAL_TTL_S', 15))
+MAXIMO = int(os.environ.get('PRINCIPAL_CACHE_MAXIMO', 1024))
+
+USUARIOS = 'usuarios'
+APOIO = 'usuarios_apoio'
+
+_trava = threading.Lock()
+_cache = OrderedDict()   # (tabela, id) -> (expira_em, Principal ou None)
+_geracao = [0]           # muda a cada invalidação: leitura feita antes dela não entra no cache
+
+
+class Principal:
+    """Usuário logado; aceita principal['campo'] como as linhas do sqlite3."""
+
+    def __init__(self, id, tabela, nome, role, is_admin, is_super_admin, municipio, municipios, pnar, servico,
+                 acesso_saude_indigena, ativo, approved):
+        self.id = id
+        self.tabela = tabela                # USUARIOS ou APOIO
+        self.nome = nome
+        self.role = role                    # 'apoio' para usuarios_apoio
+        self.is_admin = is_admin
+        self.is_super_admin = is_super_admin
+        self.municipio = municipio
+        self.municipios = municipios        # municípios de usuario_municipios (ou o do apoio)
+        self.pnar = pnar                    # acesso à fila do PNAR
+        self.servico = servico              # ambulatório do apoio PNAR
+        self.acesso_saude_indigena = acesso_saude_indigena
+        self.ativo = ativo
+        self.approved = approved
+
+    def __getitem__(self, campo):
+        return getattr(self, campo)
+
+    @property
+    def apoio(self):
+        return self.tabela == APOIO
+
+
+def carregar_principal(cursor, tabela, user_id):
+    """Principal lido do banco, sem cache; None se o usuário não existe."""
+    if tabela == APOIO:
+        cursor.execute('''
+            SELECT id, nome, municipio, COALESCE(pnar, 0) AS pnar, servico,
+                   COALESCE(acesso_saude_indigena, 0) AS acesso_saude_indigena, ativo, approved
+            FROM usuarios_apoio WHERE id = ?
+        ''', (user_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return Principal(row['id'], APOIO, row['nome'], 'apoio', 0, 0, row['municipio'],
+                         [row['municipio']] if row['municipio'] else [], row['pnar'] == 1, row['servico'],
+                         row['acesso_saude_indigena'], row['ativo'], row['approved'])
+
+    # acesso_saude_indigena de usuarios vem do apoio de mesmo id, como em saude_indigena
+    cursor.execute('''
+        SELECT u.id, u.nome, u.role, u.is_admin, u.is_super_admin, u.municipio, u.ativo, u.approved,
+               COALESCE(a.acesso_saude_indigena, 0) AS acesso_saude_indigena
+        FROM usuarios u
+        LEFT JOIN usuarios_apoio a ON a.id = u.id
+        WHERE u.id = ?
+    ''', (user_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    cursor.execute('SELECT municipio FROM usuario_municipios WHERE usuario_id = ?', (user_id,))
+    municipios = [r['municipio'] for r in cursor.fetchall()]
+    pnar = row['role'] == 'estadual' or row['is_super_admin'] == 1
+    return Principal(row['id'], USUARIOS, row['nome'], row['role'], row['is_admin'], row['is_super_admin'],
+                     row['municipio'], municipios, pnar, None, row['acesso_saude_indigena'], row['ativo'],
+                     row['approved'])
+
+
+def obter_principal(conectar, tabela, user_id, ttl=TTL_S):
+    """Principal pelo cache do worker (até ttl segundos), lendo do banco com conectar() quando vencido.
+
+    A conexão não é fechada: dentro de uma requisição é a da própria requisição.
+    """
+    chave = (tabela, user_id)
+    agora = time.monotonic()
+    with _trava:
+        guardado = _cache.get(chave)
+        if guardado and guardado[0] > agora:
+            _cache.move_to_end(chave)
+            return guardado[1]
+        geracao = _geracao[0]
+    principal = carregar_principal(conectar().cursor(), tabela, user_id)
+    with _trava:
+        if geracao == _geracao[0]:
+            _cache[chave] = (agora + ttl, principal)
+            _cache.move_to_end(chave)
+            while len(_cache) > MAXIMO:
+                _cache.popitem(last=False)
+    return principal
+
+
+def principal_atual(conectar, tabela=None):
+    """Principal da sessão, resolvido uma vez por requisição (g.principais).
+
+    tabela padrão: a do tipo de usuário da sessão (usuarios_apoio para apoio, senão usuarios).
+    """
+    user_id = session.get('user_id')
+    if user_id is None:
+        return None
+    if tabela is None:
+        tabela = APOIO if session.get('tipo_usuario') == 'apoio' else USUARIOS
+    resolvidos = g.setdefault('principais', {})
+    chave = (tabela, user_id)
+    if chave not in resolvidos:
+        resolvidos[chave] = obter_principal(conectar, tabela, user_id)
+    return resolvidos[chave]
+
+
+def invalidar_principal(tabela=None, user_id=None):
+    """Descarta o cache de um usuário (ou de todos, sem user_id) depois de alterá-lo."""
+    if user_id is not None:
+        user_id = int(user_id)
+    with _trava:
+        _geracao[0] += 1
+        for chave in list(_cache):
+            if (tabela is None or chave[0] == tabela) and (user_id is None or chave[1] == user_id):
+                del _cache[chave]
+    if has_app_context():
+        resolvidos = g.get('principais') or {}
+        for chave in list(resolvidos):
+            if (tabela is None or chave[0] == tabela) and (user_id is None or chave[1] == user_id):
+                del resolvidos[chave]
@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from agregados import manter_agregados
+from conexao_db import BUSY_TIMEOUT_MS, DB_PATH
+from ficha_itens import SECOES
+from ficha_registro import fabrica_fichas
+from pontuacao import CLASSIFICACOES, pontuar_lote, versao_pesos
+
+# Reclassificação de todas as fichas gravadas quando o protocolo muda um peso (pontuacao.py):
+# pontuacao_total e classificacao_risco são recalculados a partir das seções JSON de cada ficha,
+# em blocos de LOTE fichas por id. Cada bloco (leitura, cálculo e UPDATE das que mudaram) é uma
+# transação curta com os agregados mantidos junto; entre os blocos há uma pausa para a fila de
+# escrita de salvar_calculadora pegar o lock. O andamento (tabela e último id feitos) é gravado
+# na mesma transação de cada bloco, então uma reclassificação interrompida continua de onde parou.
+SQL_TABELA = '''
+    CREATE TABLE IF NOT EXISTS reclassificacoes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER REFERENCES usuarios(id),   -- NULL quando iniciada pela linha de comando
+        versao_pesos TEXT NOT NULL,                -- pontuacao.versao_pesos() usada no cálculo
+        status TEXT NOT NULL DEFAULT 'pendente',   -- pendente, executando, concluida, falhou
+        tabela TEXT,                               -- tabela em andamento (TABELAS, em ordem)
+        ultimo_id INTEGER NOT NULL DEFAULT 0,      -- última ficha já processada dessa tabela
+        total INTEGER NOT NULL DEFAULT 0,
+        processadas INTEGER NOT NULL DEFAULT 0,
+        alteradas INTEGER NOT NULL DEFAULT 0,
+        ignoradas INTEGER NOT NULL DEFAULT 0,      -- sem itens, com pontuação gravada (importadas só com o total)
+        transicoes TEXT NOT NULL DEFAULT '{}',     -- {"Médio Risco -> Alto Risco": n}
+        mensagem TEXT,
+        iniciada_em TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+        atualizada_em TEXT,
+        concluida_em TEXT
+    )
+'''
+
+TABELAS = ('calculos', 'calculos_arquivo')
+LOTE = int(os.environ.get('RECLASSIFICACAO_LOTE', 500))
+PAUSA_MS = float(os.environ.get('RECLASSIFICACAO_PAUSA_MS', 20))
+# Sem atualização há mais que isso, uma reclassificação 'executando' é dada como interrompida
+ABANDONADA_S = int(os.environ.get('RECLASSIFICACAO_ABANDONADA_S', 300))
+
+_ALTO = CLASSIFICACOES[2]
+
+
+class ReclassificacaoEmAndamento(RuntimeError):
+    pass
+
+
+def _conectar(caminho):
+    conn = sqlite3.connect(caminho, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    return conn
+
+
+def registrar_reclassificacao(cursor, user_id, versao=None):
+    """Cria a reclassificação e devolve (id, retomada).
+
+    Se a última não concluída usa os mesmos pesos e está parada (falhou ou sem atualização há
+    ABANDONADA_S segundos), devolve essa para continuar de onde parou. Recusa se houver uma em
+    andamento.
+    """
+    versao = versao or versao_pesos()
+    anterior = cursor.execute('''
+        SELECT id, status, versao_pesos,
+               COALESCE(atualizada_em, iniciada_em) < datetime('now', 'localtime', ?) AS parada
+        FROM reclassificacoes WHERE status IN ('pendente', 'executando', 'falhou')
+        ORDER BY id DESC LIMIT 1
+    ''', (f'-{ABANDONADA_S} seconds',)).fetchone()
+    if anterior:
+        if anterior['status'] != 'falhou' and not anterior['parada']:
+            raise ReclassificacaoEmAndamento(f"Reclassificação {anterior['id']} ainda em andamento.")
+        if anterior['versao_pesos'] == versao:
+            cursor.execute("UPDATE reclassificacoes SET status = 'pendente', user_id = COALESCE(?, user_id), "
+                           "atualizada_em = datetime('now', 'localtime') WHERE id = ?", (user_id, anterior['id']))
+            return anterior['id'], True
+        # Pesos mudaram de novo: a antiga não serve mais; a nova passa por todas as fichas
+        cursor.execute("UPDATE reclassificacoes SET status = 'falhou', mensagem = 'Substituída por nova versão dos pesos.', "
+                       "concluida_em = datetime('now', 'localtime') WHERE id = ?", (anterior['id'],))
+    cursor.execute('INSERT INTO reclassificacoes (user_id, versao_pesos) VALUES (?, ?)', (user_id, versao))
+    return cursor.lastrowid, False
+
+
+def obter_reclassificacao(cursor, reclassificacao_id):
+    row = cursor.execute('SELECT * FROM reclassificacoes WHERE id = ?', (reclassificacao_id,)).fetchone()
+    if not row:
+        return None
+    reclassificacao = dict(row)
+    transicoes = json.loads(reclassificacao['transicoes'] or '{}')
+    reclassificacao['transicoes'] = transicoes
+    reclassificacao['para_alto'] = sum(n for chave, n in transicoes.items() if chave.endswith(f' -> {_ALTO}'))
+    reclassificacao['sairam_de_alto'] = sum(n for chave, n in transicoes.items() if chave.startswith(f'{_ALTO} -> '))
+    total = reclassificacao['total']
+    reclassificacao['progresso'] = min(100, int(reclassificacao['processadas'] * 100 / total)) if total else 0
+    return reclassificacao
+
+
+def _salvar_andamento(conn, reclassificacao_id, andamento, status, mensagem=None):
+    conn.execute('''
+        UPDATE reclassificacoes SET status = ?, tabela = ?, ultimo_id = ?, total = ?, processadas = ?, alteradas = ?,
+               ignoradas = ?, transicoes = ?, mensagem = COALESCE(?, mensagem), atualizada_em = datetime('now', 'localtime'),
+               concluida_em = CASE WHEN ? IN ('concluida', 'falhou') THEN datetime('now', 'localtime') END
+        WHERE id = ?
+    ''', (status, andamento['tabela'], andamento['ultimo_id'], andamento['total'], andamento['processadas'],
+          andamento['alteradas'], andamento['ignoradas'], json.dumps(andamento['transicoes'], ensure_ascii=False),
+          mensagem, status, reclassificacao_id))
+
+
+def _reclassificar_bloco(conn, tabela, ultimo_id, lote, andamento):
+    """Um bloco de até `lote` fichas de `tabela` depois de ultimo_id; devolve (último id lido, lidas)."""
+    cursor = conn.cursor()
+    cursor.row_factory = fabrica_fichas()
+    fichas = cursor.execute(f'''
+        SELECT id, gestante_id, pontuacao_total, classificacao_risco, {', '.join(SECOES)}
+        FROM {tabela} WHERE id > ? ORDER BY id LIMIT ?
+    ''', (ultimo_id, lote)).fetchall()
+    if not fichas:
+        return ultimo_id, 0
+
+    pontos, classificacoes = pontuar_lote(fichas)
+    mudancas, gestante_ids = [], set()
+    transicoes = Counter()
+    for ficha, novo_pontos, nova_classificacao in zip(fichas, pontos.tolist(), classificacoes.tolist()):
+        pontos_gravados, classificacao_gravada = ficha.bruto('pontuacao_total'), ficha.bruto('classificacao_risco')
+        if str(pontos_gravados) == str(novo_pontos) and classificacao_gravada == nova_classificacao:
+            continue
+        if not any(ficha.itens(secao) for secao in SECOES):
+            # Sem itens não há o que recalcular: a pontuação gravada veio de fora (planilha importada)
+            andamento['ignoradas'] += 1
+            continue
+        mudancas.append((novo_pontos, nova_classificacao, ficha.bruto('id')))
+        if ficha.bruto('gestante_id') is not None:
+            gestante_ids.add(ficha.bruto('gestante_id'))
+        if classificacao_gravada != nova_classificacao:
+            transicoes[f"{classificacao_gravada or 'Sem classificação'} -> {nova_classificacao}"] += 1
+
+    if mudancas:
+        with manter_agregados(conn.cursor(), gestante_ids):
+            conn.executemany(f'UPDATE {tabela} SET pontuacao_total = ?, classificacao_risco = ? WHERE id = ?', mudancas)
+    andamento['processadas'] += len(fichas)
+    andamento['alteradas'] += len(mudancas)
+    andamento['transicoes'] = dict(Counter(andamento['transicoes']) + transicoes)
+    return fichas[-1].bruto('id'), len(fichas)
+
+
+def reclassificar_fichas(conn, reclassificacao_id, lote=LOTE, pausa_ms=PAUSA_MS, ao_progredir=None):
+    """Reclassifica as fichas a partir do andamento gravado; devolve o andamento final.
+
+    conn deve estar em autocommit (isolation_level=None). ao_progredir(andamento) é chamado
+    depois de cada bloco gravado.
+    """
+    atual = obter_reclassificacao(conn.cursor(), reclassificacao_id)
+    if atual is None:
+        raise ValueError(f'Reclassificação {reclassificacao_id} não encontrada.')
+    andamento = {campo: atual[campo] for campo in
+                 ('tabela', 'ultimo_id', 'total', 'processadas', 'alteradas', 'ignoradas', 'transicoes')}
+    if andamento['tabela'] is None:
+        andamento['tabela'] = TABELAS[0]
+        andamento['total'] = sum(conn.execute(f'SELECT COUNT(*) FROM {tabela}').fetchone()[0] for tabela in TABELAS)
+    _salvar_andamento(conn, reclassificacao_id, andamento, 'executando')
+
+    while andamento['tabela'] is not None:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ultimo_id, lidas = _reclassificar_bloco(conn, andamento['tabela'], andamento['ultimo_id'], lote, andamento)
+            if lidas < lote:
+                # Fim da tabela: a próxima começa do início
+                seguinte = TABELAS.index(andamento['tabela']) + 1
+                andamento['tabela'] = TABELAS[seguinte] if seguinte < len(TABELAS) else None
+                andamento['ultimo_id'] = 0
+            else:
+                andamento['ultimo_id'] = ultimo_id
+            _salvar_andamento(conn, reclassificacao_id, andamento, 'executando')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if ao_progredir:
+            ao_progredir(andamento)
+        if pausa_ms and andamento['tabela'] is not None:
+            time.sleep(pausa_ms / 1000)
+
+    # Fichas criadas durante a reclassificação já saem com os pesos novos (salvar_calculadora)
+    andamento['processadas'] = max(andamento['processadas'], andamento['total'])
+    _salvar_andamento(conn, reclassificacao_id, andamento, 'concluida')
+    return andamento
+
+
+def _executar(reclassificacao_id, caminho, lote, pausa_ms):
+    conn = _conectar(caminho)
+    try:
+        andamento = reclassificar_fichas(conn, reclassificacao_id, lote, pausa_ms)
+        logging.info(f"Reclassificação {reclassificacao_id}: {andamento['alteradas']} de {andamento['processadas']} "
+                     f"ficha(s) alterada(s); transições {json.dumps(andamento['transicoes'], ensure_ascii=False)}")
+    except Exception as e:
+        logging.error(f"Reclassificação {reclassificacao_id} falhou: {str(e)}", exc_info=True)
+        # Os blocos já gravados ficam; a próxima chamada com os mesmos pesos continua daqui
+        conn.execute('''
+            UPDATE reclassificacoes SET status = 'falhou', mensagem = ?, atualizada_em = datetime('now', 'localtime'),
+                   concluida_em = datetime('now', 'localtime')
+            WHERE id = ?
+        ''', (f'Erro na reclassificação: {str(e)}', reclassificacao_id))
+    finally:
+        conn.close()
+
+
+def iniciar_reclassificacao(reclassificacao_id, caminho=DB_PATH, lote=LOTE, pausa_ms=PAUSA_MS):
+    """Roda a reclassificação em segundo plano; o andamento é consultado em reclassificacoes."""
+    tarefa = threading.Thread(target=_executar, args=(reclassificacao_id, caminho, lote, pausa_ms),
+                              name=f'reclassificacao-{reclassificacao_id}', daemon=True)
+    tarefa.start()
+    return tarefa
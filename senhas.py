@@ -0,0 +1,65 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+# Hash e verificação de senhas (bcrypt) num pool limitado de threads por worker. O bcrypt solta
+# o GIL enquanto calcula, então as outras threads do worker seguem atendendo; o limite evita
+# que uma rajada de logins de manhã ponha mais hashes em paralelo do que há CPUs.
+# O custo (BCRYPT_ROUNDS) é configurável: hashes com outro custo são refeitos no próximo login.
+ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+THREADS = int(os.environ.get('BCRYPT_THREADS', os.cpu_count() or 2))
+TIMEOUT_S = float(os.environ.get('BCRYPT_TIMEOUT_S', 30))
+
+_CUSTO = re.compile(r'^\$2[abxy]?\$(\d{2})\$')
+
+_trava = threading.Lock()
+_executor = None
+_pid = None
+
+
+def _pool():
+    global _executor, _pid
+    pid = os.getpid()
+    with _trava:
+        # Depois do fork do worker as threads do processo pai não existem aqui
+        if _executor is None or _pid != pid:
+            _executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix='bcrypt')
+            _pid = pid
+        return _executor
+
+
+def _hash(senha, rounds):
+    return bcrypt.hashpw(senha.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _confere(senha, senha_hash):
+    try:
+        return bcrypt.checkpw(senha.encode('utf-8'), senha_hash.encode('utf-8'))
+    except ValueError:
+        # Hash corrompido ou em outro formato: senha não confere
+        return False
+
+
+def gerar_hash(senha, rounds=None):
+    """Hash bcrypt da senha (str), calculado no pool."""
+    return _pool().submit(_hash, senha, rounds or ROUNDS).result(TIMEOUT_S)
+
+
+def verificar_senha(senha, senha_hash):
+    """True se a senha confere com o hash; calculado no pool."""
+    if not senha or not senha_hash:
+        return False
+    return _pool().submit(_confere, senha, senha_hash).result(TIMEOUT_S)
+
+
+def custo(senha_hash):
+    """Custo (log2 das rodadas) gravado no hash; None se não for um hash bcrypt."""
+    encontrado = _CUSTO.match(senha_hash or '')
+    return int(encontrado.group(1)) if encontrado else None
+
+
+def precisa_rehash(senha_hash, rounds=None):
+    return custo(senha_hash) != (rounds or ROUNDS)
@@ -0,0 +1,63 @@
+import os
+import re
+import uuid
+
+from fichas import gravar_ficha
+
+# Envio idempotente de fichas da calculadora. A página gera uma chave (UUID) para cada ficha no
+# momento em que ela é preenchida; sem conexão, a ficha fica na fila local (localStorage) e é
+# reenviada em lote por /sincronizar_fichas quando a rede volta. A chave fica registrada na mesma
+# transação da ficha, então reenvios (tentativa que chegou ao servidor mas cuja resposta se
+# perdeu, lote repetido) devolvem o código da ficha já gravada em vez de criar outra.
+SQL_TABELA = '''
+    CREATE TABLE IF NOT EXISTS sincronizacoes (
+        user_id INTEGER NOT NULL,
+        chave TEXT NOT NULL,          -- gerada pela página para cada ficha
+        codigo_ficha TEXT NOT NULL,
+        ficha_id INTEGER NOT NULL,
+        recebida_em TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+        PRIMARY KEY (user_id, chave)
+    ) WITHOUT ROWID
+'''
+
+LOTE_MAXIMO = int(os.environ.get('SINCRONIZACAO_LOTE_MAXIMO', 200))   # fichas por requisição
+_BLOCO = 300
+
+_CHAVE = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+
+def chave_valida(chave):
+    return isinstance(chave, str) and bool(_CHAVE.match(chave))
+
+
+def novo_codigo_ficha():
+    return str(uuid.uuid4())[:8].upper()
+
+
+def gravar_sincronizadas(cursor, user_id, profissional, fichas):
+    """Grava as fichas [(chave, dados validados)] que ainda não foram recebidas.
+
+    Devolve, na mesma ordem, (codigo_ficha, nova): nova=False quando a chave já estava registrada
+    (ou repetida no próprio lote). Não faz commit: roda na transação do chamador (fila de escrita).
+    """
+    chaves = sorted({chave for chave, _ in fichas})
+    recebidas = {}
+    for inicio in range(0, len(chaves), _BLOCO):
+        bloco = chaves[inicio:inicio + _BLOCO]
+        recebidas.update(cursor.execute(f'''
+            SELECT chave, codigo_ficha FROM sincronizacoes
+            WHERE user_id = ? AND chave IN ({','.join(['?'] * len(bloco))})
+        ''', [user_id] + bloco).fetchall())
+
+    resultados = []
+    for chave, dados in fichas:
+        if chave in recebidas:
+            resultados.append((recebidas[chave], False))
+            continue
+        codigo_ficha = novo_codigo_ficha()
+        ficha_id = gravar_ficha(cursor, dados, user_id, codigo_ficha, profissional)
+        cursor.execute('INSERT INTO sincronizacoes (user_id, chave, codigo_ficha, ficha_id) VALUES (?, ?, ?, ?)',
+                       (user_id, chave, codigo_ficha, ficha_id))
+        recebidas[chave] = codigo_ficha
+        resultados.append((codigo_ficha, True))
+    return resultados
@@ -0,0 +1,117 @@
+import sqlite3
+from collections import Counter
+
+import pytest
+
+import init_db
+from agregados import ler_agregados, verificar_agregados
+from fichas import gravar_ficha, validar_ficha
+from operacoes_lote import aplicar_operacoes
+
+
+def _ficha(nome, cpf, municipio, data_envio, raca='Parda', risco='Risco Habitual'):
+    return validar_ficha({
+        'nome_gestante': nome, 'data_nasc': '14/08/1995', 'cpf': cpf, 'telefone': '83999990000',
+        'municipio': municipio, 'ubs': 'UBS 1', 'acs': 'ACS 1', 'periodo_gestacional': '1º Trimestre',
+        'data_envio': data_envio, 'classificacao_risco': risco, 'genero': '1', 'raca_cor_etnia': raca,
+        'comorbidades': '["C1"]',
+    })
+
+
+@pytest.fixture
+def cursor(tmp_path):
+    caminho = str(tmp_path / 'banco.db')
+    init_db.migrar(caminho)
+    conn = sqlite3.connect(caminho)
+    conn.row_factory = sqlite3.Row
+    yield conn.cursor()
+    conn.close()
+
+
+def _gravar(cursor, codigo, *args, **kwargs):
+    return gravar_ficha(cursor, _ficha(*args, **kwargs), 1, codigo, 'Profissional')
+
+
+def _ao_vivo(cursor, municipios, indigena=False):
+    """Contagens como admin_relatorio/saude_indigena faziam direto nas fichas do escopo."""
+    where = [f"municipio IN ({','.join(['?'] * len(municipios))})"]
+    if indigena:
+        where.append("raca_cor_etnia = 'Indígena'")
+    where = ' AND '.join(where)
+    contagem = Counter()
+    vistas = set()
+    for row in cursor.execute(
+            f'SELECT * FROM calculos_completo WHERE {where} ORDER BY data_envio_iso DESC, id DESC',
+            municipios).fetchall():
+        if row['gestante_id'] in vistas:
+            continue
+        vistas.add(row['gestante_id'])
+        contagem['gestantes'] += 1
+        contagem['fora_area'] += row['fa'] == 1
+        if row['desfecho']:
+            contagem['desfecho:' + row['desfecho']] += 1
+    for row in cursor.execute(f'''
+        SELECT * FROM calculos_completo WHERE id IN (
+            SELECT MAX(id) FROM calculos_completo
+            WHERE {where} AND desfecho IS NULL AND fa = 0 GROUP BY gestante_id)
+    ''', municipios).fetchall():
+        contagem['ativas'] += 1
+        contagem['risco:' + row['classificacao_risco']] += 1
+    contagem['fichas'] = cursor.execute(
+        f'SELECT COUNT(*) FROM calculos_completo WHERE {where} AND fa = 0', municipios).fetchone()[0]
+    return +contagem
+
+
+def _lido(cursor, municipios, indigena=False):
+    agregados = ler_agregados(cursor, municipios=municipios, indigena=indigena)
+    contagem = Counter({dimensao: sum(agregados.get(dimensao, {}).values())
+                        for dimensao in ('gestantes', 'fora_area', 'ativas', 'fichas')})
+    for valor, total in agregados.get('desfecho', {}).items():
+        contagem['desfecho:' + valor] = total
+    for valor, total in agregados.get('risco', {}).items():
+        contagem['risco:' + valor] = total
+    return +contagem
+
+
+def test_gestante_com_fichas_em_dois_municipios(cursor):
+    # Fora de área em Sousa e ficha mais nova em Assunção
+    _gravar(cursor, 'F1', 'Roberta', '11144477735', 'Sousa', '06/06/2025')
+    aplicar_operacoes(cursor, 1, [{'tipo': 'fora_area', 'codigo_ficha': 'F1',
+                                   'nome_gestante': 'Roberta', 'data_nasc': '14/08/1995'}], '07/06/2025')
+    _gravar(cursor, 'F2', 'Roberta', '11144477735', 'Assunção', '10/09/2025', risco='Alto Risco')
+    # Desfecho registrado em Sousa e ficha mais nova em Assunção
+    _gravar(cursor, 'F3', 'Carla', '', 'Sousa', '01/05/2025', raca='Indígena')
+    aplicar_operacoes(cursor, 1, [{'tipo': 'desfecho', 'nome_gestante': 'Carla',
+                                   'data_nasc': '14/08/1995', 'desfecho': 'W83'}], '02/05/2025')
+    _gravar(cursor, 'F4', 'Carla', '', 'Assunção', '03/07/2025', raca='Indígena')
+    # Ativa só em Sousa, com duas fichas
+    _gravar(cursor, 'F5', 'Heliana', '52998224725', 'Sousa', '21/09/2025')
+    _gravar(cursor, 'F6', 'Heliana', '52998224725', 'Sousa', '22/09/2025', risco='Alto Risco')
+
+    for municipios in (['Sousa'], ['Assunção'], ['Sousa', 'Assunção']):
+        for indigena in (False, True):
+            assert _lido(cursor, municipios, indigena) == _ao_vivo(cursor, municipios, indigena)
+
+    sousa = _lido(cursor, ['Sousa'])
+    assert (sousa['gestantes'], sousa['fora_area'], sousa['desfecho:W83'], sousa['ativas']) == (3, 1, 1, 1)
+    assert verificar_agregados(cursor) == []
+
+
+def test_ficha_mais_nova_em_outro_municipio_nao_move_a_situacao(cursor):
+    _gravar(cursor, 'F1', 'Roberta', '11144477735', 'Sousa', '06/06/2025')
+    _gravar(cursor, 'F2', 'Carla', '52998224725', 'Sousa', '01/05/2025')
+    aplicar_operacoes(cursor, 1, [
+        {'tipo': 'fora_area', 'codigo_ficha': 'F1', 'nome_gestante': 'Roberta', 'data_nasc': '14/08/1995'},
+        {'tipo': 'desfecho', 'nome_gestante': 'Carla', 'data_nasc': '14/08/1995', 'desfecho': 'W83'},
+    ], '07/06/2025')
+    antes = _lido(cursor, ['Sousa'])
+    assert (antes['gestantes'], antes['fora_area'], antes['desfecho:W83'], antes['ativas']) == (2, 1, 1, 0)
+
+    nova = _gravar(cursor, 'F3', 'Roberta', '11144477735', 'Assunção', '10/09/2025')
+    _gravar(cursor, 'F4', 'Carla', '52998224725', 'Assunção', '03/07/2025')
+
+    # O ponteiro da gestante passa para a ficha de Assunção; o relatório de Sousa não muda
+    assert cursor.execute("SELECT ultima_ficha_id FROM gestantes WHERE chave = 'cpf:11144477735'").fetchone()[0] == nova
+    assert _lido(cursor, ['Sousa']) == antes
+    assuncao = _lido(cursor, ['Assunção'])
+    assert (assuncao['gestantes'], assuncao['fora_area'], assuncao['ativas']) == (2, 0, 2)